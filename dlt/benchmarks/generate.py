@@ -0,0 +1,479 @@
+"""
+Synthetic OpenMRS data generator - raw tables at configurable scales for benchmarks
+"""
+from datetime import timezone
+
+import sqlalchemy as sa
+
+# Scale points: patients, encounters per patient, obs per encounter, distinct
+# question concepts and answers per coded concept
+SCALES = {
+    "tiny": {"patients": 1000, "encounters_per_patient": 5, "obs_per_encounter": 10, "concepts": 50, "coded_answers": 5},
+    "small": {"patients": 10000, "encounters_per_patient": 10, "obs_per_encounter": 10, "concepts": 200, "coded_answers": 5},
+    "medium": {"patients": 100000, "encounters_per_patient": 10, "obs_per_encounter": 10, "concepts": 500, "coded_answers": 8},
+    "large": {"patients": 1000000, "encounters_per_patient": 20, "obs_per_encounter": 25, "concepts": 1000, "coded_answers": 10},
+}
+
+# Fixed sizes of the metadata tables
+LOCATIONS = 20
+ENCOUNTER_TYPES = 10
+VISIT_TYPES = 3
+PROVIDERS = 50
+PROGRAMS = 3
+STATES_PER_WORKFLOW = 3
+APPOINTMENT_SERVICES = 5
+TYPES_PER_SERVICE = 2
+APPOINTMENTS_PER_PATIENT = 2
+# Answer concepts shared by all coded question concepts, per answer of a concept
+ANSWER_POOL_FACTOR = 10
+# Encounters and appointments are spread over this many seconds (5 years) from 2020-01-01
+TIME_SPAN_SECONDS = 5 * 365 * 24 * 3600
+
+BASE_TIME = "TIMESTAMPTZ '2020-01-01 00:00:00+00'"
+
+# One CREATE TABLE ... AS SELECT per raw table. Values are derived from the row id with
+# rnd(id, salt, n) = hash(id, seed, salt) % n, so every scale point is reproducible for a
+# given seed and rows refer to each other (obs -> encounter -> patient) without joins.
+TABLE_QUERIES = {
+    "location": """
+        SELECT
+            i AS location_id,
+            'Location ' || i AS name,
+            'Synthetic location ' || i AS description,
+            i || ' Main Road' AS address1,
+            NULL::VARCHAR AS address2,
+            'City ' || (i % 5) AS city_village,
+            'Province ' || (i % 3) AS state_province,
+            lpad(i::VARCHAR, 5, '0') AS postal_code,
+            'Country' AS country,
+            false AS retired,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('location' || i), 1, 36) AS uuid
+        FROM range(1, {locations} + 1) t(i)
+    """,
+    "encounter_type": """
+        SELECT
+            i AS encounter_type_id,
+            'Encounter Type ' || i AS name,
+            'Synthetic encounter type ' || i AS description,
+            false AS retired,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('encounter_type' || i), 1, 36) AS uuid
+        FROM range(1, {encounter_types} + 1) t(i)
+    """,
+    "visit_type": """
+        SELECT
+            i AS visit_type_id,
+            'Visit Type ' || i AS name,
+            'Synthetic visit type ' || i AS description,
+            false AS retired,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('visit_type' || i), 1, 36) AS uuid
+        FROM range(1, {visit_types} + 1) t(i)
+    """,
+    "concept": """
+        SELECT
+            i AS concept_id,
+            CASE WHEN i <= {concepts} AND i % 4 = 0 THEN 2
+                 WHEN i <= {concepts} AND i % 4 = 1 THEN 1
+                 WHEN i <= {concepts} AND i % 4 = 2 THEN 3
+                 WHEN i <= {concepts} THEN 8
+                 ELSE 4 END AS datatype_id,
+            1 AS class_id,
+            false AS is_set,
+            false AS retired,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('concept' || i), 1, 36) AS uuid
+        FROM range(1, {all_concepts} + 1) t(i)
+    """,
+    "concept_name": """
+        SELECT
+            i AS concept_name_id,
+            i AS concept_id,
+            CASE WHEN i <= {concepts} THEN 'Question ' || i
+                 WHEN i <= {answers_end} THEN 'Answer ' || (i - {concepts})
+                 ELSE 'Program Concept ' || (i - {answers_end}) END AS name,
+            'en' AS locale,
+            true AS locale_preferred,
+            'FULLY_SPECIFIED' AS concept_name_type,
+            false AS voided,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('concept_name' || i), 1, 36) AS uuid
+        FROM range(1, {all_concepts} + 1) t(i)
+    """,
+    "concept_answer": """
+        SELECT
+            row_number() OVER () AS concept_answer_id,
+            q AS concept_id,
+            {concepts} + 1 + ((q * {coded_answers} + k) % {answer_pool}) AS answer_concept,
+            k + 1 AS sort_weight,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('concept_answer' || q || '-' || k), 1, 36) AS uuid
+        FROM range(4, {concepts} + 1, 4) c(q), range(0, {coded_answers}) a(k)
+    """,
+    "person": """
+        SELECT
+            i AS person_id,
+            CASE WHEN rnd(i, 'gender', 2) = 0 THEN 'F' ELSE 'M' END AS gender,
+            (DATE '1940-01-01' + rnd(i, 'birthdate', 25000)::INTEGER) AS birthdate,
+            false AS birthdate_estimated,
+            rnd(i, 'dead', 100) = 0 AS dead,
+            NULL::TIMESTAMPTZ AS death_date,
+            false AS voided,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('person' || i), 1, 36) AS uuid
+        FROM range(1, {patients} + {providers} + 1) t(i)
+    """,
+    "person_name": """
+        SELECT
+            i AS person_name_id,
+            i AS person_id,
+            true AS preferred,
+            'Given' || rnd(i, 'given', 5000) AS given_name,
+            NULL::VARCHAR AS middle_name,
+            'Family' || rnd(i, 'family', 20000) AS family_name,
+            false AS voided,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('person_name' || i), 1, 36) AS uuid
+        FROM range(1, {patients} + {providers} + 1) t(i)
+    """,
+    "patient": """
+        SELECT
+            i AS patient_id,
+            false AS voided,
+            1 AS creator,
+            {base_time} AS date_created
+        FROM range(1, {patients} + 1) t(i)
+    """,
+    "provider": """
+        SELECT
+            i AS provider_id,
+            {patients} + i AS person_id,
+            'Provider ' || i AS name,
+            'PRV' || i AS identifier,
+            false AS retired,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('provider' || i), 1, 36) AS uuid
+        FROM range(1, {providers} + 1) t(i)
+    """,
+    "encounter": """
+        SELECT
+            e AS encounter_id,
+            1 + rnd(e, 'encounter_type', {encounter_types}) AS encounter_type,
+            (e - 1) // {encounters_per_patient} + 1 AS patient_id,
+            1 + rnd(e, 'location', {locations}) AS location_id,
+            NULL::BIGINT AS form_id,
+            {encounter_datetime} AS encounter_datetime,
+            e AS visit_id,
+            rnd(e, 'voided', 100) = 0 AS voided,
+            1 AS creator,
+            {encounter_datetime} AS date_created,
+            NULL::TIMESTAMPTZ AS date_changed,
+            NULL::TIMESTAMPTZ AS date_voided,
+            substr(md5('encounter' || e), 1, 36) AS uuid
+        FROM range(1, {encounters} + 1) t(e)
+    """,
+    "visit": """
+        SELECT
+            e AS visit_id,
+            (e - 1) // {encounters_per_patient} + 1 AS patient_id,
+            1 + rnd(e, 'visit_type', {visit_types}) AS visit_type_id,
+            {encounter_datetime} AS date_started,
+            {encounter_datetime} + INTERVAL 1 HOUR AS date_stopped,
+            1 + rnd(e, 'location', {locations}) AS location_id,
+            false AS voided,
+            1 AS creator,
+            {encounter_datetime} AS date_created,
+            substr(md5('visit' || e), 1, 36) AS uuid
+        FROM range(1, {encounters} + 1) t(e)
+    """,
+    "obs": """
+        SELECT
+            o AS obs_id,
+            (e - 1) // {encounters_per_patient} + 1 AS person_id,
+            concept_id,
+            e AS encounter_id,
+            {encounter_datetime} AS obs_datetime,
+            1 + rnd(e, 'location', {locations}) AS location_id,
+            NULL::BIGINT AS obs_group_id,
+            NULL::VARCHAR AS accession_number,
+            NULL::BIGINT AS value_group_id,
+            CASE WHEN concept_id % 4 = 0
+                 THEN {concepts} + 1 + ((concept_id * {coded_answers} + rnd(o, 'answer', {coded_answers})) % {answer_pool})
+                 END AS value_coded,
+            NULL::BIGINT AS value_coded_name_id,
+            NULL::BIGINT AS value_drug,
+            CASE WHEN concept_id % 4 = 3
+                 THEN {base_time} + (rnd(o, 'datetime', {time_span})) * INTERVAL 1 SECOND
+                 END AS value_datetime,
+            CASE WHEN concept_id % 4 = 1 THEN (rnd(o, 'numeric', 100000)) / 100.0 END AS value_numeric,
+            NULL::VARCHAR AS value_modifier,
+            CASE WHEN concept_id % 4 = 2 THEN 'Text ' || (rnd(o, 'text', 1000)) END AS value_text,
+            NULL::VARCHAR AS value_complex,
+            NULL::VARCHAR AS comments,
+            1 AS creator,
+            {encounter_datetime} AS date_created,
+            rnd(o, 'voided', 50) = 0 AS voided,
+            NULL::TIMESTAMPTZ AS date_voided,
+            NULL::VARCHAR AS void_reason,
+            substr(md5('obs' || o), 1, 36) AS uuid,
+            NULL::BIGINT AS previous_version,
+            NULL::VARCHAR AS form_namespace_and_path,
+            'FINAL' AS status
+        FROM (
+            SELECT
+                o,
+                (o - 1) // {obs_per_encounter} + 1 AS e,
+                1 + rnd(o, 'concept', {concepts}) AS concept_id
+            FROM range(1, {obs} + 1) t(o)
+        )
+    """,
+    "program": """
+        SELECT
+            p AS program_id,
+            {answers_end} + p AS concept_id,
+            'Program ' || p AS name,
+            'Synthetic program ' || p AS description,
+            false AS retired,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('program' || p), 1, 36) AS uuid
+        FROM range(1, {programs} + 1) t(p)
+    """,
+    "program_workflow": """
+        SELECT
+            p AS program_workflow_id,
+            p AS program_id,
+            {answers_end} + {programs} + p AS concept_id,
+            false AS retired,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('program_workflow' || p), 1, 36) AS uuid
+        FROM range(1, {programs} + 1) t(p)
+    """,
+    "program_workflow_state": """
+        SELECT
+            s AS program_workflow_state_id,
+            (s - 1) // {states_per_workflow} + 1 AS program_workflow_id,
+            {answers_end} + 2 * {programs} + s AS concept_id,
+            (s - 1) % {states_per_workflow} = 0 AS initial,
+            (s - 1) % {states_per_workflow} = {states_per_workflow} - 1 AS terminal,
+            false AS retired,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('program_workflow_state' || s), 1, 36) AS uuid
+        FROM range(1, {programs} * {states_per_workflow} + 1) t(s)
+    """,
+    "patient_program": """
+        SELECT
+            i AS patient_program_id,
+            i AS patient_id,
+            {program_of_patient} AS program_id,
+            {enrolled} AS date_enrolled,
+            CASE WHEN rnd(i, 'completed', 4) = 0 THEN {enrolled} + INTERVAL 180 DAY END AS date_completed,
+            1 + rnd(i, 'location', {locations}) AS location_id,
+            CASE WHEN rnd(i, 'completed', 4) = 0
+                 THEN {answers_end} + 2 * {programs} + {program_of_patient} * {states_per_workflow}
+                 END AS outcome_concept_id,
+            false AS voided,
+            NULL::VARCHAR AS void_reason,
+            1 AS creator,
+            {enrolled} AS date_created,
+            NULL::TIMESTAMPTZ AS date_changed,
+            substr(md5('patient_program' || i), 1, 36) AS uuid
+        FROM range(1, {patients} + 1) t(i)
+    """,
+    "patient_state": """
+        SELECT
+            2 * (i - 1) + k + 1 AS patient_state_id,
+            i AS patient_program_id,
+            ({program_of_patient} - 1) * {states_per_workflow} + k + 1 AS state,
+            {enrolled} + k * INTERVAL 30 DAY AS start_date,
+            CASE WHEN k = 0 THEN {enrolled} + INTERVAL 30 DAY END AS end_date,
+            false AS voided,
+            1 AS creator,
+            {enrolled} + k * INTERVAL 30 DAY AS date_created,
+            substr(md5('patient_state' || i || '-' || k), 1, 36) AS uuid
+        FROM range(1, {patients} + 1) t(i), range(0, 2) s(k)
+    """,
+    "appointment_service": """
+        SELECT
+            i AS appointment_service_id,
+            'Service ' || i AS name,
+            'Synthetic appointment service ' || i AS description,
+            TIME '08:00:00' AS start_time,
+            TIME '17:00:00' AS end_time,
+            30 AS duration_mins,
+            1 + i % {locations} AS location_id,
+            false AS voided,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('appointment_service' || i), 1, 36) AS uuid
+        FROM range(1, {appointment_services} + 1) t(i)
+    """,
+    "appointment_service_type": """
+        SELECT
+            i AS appointment_service_type_id,
+            (i - 1) // {types_per_service} + 1 AS appointment_service_id,
+            'Service Type ' || i AS name,
+            15 * (1 + i % 4) AS duration_mins,
+            false AS voided,
+            1 AS creator,
+            {base_time} AS date_created,
+            substr(md5('appointment_service_type' || i), 1, 36) AS uuid
+        FROM range(1, {appointment_services} * {types_per_service} + 1) t(i)
+    """,
+    "patient_appointment": """
+        SELECT
+            a AS patient_appointment_id,
+            1 + rnd(a, 'provider', {providers}) AS provider_id,
+            'APT' || a AS appointment_number,
+            (a - 1) // {appointments_per_patient} + 1 AS patient_id,
+            {appointment_start} AS start_date_time,
+            {appointment_start} + INTERVAL 30 MINUTE AS end_date_time,
+            service_id AS appointment_service_id,
+            (service_id - 1) * {types_per_service} + 1 + rnd(a, 'service_type', {types_per_service}) AS appointment_service_type_id,
+            CASE rnd(a, 'status', 4) WHEN 0 THEN 'Scheduled' WHEN 1 THEN 'Completed'
+                 WHEN 2 THEN 'Missed' ELSE 'Cancelled' END AS status,
+            1 + rnd(a, 'location', {locations}) AS location_id,
+            CASE WHEN rnd(a, 'kind', 10) = 0 THEN 'WalkIn' ELSE 'Scheduled' END AS appointment_kind,
+            NULL::VARCHAR AS comments,
+            NULL::BIGINT AS related_appointment_id,
+            {appointment_start} - INTERVAL 7 DAY AS date_appointment_scheduled,
+            NULL::VARCHAR AS priority,
+            NULL::VARCHAR AS tele_health_video_link,
+            false AS voided,
+            NULL::VARCHAR AS void_reason,
+            1 AS creator,
+            {appointment_start} - INTERVAL 7 DAY AS date_created,
+            NULL::TIMESTAMPTZ AS date_changed,
+            substr(md5('patient_appointment' || a), 1, 36) AS uuid
+        FROM (
+            SELECT a, 1 + rnd(a, 'service', {appointment_services}) AS service_id
+            FROM range(1, {appointments} + 1) t(a)
+        )
+    """,
+}
+
+
+def scale_parameters(scale, seed):
+    """Row counts, id ranges and shared SQL expressions of a scale point"""
+    patients = scale["patients"]
+    encounters = patients * scale["encounters_per_patient"]
+    answer_pool = scale["coded_answers"] * ANSWER_POOL_FACTOR
+    answers_end = scale["concepts"] + answer_pool
+    parameters = {
+        **scale,
+        "seed": seed,
+        "encounters": encounters,
+        "obs": encounters * scale["obs_per_encounter"],
+        "appointments": patients * APPOINTMENTS_PER_PATIENT,
+        "answer_pool": answer_pool,
+        "answers_end": answers_end,
+        "all_concepts": answers_end + PROGRAMS * (2 + STATES_PER_WORKFLOW),
+        "locations": LOCATIONS,
+        "encounter_types": ENCOUNTER_TYPES,
+        "visit_types": VISIT_TYPES,
+        "providers": PROVIDERS,
+        "programs": PROGRAMS,
+        "states_per_workflow": STATES_PER_WORKFLOW,
+        "appointment_services": APPOINTMENT_SERVICES,
+        "types_per_service": TYPES_PER_SERVICE,
+        "appointments_per_patient": APPOINTMENTS_PER_PATIENT,
+        "time_span": TIME_SPAN_SECONDS,
+        "base_time": BASE_TIME,
+    }
+    # Encounter times grow with encounter_id like the autoincrement ids of a live system
+    parameters["encounter_datetime"] = f"({BASE_TIME} + (e * {TIME_SPAN_SECONDS} // {encounters}) * INTERVAL 1 SECOND)"
+    parameters["appointment_start"] = (
+        f"({BASE_TIME} + (a * {TIME_SPAN_SECONDS} // {parameters['appointments']}) * INTERVAL 1 SECOND)"
+    )
+    parameters["program_of_patient"] = f"(1 + rnd(i, 'program', {PROGRAMS}))"
+    parameters["enrolled"] = f"({BASE_TIME} + (rnd(i, 'enrolled', {TIME_SPAN_SECONDS})) * INTERVAL 1 SECOND)"
+    return parameters
+
+
+def generate_tables(conn, scale, seed=42, dataset_name="openmrs_analytics"):
+    """
+    Create the synthetic raw tables of a scale point in a DuckDB connection.
+    Returns the row count of every generated table.
+    """
+    parameters = scale_parameters(scale, seed)
+    conn.execute(f"CREATE SCHEMA IF NOT EXISTS {dataset_name}")
+    # hash() is a UBIGINT: the modulo must stay unsigned, with a signed n it is computed
+    # in DOUBLE and the rounding skews the distribution
+    conn.execute(f"CREATE OR REPLACE TEMP MACRO rnd(x, salt, n) AS (hash(x, {seed}, salt) % n::UBIGINT)::BIGINT")
+    row_counts = {}
+    for table_name, query in TABLE_QUERIES.items():
+        conn.execute(f"CREATE OR REPLACE TABLE {dataset_name}.{table_name} AS {query.format(**parameters)}")
+        row_counts[table_name] = conn.execute(f"SELECT COUNT(*) FROM {dataset_name}.{table_name}").fetchone()[0]
+        print(f"Generated {table_name}: {row_counts[table_name]} rows")
+    check_data_shape(conn, scale, dataset_name)
+    return row_counts
+
+
+def check_data_shape(conn, scale, dataset_name="openmrs_analytics", tolerance=0.05):
+    """
+    Check that the generated obs match the scale point: every question concept is
+    observed and the share of coded obs is within tolerance of its concept share.
+    Raises ValueError otherwise.
+    """
+    concepts, coded_share = conn.execute(f"""
+        SELECT COUNT(DISTINCT concept_id), AVG(CASE WHEN value_coded IS NOT NULL THEN 1.0 ELSE 0.0 END)
+        FROM {dataset_name}.obs
+    """).fetchone()
+    if concepts != scale["concepts"]:
+        raise ValueError(f"obs observe {concepts} distinct concepts, the scale has {scale['concepts']}")
+    # Every fourth question concept is coded
+    expected_share = (scale["concepts"] // 4) / scale["concepts"]
+    if abs(coded_share - expected_share) > tolerance:
+        raise ValueError(f"{coded_share:.1%} of obs are coded, expected {expected_share:.1%}")
+
+
+def create_mysql_database(engine, source_database, database, table_names):
+    """
+    (Re)create a benchmark database next to the OpenMRS one with empty copies of its
+    tables. CREATE TABLE ... LIKE keeps columns and indexes but no foreign keys.
+    """
+    with engine.begin() as conn:
+        conn.execute(sa.text(f"CREATE DATABASE IF NOT EXISTS `{database}`"))
+        for table_name in table_names:
+            conn.execute(sa.text(f"DROP TABLE IF EXISTS `{database}`.`{table_name}`"))
+            conn.execute(sa.text(f"CREATE TABLE `{database}`.`{table_name}` LIKE `{source_database}`.`{table_name}`"))
+
+
+def copy_to_mysql(duckdb_conn, engine, table_names, dataset_name="openmrs_analytics", batch_size=50000):
+    """
+    Insert generated tables into the MySQL database of engine in batches. Only columns
+    the MySQL table has are copied, the others get their defaults (non-strict sql_mode).
+    """
+    for table_name in table_names:
+        mysql_table = sa.Table(table_name, sa.MetaData(), autoload_with=engine)
+        generated_columns = [row[0] for row in duckdb_conn.execute(f"DESCRIBE {dataset_name}.{table_name}").fetchall()]
+        columns = [name for name in generated_columns if name in mysql_table.c]
+        cursor = duckdb_conn.execute(f"SELECT {', '.join(columns)} FROM {dataset_name}.{table_name}")
+        copied = 0
+        with engine.connect() as conn:
+            conn.execute(sa.text("SET SESSION sql_mode = ''"))
+            conn.execute(sa.text("SET SESSION foreign_key_checks = 0"))
+            while rows := cursor.fetchmany(batch_size):
+                conn.execute(mysql_table.insert(), [dict(zip(columns, map(mysql_value, row))) for row in rows])
+                conn.commit()
+                copied += len(rows)
+        print(f"Copied {table_name}: {copied} rows")
+
+
+def mysql_value(value):
+    """MySQL DATETIME is naive UTC"""
+    if getattr(value, "tzinfo", None) is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
@@ -8,8 +8,8 @@ import os
 # This is required for dlt to locate the .dlt/ configuration directory
 os.chdir('/opt/airflow/dlt')
 
-from pipeline.pipeline_runner import run_full_pipeline
-from pipeline.transform_pivot import incremental_widened_observations
+from pipeline.config import get_db_path
+from pipeline.pipeline_runner import run_full_pipeline, run_incremental_pipeline
 
 default_args = {
     'owner': 'openmrs',
@@ -27,7 +27,7 @@ def run_incremental_etl():
     import os
 
     # Check if this is the first run by seeing if the database exists
-    db_path = "/opt/airflow/data/openmrs_etl.duckdb"
+    db_path = get_db_path()
     is_first_run = not os.path.exists(db_path)
 
     if is_first_run:
@@ -39,12 +39,12 @@ def run_incremental_etl():
             conn = duckdb.connect(db_path)
             conn.execute("SELECT 1 FROM openmrs_analytics.flattened_observations LIMIT 1")
             conn.close()
-            print("Tables exist - running incremental update...")
-            pipeline = None  # Let the function create its own pipeline
-            incremental_widened_observations(pipeline)
         except Exception as e:
             print(f"Tables don't exist - running full ETL pipeline: {e}")
             run_full_pipeline()
+            return
+        print("Tables exist - running incremental update...")
+        run_incremental_pipeline()
 
 def run_full_etl():
     """Force full pipeline execution - useful for reprocessing or schema changes"""
@@ -0,0 +1,41 @@
+"""
+Pipeline settings shared by the extract and transform steps
+"""
+import os
+
+import dlt
+
+# Configuration settings, DB_PATH and PIPELINES_DIR can be overridden from the environment
+DEFAULT_DB_PATH = "/opt/airflow/data/openmrs_etl.duckdb"
+DATASET_NAME = "openmrs_analytics"
+PIPELINE_NAME = "openmrs_etl"
+
+
+def get_db_path():
+    """Path of the DuckDB database the pipeline loads into"""
+    return os.getenv("DB_PATH", DEFAULT_DB_PATH)
+
+
+def get_option(key, default=None, option_type=None):
+    """
+    Read an option from .dlt/config.toml or the environment by its dotted key.
+    Environment variables are strings, they are coerced to option_type (the type of
+    default if not given), e.g. "false" to False and '["a", "b"]' to a list.
+    """
+    if option_type is None and default is not None:
+        option_type = type(default)
+    value = dlt.config.get(key, option_type)
+    return default if value is None else value
+
+
+def get_pipeline():
+    """
+    The openmrs_etl dlt pipeline on the DuckDB database at DB_PATH. PIPELINES_DIR
+    keeps its local state apart, e.g. for benchmarks (dlt's default when unset).
+    """
+    return dlt.pipeline(
+        pipeline_name=PIPELINE_NAME,
+        destination=dlt.destinations.duckdb(get_db_path()),
+        dataset_name=DATASET_NAME,
+        pipelines_dir=os.getenv("PIPELINES_DIR")
+    )
@@ -0,0 +1,167 @@
+"""
+Change data capture for raw OpenMRS tables from the MySQL row-based binlog
+"""
+from datetime import datetime
+
+import dlt
+import sqlalchemy as sa
+from dlt.common.configuration.specs import ConnectionStringCredentials
+from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.row_event import DeleteRowsEvent, UpdateRowsEvent, WriteRowsEvent
+
+from pipeline.config import get_pipeline
+from pipeline.load_raw_tables import (
+    CHANGE_COLUMNS,
+    CHANGE_CURSOR,
+    RAW_TABLES,
+    create_source_engine,
+    get_extract_option,
+    get_source_state,
+    keeps_column,
+    load_tables,
+    uses_change_cursor
+)
+
+# Replication client id, must differ from the server and every other replica
+DEFAULT_BINLOG_SERVER_ID = 4242
+# Rows per table collected from the binlog before they are yielded as one batch
+DEFAULT_BINLOG_BATCH_SIZE = 10000
+
+# Deleted rows carry this flag and are removed by the merge (dlt hard_delete)
+CDC_DELETED = "_cdc_deleted"
+# Binlog position of the change, the latest change of a key wins within a load
+CDC_SEQUENCE = "_cdc_sequence"
+CDC_COLUMNS = {
+    CDC_DELETED: {"data_type": "bool", "hard_delete": True},
+    CDC_SEQUENCE: {"data_type": "bigint", "dedup_sort": "desc"},
+}
+
+
+def get_binlog_position(engine):
+    """Get the current binlog file and position of the OpenMRS MySQL server"""
+    with engine.connect() as conn:
+        row = conn.execute(sa.text("SHOW MASTER STATUS")).first()
+    if row is None:
+        raise RuntimeError("Binary logging is disabled on the OpenMRS MySQL server (log_bin=OFF)")
+    return {"log_file": row[0], "log_pos": row[1]}
+
+
+def binlog_sequence(log_file, log_pos):
+    """Monotonic change sequence from a binlog position, e.g. mysql-bin.000003:1024"""
+    return int(log_file.rsplit(".", 1)[1]) * 2**32 + log_pos
+
+
+def change_row(table_name, event, row, sequence):
+    """Raw table row for one binlog row change, flagged when it was deleted"""
+    values = row["after_values"] if isinstance(event, UpdateRowsEvent) else row["values"]
+    values = {name: value for name, value in values.items() if keeps_column(table_name, name)}
+    if isinstance(event, DeleteRowsEvent):
+        values[CDC_DELETED] = True
+    values[CDC_SEQUENCE] = sequence
+
+    # Keep row_changed_at filled like the polling loader does
+    if uses_change_cursor(table_name):
+        audit_values = [values.get(name) for name in ("date_created",) + CHANGE_COLUMNS]
+        audit_values = [value for value in audit_values if isinstance(value, datetime)]
+        values[CHANGE_CURSOR] = max(audit_values) if audit_values else None
+    return values
+
+
+def change_batch(table_name, rows):
+    """Route a batch of changes to its raw table as a merge on the table's primary key"""
+    return dlt.mark.with_hints(
+        rows,
+        dlt.mark.make_hints(
+            table_name=table_name,
+            write_disposition="merge",
+            primary_key=RAW_TABLES[table_name]["primary_key"],
+            columns=CDC_COLUMNS
+        ),
+        create_table_variant=True
+    )
+
+
+@dlt.source(name="sql_database", section="sql_database")
+def openmrs_binlog(credentials, table_names, position, server_id, batch_size):
+    """
+    Inserts, updates and deletes of the raw OpenMRS tables read from the binlog
+    starting at position. The position after the last read event is kept in the
+    source state and committed with the loaded changes.
+    """
+    @dlt.resource(name="binlog_changes")
+    def binlog_changes():
+        stream = BinLogStreamReader(
+            connection_settings={
+                "host": credentials.host,
+                "port": credentials.port or 3306,
+                "user": credentials.username,
+                "passwd": credentials.password,
+            },
+            server_id=server_id,
+            only_schemas=[credentials.database],
+            only_tables=table_names,
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent],
+            log_file=position["log_file"],
+            log_pos=position["log_pos"],
+            resume_stream=True,
+            blocking=False
+        )
+        batches = {}
+        try:
+            for event in stream:
+                sequence = binlog_sequence(stream.log_file, event.packet.log_pos)
+                rows = batches.setdefault(event.table, [])
+                rows.extend(change_row(event.table, event, row, sequence) for row in event.rows)
+                if len(rows) >= batch_size:
+                    yield change_batch(event.table, rows)
+                    batches[event.table] = []
+            # The stream also reads past events of other tables and rotations, so the
+            # position is saved once it is exhausted, even when no row changed
+            dlt.current.source_state()["binlog"] = {
+                "log_file": stream.log_file,
+                "log_pos": stream.log_pos
+            }
+            for table_name, rows in batches.items():
+                if rows:
+                    yield change_batch(table_name, rows)
+        finally:
+            stream.close()
+
+    return binlog_changes
+
+
+def load_binlog_changes():
+    """
+    Apply the binlog changes of the raw tables since the last run. The first run
+    takes a polling snapshot and then replays the changes made while it ran.
+    Returns the traces of the pipeline runs (snapshot and changes).
+    """
+    credentials = dlt.secrets.get("sources.sql_database.credentials", ConnectionStringCredentials)
+    pipeline = get_pipeline()
+
+    pipeline.sync_destination()
+    position = get_source_state(pipeline).get("binlog")
+    if position is None:
+        engine = create_source_engine(1)
+        position = get_binlog_position(engine)
+        engine.dispose()
+        print(f"No binlog position yet - taking a snapshot from {position['log_file']}:{position['log_pos']}")
+        traces = load_tables(mode="poll")
+    else:
+        traces = []
+
+    source = openmrs_binlog(
+        credentials,
+        list(RAW_TABLES),
+        position,
+        server_id=get_extract_option("binlog_server_id", DEFAULT_BINLOG_SERVER_ID),
+        batch_size=get_extract_option("binlog_batch_size", DEFAULT_BINLOG_BATCH_SIZE)
+    )
+    load_info = pipeline.run(source)
+    print(load_info)
+    traces.append(pipeline.last_trace)
+    return traces
+
+
+if __name__ == '__main__':
+    load_binlog_changes()
@@ -1,303 +1,766 @@
+import json
+import threading
+from datetime import timedelta, timezone
+from functools import wraps
+
 import dlt
-from dlt.sources.sql_database import sql_database
-
-def load_tables():
-	"""Extract raw data from SQL database and load into DuckDB using dlt"""
-	source = sql_database().with_resources(
-		"person",
-		"person_name",
-		"person_address",
-		"person_attribute",
-		"patient",
-		"patient_identifier",
-		"patient_identifier_type",
-		"encounter",
-		"encounter_type",
-		"encounter_provider",
-		"encounter_role",
-		"obs",
-		"visit",
-		"visit_type",
-		"location",
-		"provider",
-		"concept",
-		"concept_name",
-		"concept_answer",
-		"concept_class",
-		"concept_datatype",
-		"concept_set",
-		"program",
-		"program_workflow",
-		"program_workflow_state",
-		"patient_program",
-		"patient_state",
-		"orders",
-		"drug",
-		"drug_order",
-		"relationship",
-		"users",
-		"user_role",
-		"role_privilege",
-		"form",
-		"form_field",
-		"form_resource",
-		"global_property",
-		"patient_appointment",
-		"appointment_service",
-		"appointment_service_type",
-		"appointment_service_weekly_availability",
-		"appointment_speciality",
-		"patient_appointment_provider"
-	)
+import pyarrow as pa
+import sqlalchemy as sa
+from dlt.common.configuration.specs import ConnectionStringCredentials
+from dlt.sources.sql_database import sql_table
 
-    # specify different loading strategy for each resource using apply_hints
- 	# Core patient and encounter data
-	source.person.apply_hints(
-		write_disposition="merge",
-		primary_key="person_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.person_name.apply_hints(
-		write_disposition="merge",
-		primary_key="person_name_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.person_address.apply_hints(
-		write_disposition="merge",
-		primary_key="person_address_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.person_attribute.apply_hints(
-		write_disposition="merge",
-		primary_key="person_attribute_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.patient.apply_hints(
-		write_disposition="merge",
-		primary_key="patient_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.encounter.apply_hints(
-		write_disposition="merge",
-		primary_key="encounter_id",
-		incremental=dlt.sources.incremental("encounter_datetime")
-	)
-	source.obs.apply_hints(
-		write_disposition="merge",
-		primary_key="obs_id",
-		incremental=dlt.sources.incremental("obs_datetime")
-	)
-	source.visit.apply_hints(
-		write_disposition="merge",
-		primary_key="visit_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.location.apply_hints(
-		write_disposition="merge",
-		primary_key="location_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.provider.apply_hints(
-		write_disposition="merge",
-		primary_key="provider_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
+from pipeline.config import get_option, get_pipeline
+
+# Raw OpenMRS tables with the merge key and incremental cursor of each one.
+# A cursor of None means the table is re-hashed on every run and only new or
+# changed rows are merged (see get_changed_keys).
+# Chunked tables are first loaded in primary key ranges (see load_table_in_chunks).
+RAW_TABLES = {
+	# Core patient and encounter data
+	"person": {"primary_key": "person_id", "cursor": "date_created"},
+	"person_name": {"primary_key": "person_name_id", "cursor": "date_created"},
+	"person_address": {"primary_key": "person_address_id", "cursor": "date_created"},
+	"person_attribute": {"primary_key": "person_attribute_id", "cursor": "date_created"},
+	"patient": {"primary_key": "patient_id", "cursor": "date_created"},
+	"encounter": {"primary_key": "encounter_id", "cursor": "encounter_datetime", "chunked": True},
+	"obs": {"primary_key": "obs_id", "cursor": "obs_datetime", "chunked": True},
+	"visit": {"primary_key": "visit_id", "cursor": "date_created"},
+	"location": {"primary_key": "location_id", "cursor": "date_created"},
+	"provider": {"primary_key": "provider_id", "cursor": "date_created"},
 
 	# Concepts
-	source.concept.apply_hints(
-		write_disposition="merge",
-		primary_key="concept_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.concept_name.apply_hints(
-		write_disposition="merge",
-		primary_key="concept_name_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.concept_answer.apply_hints(
-		write_disposition="merge",
-		primary_key="concept_answer_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.concept_class.apply_hints(
-		write_disposition="merge",
-		primary_key="concept_class_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.concept_datatype.apply_hints(
-		write_disposition="merge",
-		primary_key="concept_datatype_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.concept_set.apply_hints(
-		write_disposition="merge",
-		primary_key="concept_set_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
+	"concept": {"primary_key": "concept_id", "cursor": "date_created"},
+	"concept_name": {"primary_key": "concept_name_id", "cursor": "date_created"},
+	"concept_answer": {"primary_key": "concept_answer_id", "cursor": "date_created"},
+	"concept_class": {"primary_key": "concept_class_id", "cursor": "date_created"},
+	"concept_datatype": {"primary_key": "concept_datatype_id", "cursor": "date_created"},
+	"concept_set": {"primary_key": "concept_set_id", "cursor": "date_created"},
 
 	# Encounter and visit types
-	source.encounter_type.apply_hints(
-		write_disposition="merge",
-		primary_key="encounter_type_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.visit_type.apply_hints(
-		write_disposition="merge",
-		primary_key="visit_type_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
+	"encounter_type": {"primary_key": "encounter_type_id", "cursor": "date_created"},
+	"visit_type": {"primary_key": "visit_type_id", "cursor": "date_created"},
 
 	# Programs and workflows
-	source.program.apply_hints(
-		write_disposition="merge",
-		primary_key="program_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.program_workflow.apply_hints(
-		write_disposition="merge",
-		primary_key="program_workflow_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.program_workflow_state.apply_hints(
-		write_disposition="merge",
-		primary_key="program_workflow_state_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.patient_program.apply_hints(
-		write_disposition="merge",
-		primary_key="patient_program_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.patient_state.apply_hints(
-		write_disposition="merge",
-		primary_key="patient_state_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
+	"program": {"primary_key": "program_id", "cursor": "date_created"},
+	"program_workflow": {"primary_key": "program_workflow_id", "cursor": "date_created"},
+	"program_workflow_state": {"primary_key": "program_workflow_state_id", "cursor": "date_created"},
+	"patient_program": {"primary_key": "patient_program_id", "cursor": "date_created"},
+	"patient_state": {"primary_key": "patient_state_id", "cursor": "date_created"},
 
 	# Patient identifiers
-	source.patient_identifier.apply_hints(
-		write_disposition="merge",
-		primary_key="patient_identifier_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.patient_identifier_type.apply_hints(
-		write_disposition="merge",
-		primary_key="patient_identifier_type_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
+	"patient_identifier": {"primary_key": "patient_identifier_id", "cursor": "date_created"},
+	"patient_identifier_type": {"primary_key": "patient_identifier_type_id", "cursor": "date_created"},
 
 	# Encounter providers and roles
-	source.encounter_provider.apply_hints(
-		write_disposition="merge",
-		primary_key="encounter_provider_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.encounter_role.apply_hints(
-		write_disposition="merge",
-		primary_key="encounter_role_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
+	"encounter_provider": {"primary_key": "encounter_provider_id", "cursor": "date_created"},
+	"encounter_role": {"primary_key": "encounter_role_id", "cursor": "date_created"},
 
 	# Orders and drugs
-	source.orders.apply_hints(
-		write_disposition="merge",
-		primary_key="order_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.drug.apply_hints(
-		write_disposition="merge",
-		primary_key="drug_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.drug_order.apply_hints(
-		write_disposition="merge",
-		primary_key="order_id"
-		# Note: drug_order is a child table of orders, no date_created column
-	)
+	"orders": {"primary_key": "order_id", "cursor": "date_created"},
+	"drug": {"primary_key": "drug_id", "cursor": "date_created"},
+	# Note: drug_order is a child table of orders, no date_created column
+	"drug_order": {"primary_key": "order_id", "cursor": None},
 
 	# Relationships
-	source.relationship.apply_hints(
-		write_disposition="merge",
-		primary_key="relationship_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
+	"relationship": {"primary_key": "relationship_id", "cursor": "date_created"},
 
 	# Users and roles
-	source.users.apply_hints(
-		write_disposition="merge",
-		primary_key="user_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.user_role.apply_hints(
-		write_disposition="merge",
-		primary_key="user_id"  # Composite key (user_id, role), no timestamp columns
-	)
-	source.role_privilege.apply_hints(
-		write_disposition="merge",
-		primary_key="role"  # Composite key (role, privilege), no timestamp columns
-	)
+	"users": {"primary_key": "user_id", "cursor": "date_created"},
+	# Composite key (user_id, role), no timestamp columns
+	"user_role": {"primary_key": ["user_id", "role"], "cursor": None},
+	# Composite key (role, privilege), no timestamp columns
+	"role_privilege": {"primary_key": ["role", "privilege"], "cursor": None},
 
 	# Forms
-	source.form.apply_hints(
-		write_disposition="merge",
-		primary_key="form_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.form_field.apply_hints(
-		write_disposition="merge",
-		primary_key="form_field_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.form_resource.apply_hints(
-		write_disposition="merge",
-		primary_key="form_resource_id"
-		# Note: date_changed can be NULL, so we don't use incremental loading
-	)
+	"form": {"primary_key": "form_id", "cursor": "date_created"},
+	"form_field": {"primary_key": "form_field_id", "cursor": "date_created"},
+	# Note: date_changed can be NULL, so we don't use incremental loading
+	"form_resource": {"primary_key": "form_resource_id", "cursor": None},
 
 	# Global properties
-	source.global_property.apply_hints(
-		write_disposition="merge",
-		primary_key="property"
-		# Note: date_changed can be NULL, so we don't use incremental loading for this table
-	)
+	# Note: date_changed can be NULL, so we don't use incremental loading for this table
+	"global_property": {"primary_key": "property", "cursor": None},
 
 	# Appointments
-	source.patient_appointment.apply_hints(
-		write_disposition="merge",
-		primary_key="patient_appointment_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.appointment_service.apply_hints(
-		write_disposition="merge",
-		primary_key="appointment_service_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.appointment_service_type.apply_hints(
-		write_disposition="merge",
-		primary_key="appointment_service_type_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.appointment_service_weekly_availability.apply_hints(
-		write_disposition="merge",
-		primary_key="service_weekly_availability_id",
-		incremental=dlt.sources.incremental("date_created")
-	)
-	source.appointment_speciality.apply_hints(
-		write_disposition="merge",
-		primary_key="speciality_id",
-		incremental=dlt.sources.incremental("date_created")
+	"patient_appointment": {"primary_key": "patient_appointment_id", "cursor": "date_created"},
+	"appointment_service": {"primary_key": "appointment_service_id", "cursor": "date_created"},
+	"appointment_service_type": {"primary_key": "appointment_service_type_id", "cursor": "date_created"},
+	"appointment_service_weekly_availability": {"primary_key": "service_weekly_availability_id", "cursor": "date_created"},
+	"appointment_speciality": {"primary_key": "speciality_id", "cursor": "date_created"},
+	"patient_appointment_provider": {"primary_key": "patient_appointment_provider_id", "cursor": "date_created"},
+}
+
+# Used when [extract] workers is not set in .dlt/config.toml (dlt's own default)
+DEFAULT_EXTRACT_WORKERS = 5
+# Seconds a parallel table waits for a connection slot before its worker is released
+SLOT_WAIT_SECONDS = 0.1
+# Primary key values per range when a chunked table is loaded for the first time
+DEFAULT_PK_CHUNK_SIZE = 1000000
+# Seconds of overlap re-read by every incremental run to catch late commits
+DEFAULT_CHANGE_CURSOR_LAG = 3600
+
+# Synthetic cursor column: latest of date_created and the audit columns below
+CHANGE_CURSOR = "row_changed_at"
+CHANGE_COLUMNS = ("date_changed", "date_voided", "date_retired")
+ARROW_BACKENDS = ("pyarrow", "connectorx")
+# Hex digits of the MD5 row hash kept per row in the row hash manifest
+ROW_HASH_LENGTH = 16
+# Row hash manifest of the last load and the hashes of the running one, in DuckDB
+ROW_HASH_TABLE = "raw_row_hashes"
+ROW_HASH_STAGING_TABLE = "raw_row_hashes_staging"
+ROW_HASH_BATCH_SIZE = 50000
+# Appending tables whose older row versions are not deleted yet, in DuckDB
+APPEND_DEDUPE_TABLE = "raw_append_dedupe"
+
+
+def get_extract_option(key, default, option_type=None):
+	"""Read an [openmrs.extract] option from .dlt/config.toml, typed like default"""
+	return get_option(f"openmrs.extract.{key}", default, option_type)
+
+
+def get_table_option(table_name, key, default=None, option_type=None):
+	"""
+	Read a per-table extraction option: [openmrs.tables.<table>] in .dlt/config.toml,
+	then the RAW_TABLES entry, then the [openmrs.extract] default
+	"""
+	if option_type is None and default is not None:
+		option_type = type(default)
+	value = get_option(f"openmrs.tables.{table_name}.{key}", option_type=option_type)
+	if value is None:
+		value = RAW_TABLES[table_name].get(key)
+	if value is None:
+		value = get_extract_option(key, default, option_type)
+	return value
+
+
+def arrow_table_adapter(table):
+	"""
+	Return MySQL DOUBLE/FLOAT columns as Python floats rather than Decimal so arrow
+	batches keep them as float64 (an unscaled Decimal cannot be cast to decimal128)
+	"""
+	for column in table.columns:
+		if isinstance(column.type, sa.Float):
+			column.type.asdecimal = False
+	return table
+
+
+def uses_change_cursor(table_name):
+	"""Whether a table is loaded incrementally on the composite change cursor"""
+	if RAW_TABLES[table_name]["cursor"] is None:
+		return False
+	return get_table_option(table_name, "change_cursor", True)
+
+
+def uses_row_hash(table_name):
+	"""Whether a table without cursor only merges the rows whose content hash changed"""
+	if RAW_TABLES[table_name]["cursor"] is not None:
+		return False
+	return get_table_option(table_name, "row_hash", True)
+
+
+def primary_key_columns(table_name):
+	"""Primary key column names of a raw table, composite keys are lists"""
+	primary_key = RAW_TABLES[table_name]["primary_key"]
+	return [primary_key] if isinstance(primary_key, str) else list(primary_key)
+
+
+def keeps_column(table_name, column_name):
+	"""
+	Column projection from the include_columns/exclude_columns table options.
+	Key, cursor and audit columns are always kept, merges and cursors rely on them.
+	"""
+	table_config = RAW_TABLES[table_name]
+	required = primary_key_columns(table_name) + [table_config["cursor"], "date_created", *CHANGE_COLUMNS]
+	if column_name in required:
+		return True
+	include_columns = get_table_option(table_name, "include_columns", option_type=list)
+	if include_columns is not None and column_name not in include_columns:
+		return False
+	return column_name not in get_table_option(table_name, "exclude_columns", [])
+
+
+def change_cursor_expression(table):
+	"""GREATEST(date_created, COALESCE(date_changed, date_created), ...) over the audit columns the table has"""
+	date_created = table.c.date_created
+	changes = [sa.func.coalesce(table.c[name], date_created) for name in CHANGE_COLUMNS if name in table.c]
+	if not changes:
+		return date_created
+	return sa.func.greatest(date_created, *changes, type_=sa.DateTime())
+
+
+def changed_since(table, start_value):
+	"""Change cursor >= start_value as an OR over the audit columns"""
+	audit_columns = [table.c.date_created] + [table.c[name] for name in CHANGE_COLUMNS if name in table.c]
+	return sa.or_(*[column >= start_value for column in audit_columns])
+
+
+def change_cursor_query(table, incremental):
+	"""
+	Select the table with the change cursor evaluated on the MySQL side. The range filter
+	is an OR over the audit columns rather than on GREATEST() so their indexes are usable.
+	"""
+	columns = [column for column in table.columns if column.name != CHANGE_CURSOR]
+	query = sa.select(*columns, change_cursor_expression(table).label(CHANGE_CURSOR))
+	if incremental is None or incremental.last_value is None:
+		return query
+	query = query.where(changed_since(table, incremental.last_value))
+	if incremental.end_value is not None:
+		query = query.where(change_cursor_expression(table) < incremental.end_value)
+	return query
+
+
+def row_hash_expression(table):
+	"""SUBSTR(MD5(CONCAT_WS(0x1F, COALESCE(CAST(col AS CHAR), '\\N'), ...)), 1, n) over all columns"""
+	values = [sa.func.coalesce(sa.cast(column, sa.String()), "\\N") for column in table.columns]
+	return sa.func.substr(sa.func.md5(sa.func.concat_ws("\x1f", *values)), 1, ROW_HASH_LENGTH)
+
+
+def changed_rows_filter(table_name, changed_keys):
+	"""Query filter selecting only the rows with the given primary key values"""
+	def filter_changed_rows(query, table):
+		key_columns = [table.c[name] for name in primary_key_columns(table_name)]
+		if len(key_columns) == 1:
+			return query.where(key_columns[0].in_([key_values[0] for key_values in changed_keys]))
+		return query.where(sa.tuple_(*key_columns).in_(changed_keys))
+	return filter_changed_rows
+
+
+def skipped_rows_filter(table_name, skip_keys):
+	"""Query filter leaving out the rows with the given primary key values"""
+	def filter_skipped_rows(query, table):
+		return query.where(table.c[RAW_TABLES[table_name]["primary_key"]].not_in(skip_keys))
+	return filter_skipped_rows
+
+
+def included_columns(engine, table_name):
+	"""
+	Names of the columns selected from a table with include_columns/exclude_columns,
+	None (every column) for tables without projection
+	"""
+	if get_table_option(table_name, "include_columns", option_type=list) is None and not get_table_option(table_name, "exclude_columns", []):
+		return None
+	columns = sa.inspect(engine).get_columns(table_name)
+	return [column["name"] for column in columns if keeps_column(table_name, column["name"])]
+
+
+def sql_table_options(engine, table_name, query_filters=(), full_load=True):
+	"""
+	sql_table arguments for a raw table: the configured backend, the column projection
+	and table/query adapters.
+	"sqlalchemy" yields Python dicts, "pyarrow" builds arrow batches from the cursor tuples
+	and "connectorx" reads arrow directly (fastest, but ignores chunk_size).
+	The row_filter table option is only applied to full loads (full_load and no cursor
+	value yet): later runs must still read rows that stop matching it, e.g. get voided.
+	"""
+	backend = get_table_option(table_name, "backend", "sqlalchemy")
+	change_cursor = uses_change_cursor(table_name)
+	row_filter = get_table_option(table_name, "row_filter", option_type=str)
+
+	def adapt_table(table):
+		if backend in ARROW_BACKENDS:
+			arrow_table_adapter(table)
+		if change_cursor:
+			# Lets dlt use the computed column as cursor; change_cursor_query selects it
+			table.append_column(sa.Column(CHANGE_CURSOR, sa.DateTime()))
+		return table
+
+	def adapt_query(query, table, incremental=None, engine=None):
+		if change_cursor:
+			query = change_cursor_query(table, incremental)
+		for query_filter in query_filters:
+			query = query_filter(query, table)
+		if row_filter and full_load and (incremental is None or incremental.last_value is None):
+			query = query.where(sa.text(row_filter))
+		return query
+
+	options = {
+		"backend": backend,
+		"included_columns": included_columns(engine, table_name),
+		"table_adapter_callback": adapt_table,
+		"query_adapter_callback": adapt_query
+	}
+	if backend == "pyarrow":
+		# MySQL DATETIME is naive, mark it UTC like the normalizer does for sqlalchemy rows
+		options["backend_kwargs"] = {"tz": "UTC"}
+	elif backend == "connectorx":
+		options["backend_kwargs"] = {"return_type": "arrow"}
+	return options
+
+
+def create_source_engine(workers):
+	"""
+	Create the OpenMRS MySQL engine with at most one connection per extract worker.
+	Tables only open theirs while they hold a slot (see limit_open_connections).
+	"""
+	credentials = dlt.secrets.get("sources.sql_database.credentials", ConnectionStringCredentials)
+	return sa.create_engine(
+		credentials.to_url(),
+		pool_size=workers,
+		max_overflow=0,
+		pool_pre_ping=True
 	)
-	source.patient_appointment_provider.apply_hints(
-		write_disposition="merge",
-		primary_key="patient_appointment_provider_id",
-		incremental=dlt.sources.incremental("date_created")
+
+
+def limit_open_connections(resource, slots, wait_seconds):
+	"""
+	Let a table resource start reading only once it acquired one of slots, released
+	when the table is read. dlt starts every resource of a source in turn and a table
+	keeps its connection until it is read, so without slots the tables waiting for a
+	connection could block the extract workers of the tables that hold one.
+	A waiting table yields nothing and is retried on its next turn.
+	"""
+	# Wrapped like DltResource.parallelize wraps the resource generator
+	gen = resource._pipe.gen
+
+	@wraps(gen)
+	def table_rows_in_slot(*args, **kwargs):
+		while not slots.acquire(timeout=wait_seconds):
+			yield None
+		try:
+			yield from gen(*args, **kwargs)
+		finally:
+			slots.release()
+
+	resource._pipe.replace_gen(table_rows_in_slot)
+	return resource
+
+
+def get_table_sizes(engine, table_names):
+	"""Get the approximate data size in bytes of each table from information_schema"""
+	sizes_query = sa.text("""
+		SELECT table_name, data_length
+		FROM information_schema.tables
+		WHERE table_schema = DATABASE()
+	""")
+	with engine.connect() as conn:
+		sizes = {row[0]: row[1] or 0 for row in conn.execute(sizes_query)}
+	return {table_name: sizes.get(table_name, 0) for table_name in table_names}
+
+
+def order_tables_by_size(engine, table_names):
+	"""Order tables largest first so obs/encounter start before the small metadata tables"""
+	try:
+		sizes = get_table_sizes(engine, table_names)
+	except sa.exc.SQLAlchemyError as e:
+		print(f"Could not read table sizes, keeping configured order: {e}")
+		return list(table_names)
+	return sorted(table_names, key=lambda table_name: sizes[table_name], reverse=True)
+
+
+def get_source_state(pipeline):
+	"""Get the persisted state of the raw tables source (incremental cursors, chunk checkpoints)"""
+	return pipeline.state.get("sources", {}).get("sql_database", {})
+
+
+@dlt.source(name="sql_database", section="sql_database")
+def openmrs_raw_tables(
+	engine,
+	table_names,
+	parallel=True,
+	initial_values=None,
+	changed_keys=None,
+	append_windows=None
+):
+	"""
+	One sql_table resource per raw OpenMRS table with its merge/incremental hints.
+	Keeps the source name and section of dlt's sql_database source so the schema
+	and incremental state of existing pipelines are reused.
+	Row hashed tables only read their changed_keys (all rows when None).
+	Tables in append_windows are appended without their already loaded rows
+	(see get_append_window) and deduplicated afterwards by dedupe_appended_rows.
+	"""
+	initial_values = initial_values or {}
+	changed_keys = changed_keys or {}
+	append_windows = append_windows or {}
+	slots = threading.BoundedSemaphore(engine.pool.size())
+	for table_name in table_names:
+		table_config = RAW_TABLES[table_name]
+		query_filters = []
+		if changed_keys.get(table_name) is not None:
+			if not changed_keys[table_name]:
+				continue
+			query_filters.append(changed_rows_filter(table_name, changed_keys[table_name]))
+		if append_windows.get(table_name, {}).get("skip_keys"):
+			query_filters.append(skipped_rows_filter(table_name, append_windows[table_name]["skip_keys"]))
+		resource = sql_table(
+			credentials=engine,
+			table=table_name,
+			**sql_table_options(
+				engine,
+				table_name,
+				query_filters=query_filters,
+				full_load=changed_keys.get(table_name) is None
+			)
+		)
+		incremental = None
+		# initial_value only applies until the resource has its own cursor state
+		if uses_change_cursor(table_name):
+			incremental = dlt.sources.incremental(
+				CHANGE_CURSOR,
+				initial_value=initial_values.get(table_name),
+				lag=get_extract_option("change_cursor_lag", DEFAULT_CHANGE_CURSOR_LAG)
+			)
+		elif table_config["cursor"]:
+			incremental = dlt.sources.incremental(
+				table_config["cursor"],
+				initial_value=initial_values.get(table_name)
+			)
+		resource.apply_hints(
+			write_disposition="append" if table_name in append_windows else "merge",
+			primary_key=table_config["primary_key"],
+			incremental=incremental
+		)
+		# One table per pooled connection at a time, the others wait for a slot: in the
+		# extract thread pool for a moment, serially not at all so the open table goes on
+		resource = limit_open_connections(resource, slots, SLOT_WAIT_SECONDS if parallel else 0)
+		if parallel:
+			# Each table is read in the extract thread pool on its own pooled connection
+			resource = resource.parallelize()
+		yield resource
+
+
+
+@dlt.source(name="sql_database", section="sql_database")
+def openmrs_pk_range(engine, table_name, lower, upper, checkpoint):
+	"""Rows of one primary key range of a chunked table plus its checkpoint"""
+	primary_key = RAW_TABLES[table_name]["primary_key"]
+
+	def pk_range_query(query, table):
+		return query.where(table.c[primary_key].between(lower, upper))
+
+	table_rows = sql_table(
+		credentials=engine,
+		table=table_name,
+		**sql_table_options(engine, table_name, query_filters=[pk_range_query])
 	)
+	table_rows.apply_hints(write_disposition="merge", primary_key=primary_key)
+
+	@dlt.resource(name=f"{table_name}_pk_checkpoint")
+	def pk_checkpoint():
+		# Source state is committed with the load package, so the checkpoint
+		# only advances once the rows of this range are loaded
+		dlt.current.source_state().setdefault("pk_backfill", {})[table_name] = checkpoint
+		yield from ()
+
+	return table_rows, pk_checkpoint
+
+
+def get_pk_bounds(engine, table_name):
+	"""Get the primary key range and cursor high-water mark a chunked load has to cover"""
+	table_config = RAW_TABLES[table_name]
+	table = sa.Table(table_name, sa.MetaData(), autoload_with=engine)
+	primary_key = table.c[table_config["primary_key"]]
+	if uses_change_cursor(table_name):
+		cursor = change_cursor_expression(table)
+	else:
+		cursor = table.c[table_config["cursor"]]
+	bounds_query = sa.select(
+		sa.func.min(primary_key),
+		sa.func.max(primary_key),
+		sa.func.max(cursor)
+	)
+	with engine.connect() as conn:
+		min_id, max_id, cursor_high_water = conn.execute(bounds_query).one()
+	return {
+		"last_id": (min_id or 1) - 1,
+		"max_id": max_id or 0,
+		"cursor_high_water": cursor_high_water
+	}
+
+
+def get_initial_values(source_state, table_names):
+	"""
+	Start change cursors of already loaded tables from their previous cursor's
+	position, so switching cursors does not reload every table from scratch
+	"""
+	initial_values = {}
+	resources_state = source_state.get("resources", {})
+	for table_name in table_names:
+		if not uses_change_cursor(table_name):
+			continue
+		cursors_state = resources_state.get(table_name, {}).get("incremental", {})
+		previous_state = cursors_state.get(RAW_TABLES[table_name]["cursor"])
+		if CHANGE_CURSOR not in cursors_state and previous_state:
+			initial_values[table_name] = previous_state["last_value"]
+	return initial_values
+
+
+def create_row_hash_tables(client):
+	"""Create the row hash manifest and its staging table"""
+	if not client.has_dataset():
+		client.create_dataset()
+	for table_name in (ROW_HASH_TABLE, ROW_HASH_STAGING_TABLE):
+		client.execute_sql(f"""
+			CREATE TABLE IF NOT EXISTS {client.make_qualified_table_name(table_name)} (
+				table_name VARCHAR, row_key VARCHAR, row_hash VARCHAR
+			)
+		""")
+
+
+def get_changed_keys(pipeline, engine, table_name):
+	"""
+	Hash every row of a table on the MySQL side into the DuckDB staging table and
+	join it with the manifest of the last load. Returns the primary key values of
+	new or changed rows (None without manifest, i.e. read everything) and the row count.
+	Rows deleted in MySQL drop out of the manifest and are kept in DuckDB.
+	"""
+	table = sa.Table(table_name, sa.MetaData(), autoload_with=engine)
+	key_columns = [table.c[name] for name in primary_key_columns(table_name)]
+	hashes_query = sa.select(*key_columns, row_hash_expression(table))
+	with pipeline.sql_client() as client:
+		create_row_hash_tables(client)
+		manifest = client.make_qualified_table_name(ROW_HASH_TABLE)
+		staging = client.make_qualified_table_name(ROW_HASH_STAGING_TABLE)
+		client.execute_sql(f"DELETE FROM {staging} WHERE table_name = ?", table_name)
+		with engine.connect() as conn:
+			result = conn.execution_options(stream_results=True).execute(hashes_query)
+			for rows in result.partitions(ROW_HASH_BATCH_SIZE):
+				# The JSON of the key values is the manifest key and gives them back typed
+				row_hashes = pa.table({
+					"row_key": [json.dumps(list(row[:-1]), default=str) for row in rows],
+					"row_hash": [row[-1] for row in rows]
+				})
+				client.register("row_hash_batch", row_hashes)
+				client.execute_sql(f"INSERT INTO {staging} SELECT ?, row_key, row_hash FROM row_hash_batch", table_name)
+				client.unregister("row_hash_batch")
+
+		row_count = client.execute_sql(f"SELECT COUNT(*) FROM {staging} WHERE table_name = ?", table_name)[0][0]
+		has_manifest = client.execute_sql(f"SELECT COUNT(*) > 0 FROM {manifest} WHERE table_name = ?", table_name)[0][0]
+		if not has_manifest:
+			return None, row_count
+		changed_rows = client.execute_sql(f"""
+			SELECT staged.row_key
+			FROM {staging} staged
+			LEFT JOIN {manifest} loaded
+				ON loaded.table_name = staged.table_name AND loaded.row_key = staged.row_key
+			WHERE staged.table_name = ? AND loaded.row_hash IS DISTINCT FROM staged.row_hash
+		""", table_name)
+	return [tuple(json.loads(row[0])) for row in changed_rows], row_count
+
+
+def commit_row_hashes(pipeline, table_names):
+	"""Replace the manifest of table_names with the staged hashes once their rows are loaded"""
+	with pipeline.sql_client() as client:
+		manifest = client.make_qualified_table_name(ROW_HASH_TABLE)
+		staging = client.make_qualified_table_name(ROW_HASH_STAGING_TABLE)
+		with client.begin_transaction():
+			for table_name in table_names:
+				client.execute_sql(f"DELETE FROM {manifest} WHERE table_name = ?", table_name)
+				client.execute_sql(f"INSERT INTO {manifest} SELECT * FROM {staging} WHERE table_name = ?", table_name)
+				client.execute_sql(f"DELETE FROM {staging} WHERE table_name = ?", table_name)
+
+
+def get_append_window(pipeline, engine, table_name, source_state):
+	"""
+	Plan an append instead of a merge for the next incremental run of an insert-mostly
+	table. Reads the key and cursor of the rows in the incremental window (including the
+	lag) from MySQL and looks them up in DuckDB: rows loaded with the same cursor value
+	are skipped, all others are appended. Returns None before the table's first load.
+	"""
+	table_config = RAW_TABLES[table_name]
+	cursor_name = CHANGE_CURSOR if uses_change_cursor(table_name) else table_config["cursor"]
+	cursor_state = source_state.get("resources", {}).get(table_name, {}).get("incremental", {}).get(cursor_name)
+	if not cursor_state or cursor_state.get("last_value") is None:
+		return None
+
+	table = sa.Table(table_name, sa.MetaData(), autoload_with=engine)
+	primary_key = table_config["primary_key"]
+	if cursor_name == CHANGE_CURSOR:
+		start_value = cursor_state["last_value"] - timedelta(
+			seconds=get_extract_option("change_cursor_lag", DEFAULT_CHANGE_CURSOR_LAG)
+		)
+		window_query = sa.select(table.c[primary_key], change_cursor_expression(table)).where(
+			changed_since(table, start_value)
+		)
+	else:
+		window_query = sa.select(table.c[primary_key], table.c[cursor_name]).where(
+			table.c[cursor_name] >= cursor_state["last_value"]
+		)
+	with engine.connect() as conn:
+		incoming = {row[0]: row[1] for row in conn.execute(window_query)}
+
+	with pipeline.sql_client() as client:
+		qualified_name = client.make_qualified_table_name(table_name)
+		max_id, after_load_id = client.execute_sql(
+			f"SELECT MAX({primary_key}), MAX(_dlt_load_id) FROM {qualified_name}"
+		)[0]
+		loaded = client.execute_sql(
+			f"SELECT {primary_key}, {cursor_name} FROM {qualified_name} WHERE {primary_key} IN (SELECT UNNEST(?))",
+			list(incoming)
+		) if incoming else []
+
+	skip_keys = [
+		key for key, cursor in loaded
+		if cursor is not None and incoming[key] is not None and as_utc(cursor) == as_utc(incoming[key])
+	]
+	return {"skip_keys": skip_keys, "max_id": max_id or 0, "after_load_id": after_load_id or ""}
+
+
+def as_utc(value):
+	"""
+	A cursor value in UTC: MySQL datetimes are naive UTC, DuckDB returns the
+	loaded ones in the session time zone
+	"""
+	if value.tzinfo is None:
+		return value.replace(tzinfo=timezone.utc)
+	return value.astimezone(timezone.utc)
+
+
+def create_append_dedupe_table(client):
+	"""Create the table of the dedupe markers of appending tables"""
+	if not client.has_dataset():
+		client.create_dataset()
+	client.execute_sql(f"""
+		CREATE TABLE IF NOT EXISTS {client.make_qualified_table_name(APPEND_DEDUPE_TABLE)} (
+			table_name VARCHAR PRIMARY KEY, max_id BIGINT, after_load_id VARCHAR
+		)
+	""")
+
+
+def save_append_markers(pipeline, append_windows):
+	"""
+	Record the dedupe marker of each appending table before its rows are loaded,
+	so a run that stops between the append and the dedupe is repaired by the next one
+	"""
+	with pipeline.sql_client() as client:
+		create_append_dedupe_table(client)
+		for table_name, window in append_windows.items():
+			client.execute_sql(
+				f"INSERT OR REPLACE INTO {client.make_qualified_table_name(APPEND_DEDUPE_TABLE)} VALUES (?, ?, ?)",
+				table_name, window["max_id"], window["after_load_id"]
+			)
+
+
+def get_append_markers(pipeline):
+	"""Dedupe markers of the appends that were not deduplicated yet, per table"""
+	with pipeline.sql_client() as client:
+		create_append_dedupe_table(client)
+		rows = client.execute_sql(
+			f"SELECT table_name, max_id, after_load_id FROM {client.make_qualified_table_name(APPEND_DEDUPE_TABLE)}"
+		)
+	return {table_name: {"max_id": max_id, "after_load_id": after_load_id} for table_name, max_id, after_load_id in rows}
+
+
+def dedupe_appended_rows(pipeline, table_name, marker):
+	"""
+	Delete the older versions of rows appended after marker["after_load_id"] and
+	the table's marker with them.
+	Only keys up to the table's max primary key before the append can have older
+	versions, so new rows never enter the delete.
+	"""
+	primary_key = RAW_TABLES[table_name]["primary_key"]
+	with pipeline.sql_client() as client:
+		qualified_name = client.make_qualified_table_name(table_name)
+		with client.begin_transaction():
+			client.execute_sql(f"""
+				DELETE FROM {qualified_name}
+				WHERE _dlt_load_id <= ?
+				  AND {primary_key} IN (
+					SELECT {primary_key} FROM {qualified_name}
+					WHERE _dlt_load_id > ? AND {primary_key} <= ?
+				  )
+			""", marker["after_load_id"], marker["after_load_id"], marker["max_id"])
+			client.execute_sql(
+				f"DELETE FROM {client.make_qualified_table_name(APPEND_DEDUPE_TABLE)} WHERE table_name = ?",
+				table_name
+			)
+
+
+def load_table_in_chunks(pipeline, engine, table_name, checkpoint, chunk_size, traces):
+	"""
+	First full load of a large table as independent primary key ranges.
+	Each range is its own pipeline run and checkpoints its upper bound, so a
+	crashed load resumes after the last completed range instead of from zero.
+	The trace of every run is added to traces.
+	"""
+	if checkpoint is None:
+		checkpoint = get_pk_bounds(engine, table_name)
+	primary_key = RAW_TABLES[table_name]["primary_key"]
+
+	while checkpoint["last_id"] < checkpoint["max_id"]:
+		lower = checkpoint["last_id"] + 1
+		upper = min(lower + chunk_size - 1, checkpoint["max_id"])
+		checkpoint = {**checkpoint, "last_id": upper}
+		print(f"Loading {table_name} chunk {primary_key} {lower}-{upper} of {checkpoint['max_id']}")
+		pipeline.run(openmrs_pk_range(engine, table_name, lower, upper, checkpoint))
+		traces.append(pipeline.last_trace)
+
+	return checkpoint
+
+
+def load_tables(mode=None):
+	"""
+	Extract raw data from SQL database and load into DuckDB using dlt.
+	mode "poll" (default) queries the tables, "binlog" applies MySQL binlog changes.
+	Returns the traces of its pipeline runs: the ranges of first chunked loads, then
+	the run of all tables.
+	"""
+	if (mode or get_extract_option("mode", "poll")) == "binlog":
+		from pipeline.load_binlog import load_binlog_changes
+		return load_binlog_changes()
+
+	workers = dlt.config.get("extract.workers", int) or DEFAULT_EXTRACT_WORKERS
+	engine = create_source_engine(workers)
+
+	# Large tables are scheduled first so they overlap with the many small ones
+	table_names = order_tables_by_size(engine, RAW_TABLES.keys())
 
 	# Create a dlt pipeline object
-	pipeline = dlt.pipeline(
-		pipeline_name="openmrs_etl", # Custom name for the pipeline
-		destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-		dataset_name="openmrs_analytics" # Custom name for the dataset created in the destination
+	pipeline = get_pipeline()
+
+	# Chunked tables that were never loaded get their full load range by range.
+	# Their incremental cursor then starts from the high-water mark of that load.
+	pipeline.sync_destination()
+	source_state = get_source_state(pipeline)
+	chunk_size = get_extract_option("pk_chunk_size", DEFAULT_PK_CHUNK_SIZE)
+	initial_values = get_initial_values(source_state, table_names)
+	traces = []
+	for table_name in table_names:
+		if not RAW_TABLES[table_name].get("chunked"):
+			continue
+		if "incremental" in source_state.get("resources", {}).get(table_name, {}):
+			continue
+		checkpoint = load_table_in_chunks(
+			pipeline,
+			engine,
+			table_name,
+			source_state.get("pk_backfill", {}).get(table_name),
+			chunk_size,
+			traces
+		)
+		initial_values[table_name] = checkpoint["cursor_high_water"]
+
+	# Repair appends of a run that stopped before its dedupe
+	for table_name, marker in get_append_markers(pipeline).items():
+		dedupe_appended_rows(pipeline, table_name, marker)
+
+	# Insert-mostly tables append their new rows instead of merging every run
+	append_windows = {}
+	for table_name in table_names:
+		if not get_table_option(table_name, "append_fast_path", False):
+			continue
+		append_window = get_append_window(pipeline, engine, table_name, source_state)
+		if append_window is not None:
+			append_windows[table_name] = append_window
+			print(f"{table_name}: appending, {len(append_window['skip_keys'])} loaded rows skipped")
+	save_append_markers(pipeline, append_windows)
+
+	# Tables without cursor only transfer the rows whose content hash changed
+	changed_keys = {}
+	for table_name in table_names:
+		if not uses_row_hash(table_name):
+			continue
+		changed_keys[table_name], row_count = get_changed_keys(pipeline, engine, table_name)
+		if changed_keys[table_name] is not None:
+			print(f"{table_name}: {len(changed_keys[table_name])} of {row_count} rows changed")
+
+	source = openmrs_raw_tables(
+		engine,
+		table_names,
+		parallel=workers > 1,
+		initial_values=initial_values,
+		changed_keys=changed_keys,
+		append_windows=append_windows
 	)
 
 	# Run the pipeline
@@ -306,6 +769,16 @@ def load_tables():
 
 	# Pretty print load information
 	print(load_info)
+	traces.append(pipeline.last_trace)
+
+	for table_name, append_window in append_windows.items():
+		dedupe_appended_rows(pipeline, table_name, append_window)
+
+	# A run that fails before this point re-reads the same rows next time
+	commit_row_hashes(pipeline, changed_keys)
+
+	engine.dispose()
+	return traces
 
 if __name__ == '__main__':
 	load_tables()
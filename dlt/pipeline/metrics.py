@@ -0,0 +1,153 @@
+"""
+Run metrics - wall time, CPU time, max RSS and row counts per stage and raw table
+"""
+import json
+import resource
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+METRICS_TABLE = "pipeline_run_metrics"
+
+METRICS_COLUMNS = {
+    "run_id": "VARCHAR",
+    "run_type": "VARCHAR",
+    "stage": "VARCHAR",
+    "table_name": "VARCHAR",
+    "status": "VARCHAR",
+    "started_at": "TIMESTAMPTZ",
+    "wall_seconds": "DOUBLE",
+    "cpu_seconds": "DOUBLE",
+    "max_rss_so_far_mb": "DOUBLE",
+    "rows_read": "BIGINT",
+    "rows_written": "BIGINT",
+    "error": "VARCHAR",
+}
+
+
+def max_rss_so_far_mb():
+    """
+    Peak resident set size of this process so far (ru_maxrss is in KiB on Linux).
+    It only grows, so a stage's value may be the peak of an earlier one.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def count_rows(pipeline, table_names):
+    """Total row count of DuckDB tables in the dataset, None if one is missing"""
+    total = 0
+    try:
+        with pipeline.sql_client() as client:
+            for table_name in table_names:
+                total += client.execute_sql(
+                    f"SELECT COUNT(*) FROM {client.make_qualified_table_name(table_name)}"
+                )[0][0]
+    except Exception as e:
+        print(f"Could not count rows of {', '.join(table_names)}: {e}")
+        return None
+    return total
+
+
+class RunMetrics:
+    """
+    Metrics of one pipeline run. Every stage and raw table record is printed as a
+    JSON line when it is taken and all of them are appended to pipeline_run_metrics.
+    """
+
+    def __init__(self, run_type):
+        self.run_id = uuid.uuid4().hex
+        self.run_type = run_type
+        self.records = []
+
+    def emit(self, stage, **values):
+        """Print one metrics record as a JSON line and keep it for save()"""
+        record = {column: None for column in METRICS_COLUMNS}
+        record.update(run_id=self.run_id, run_type=self.run_type, stage=stage, **values)
+        self.records.append(record)
+        print(json.dumps(record, default=str))
+
+    @contextmanager
+    def stage(self, name, pipeline=None, reads=(), writes=(), process_totals=True):
+        """
+        Measure the wrapped stage. Rows read/written are the row counts of the reads and
+        writes tables afterwards, unless the stage sets them on the yielded dict itself.
+        CPU time and max RSS are of the whole process, stages that overlap with others
+        pass process_totals=False and only record their wall time.
+        """
+        rows = {"rows_read": None, "rows_written": None}
+        started_at = datetime.now(timezone.utc)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        status, error = "success", None
+        try:
+            yield rows
+        except Exception as e:
+            status, error = "failed", str(e)
+            raise
+        finally:
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+            if pipeline is not None and status == "success":
+                if reads and rows["rows_read"] is None:
+                    rows["rows_read"] = count_rows(pipeline, reads)
+                if writes and rows["rows_written"] is None:
+                    rows["rows_written"] = count_rows(pipeline, writes)
+            self.emit(
+                name,
+                status=status,
+                started_at=started_at,
+                wall_seconds=round(wall_seconds, 3),
+                cpu_seconds=round(cpu_seconds, 3) if process_totals else None,
+                max_rss_so_far_mb=round(max_rss_so_far_mb(), 1) if process_totals else None,
+                error=error,
+                **rows
+            )
+
+    def record_load(self, stage, traces, rows):
+        """
+        Record rows read (extracted) and written (normalized) per table of the dlt runs
+        of a load (their traces) and add their totals to the stage's rows
+        """
+        rows_read, rows_written = {}, {}
+        for trace in traces:
+            for load_metrics in trace.last_extract_info.metrics.values():
+                for extract_metrics in load_metrics:
+                    for table_name, table_metrics in extract_metrics["table_metrics"].items():
+                        rows_read[table_name] = rows_read.get(table_name, 0) + table_metrics.items_count
+            for table_name, row_count in trace.last_normalize_info.row_counts.items():
+                rows_written[table_name] = rows_written.get(table_name, 0) + row_count
+
+        for table_name in sorted(set(rows_read) | set(rows_written)):
+            if table_name.startswith("_dlt"):
+                continue
+            self.emit(
+                stage,
+                table_name=table_name,
+                status="success",
+                rows_read=rows_read.get(table_name, 0),
+                rows_written=rows_written.get(table_name, 0)
+            )
+            rows["rows_read"] = (rows["rows_read"] or 0) + rows_read.get(table_name, 0)
+            rows["rows_written"] = (rows["rows_written"] or 0) + rows_written.get(table_name, 0)
+
+    def save(self, pipeline):
+        """Append the run's records to pipeline_run_metrics in DuckDB"""
+        columns = ", ".join(f"{name} {data_type}" for name, data_type in METRICS_COLUMNS.items())
+        placeholders = ", ".join("?" for _ in METRICS_COLUMNS)
+        try:
+            with pipeline.sql_client() as client:
+                qualified_name = client.make_qualified_table_name(METRICS_TABLE)
+                client.execute_sql(f"CREATE SCHEMA IF NOT EXISTS {client.fully_qualified_dataset_name()}")
+                client.execute_sql(f"CREATE TABLE IF NOT EXISTS {qualified_name} ({columns})")
+                # Tables of older runs get the columns added since
+                for name, data_type in METRICS_COLUMNS.items():
+                    client.execute_sql(f"ALTER TABLE {qualified_name} ADD COLUMN IF NOT EXISTS {name} {data_type}")
+                for record in self.records:
+                    client.execute_sql(
+                        f"INSERT INTO {qualified_name} ({', '.join(METRICS_COLUMNS)}) VALUES ({placeholders})",
+                        *[record[name] for name in METRICS_COLUMNS]
+                    )
+        except Exception as e:
+            # Metrics must never fail the pipeline run itself
+            print(f"Could not store run metrics: {e}")
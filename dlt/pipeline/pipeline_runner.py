@@ -1,42 +1,128 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline.config import get_option, get_pipeline
 from pipeline.load_raw_tables import load_tables
+from pipeline.metrics import RunMetrics
 from pipeline.transform_flatten import (
+    create_dimension_tables,
+    incremental_dimension_tables,
     create_flattened_observations,
+    incremental_flattened_observations,
     create_flattened_appointments,
-    create_flattened_patient_program
+    incremental_flattened_appointments,
+    create_flattened_patient_program,
+    incremental_flattened_patient_program
 )
-from pipeline.transform_pivot import run_pivoting_transformation
+from pipeline.transform_flatten.dimensions import DIMENSION_SOURCE_TABLES, DIMENSIONS
+from pipeline.transform_pivot import incremental_widened_observations, run_pivoting_transformation
+
+# Flatten steps as (stage, function, reads, writes). They read disjoint fact tables
+# (and the shared dimension tables) and write separate outputs, so they run concurrently.
+FLATTEN_STEPS = [
+    ("flatten_observations", create_flattened_observations, ["obs"], ["flattened_observations"]),
+    ("flatten_appointments", create_flattened_appointments, ["patient_appointment"], ["flattened_appointments"]),
+    ("flatten_patient_programs", create_flattened_patient_program, ["patient_program"], ["flattened_patient_program"]),
+]
+INCREMENTAL_FLATTEN_STEPS = [
+    ("flatten_observations_incremental", incremental_flattened_observations, ["obs"], ["flattened_observations"]),
+    ("flatten_appointments_incremental", incremental_flattened_appointments, ["patient_appointment"], ["flattened_appointments"]),
+    ("flatten_patient_programs_incremental", incremental_flattened_patient_program, ["patient_program"], ["flattened_patient_program"]),
+]
+
+def get_transform_option(key, default, option_type=None):
+    """Read an [openmrs.transform] option from .dlt/config.toml, typed like default"""
+    return get_option(f"openmrs.transform.{key}", default, option_type)
+
+def run_flatten_steps(metrics, pipeline, steps=FLATTEN_STEPS, stage="flatten"):
+    """
+    Run the flatten steps (full or incremental) on a thread pool of [openmrs.transform] workers, each on its
+    own cursor of the shared DuckDB database, so the stage takes about as long as the
+    slowest step. threads, if set, is DuckDB's thread count shared by all of them.
+    The group is measured as one stage; steps that run concurrently only record
+    their own wall time and rows, CPU time and max RSS are those of the process.
+    """
+    threads = get_transform_option("threads", None, int)
+    if threads:
+        with pipeline.sql_client() as client:
+            client.execute_sql(f"SET threads = {int(threads)}")
+
+    workers = get_transform_option("workers", len(steps))
 
-import dlt
+    def run_step(step):
+        name, function, reads, writes = step
+        with metrics.stage(name, pipeline, reads=reads, writes=writes, process_totals=workers == 1) as rows:
+            # Incremental steps return the rows they read and wrote, full ones are counted
+            rows.update(function(pipeline) or {})
+
+    with metrics.stage(stage) as rows:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Raises the first failure once every step has finished
+            list(executor.map(run_step, steps))
+        step_names = {step[0] for step in steps}
+        for key in rows:
+            counts = [record[key] for record in metrics.records if record["stage"] in step_names]
+            rows[key] = None if None in counts else sum(counts)
 
 def run_full_pipeline():
     """Run the complete ETL pipeline: Extract → Transform"""
     print("Starting full ETL pipeline...")
-
-    # Step 1: Extract raw data
-    print("Step 1: Extracting raw data...")
-    load_tables()
+    metrics = RunMetrics("full")
 
     # Create pipeline object to pass to transform functions
-    pipeline = dlt.pipeline(
-        pipeline_name="openmrs_etl",
-        destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-        dataset_name="openmrs_analytics"
-    )
-    
-    # Step 2: Create flattened observations
-    print("Step 2: Creating flattened observations...")
-    create_flattened_observations(pipeline)
-
-    # Step 3: Create flattened appointments
-    print("Step 3: Creating flattened appointments...")
-    create_flattened_appointments(pipeline)
-
-    # Step 4: Create flattened patient programs (with workflow states)
-    print("Step 4: Creating flattened patient programs...")
-    create_flattened_patient_program(pipeline)
-
-    # Step 5: Dynamic pivoting
-    print("Step 5: Creating dynamically widened observations...")
-    run_pivoting_transformation()
-
-    print("Full ETL pipeline completed successfully!")
\ No newline at end of file
+    pipeline = get_pipeline()
+
+    try:
+        # Step 1: Extract raw data
+        print("Step 1: Extracting raw data...")
+        with metrics.stage("extract") as rows:
+            traces = load_tables()
+            metrics.record_load("extract", traces, rows)
+
+        # Step 2: Dimension tables shared by the flatten steps
+        print("Step 2: Building dimension tables...")
+        with metrics.stage("dimensions", pipeline, reads=DIMENSION_SOURCE_TABLES, writes=list(DIMENSIONS)):
+            create_dimension_tables(pipeline)
+
+        # Step 3: Flattened observations, appointments and patient programs (with workflow states)
+        print("Step 3: Creating flattened observations, appointments and patient programs concurrently...")
+        run_flatten_steps(metrics, pipeline)
+
+        # Step 4: Dynamic pivoting
+        print("Step 4: Creating dynamically widened observations...")
+        with metrics.stage("pivot", pipeline, reads=["flattened_observations"], writes=["widened_observations"]):
+            run_pivoting_transformation()
+    finally:
+        metrics.save(pipeline)
+
+    print("Full ETL pipeline completed successfully!")
+
+def run_incremental_pipeline():
+    """
+    Run the pipeline incrementally: Extract → changed dimension rows → affected flattened
+    rows → re-pivot of the touched encounters
+    """
+    print("Starting incremental ETL pipeline...")
+    metrics = RunMetrics("incremental")
+    pipeline = get_pipeline()
+
+    try:
+        print("Step 1: Extracting changed raw data...")
+        with metrics.stage("extract") as rows:
+            traces = load_tables()
+            metrics.record_load("extract", traces, rows)
+
+        print("Step 2: Updating dimension tables...")
+        with metrics.stage("dimensions_incremental", pipeline) as rows:
+            rows.update(incremental_dimension_tables(pipeline))
+
+        print("Step 3: Updating flattened observations, appointments and patient programs concurrently...")
+        run_flatten_steps(metrics, pipeline, INCREMENTAL_FLATTEN_STEPS, "flatten_incremental")
+
+        print("Step 4: Re-pivoting the touched encounters...")
+        # Counted like the full pivot only if the writer changed and it ran one
+        with metrics.stage("pivot_incremental", pipeline, writes=["widened_observations"]) as rows:
+            rows.update(incremental_widened_observations(pipeline) or {})
+    finally:
+        metrics.save(pipeline)
+
+    print("Incremental ETL pipeline completed successfully!")
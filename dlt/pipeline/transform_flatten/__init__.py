@@ -1,14 +1,18 @@
 """
 Transform flatten module - flattened analytical tables
 """
+from .dimensions import create_dimension_tables, incremental_dimension_tables
 from .observations import create_flattened_observations, incremental_flattened_observations
 from .appointments import create_flattened_appointments, incremental_flattened_appointments
-from .patient_programs import create_flattened_patient_program
+from .patient_programs import create_flattened_patient_program, incremental_flattened_patient_program
 
 __all__ = [
+    'create_dimension_tables',
+    'incremental_dimension_tables',
     'create_flattened_observations',
     'incremental_flattened_observations',
     'create_flattened_appointments',
     'incremental_flattened_appointments',
     'create_flattened_patient_program',
+    'incremental_flattened_patient_program',
 ]
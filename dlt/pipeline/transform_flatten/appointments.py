@@ -1,25 +1,27 @@
 """
 Transform appointments data - flatten and enrich with related metadata
 """
-import dlt
+from pipeline.config import get_pipeline
 
+from .dimensions import (
+    affected_rows,
+    change_cursor,
+    changed_since,
+    dim_location_changed,
+    dim_patient_changed,
+    dim_provider_changed,
+    get_change_cursor_tables,
+    lagged_watermark
+)
 
-def create_flattened_appointments(pipeline):
+
+def appointment_select(cursor_tables, condition=None):
     """
-    Create flattened appointments table with all related metadata.
+    Flattened rows of the non-voided appointments, optionally only those matching condition.
     Joins patient_appointment with service, service_type, location, provider, and patient info.
     """
-
-    # If no pipeline provided, create one
-    if pipeline is None:
-        pipeline = dlt.pipeline(
-            pipeline_name="openmrs_etl",
-            destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-            dataset_name="openmrs_analytics"
-        )
-
-    flatten_sql = """
-    CREATE OR REPLACE TABLE openmrs_analytics.flattened_appointments AS
+    condition_sql = f"AND {condition}" if condition else ""
+    return f"""
     SELECT
         -- Appointment identifiers
         pa.patient_appointment_id,
@@ -28,9 +30,9 @@ def create_flattened_appointments(pipeline):
 
         -- Patient information
         pa.patient_id,
-        CONCAT(pn.given_name, ' ', pn.family_name) as patient_name,
-        person.gender as patient_gender,
-        date_diff('year', person.birthdate, CURRENT_DATE) as patient_age,
+        CONCAT(patient.given_name, ' ', patient.family_name) as patient_name,
+        patient.gender as patient_gender,
+        date_diff('year', patient.birthdate, CURRENT_DATE) as patient_age,
 
         -- Appointment timing
         pa.start_date_time,
@@ -64,7 +66,7 @@ def create_flattened_appointments(pipeline):
 
         -- Provider information
         pa.provider_id,
-        CONCAT(provider_pn.given_name, ' ', provider_pn.family_name) as provider_name,
+        CONCAT(prov.given_name, ' ', prov.family_name) as provider_name,
 
         -- Related appointment (for rescheduled/cancelled appointments)
         pa.related_appointment_id,
@@ -77,15 +79,20 @@ def create_flattened_appointments(pipeline):
         pa.date_created,
         pa.date_changed,
         pa.voided,
-        pa.void_reason
+        pa.void_reason,
+        GREATEST(
+            {change_cursor(cursor_tables, 'patient_appointment', 'pa')},
+            patient.source_changed_at,
+            {change_cursor(cursor_tables, 'appointment_service', 'aps')},
+            {change_cursor(cursor_tables, 'appointment_service_type', 'apst')},
+            l.source_changed_at,
+            prov.source_changed_at
+        ) as source_changed_at
 
     FROM openmrs_analytics.patient_appointment pa
 
     -- Join patient information
-    LEFT JOIN openmrs_analytics.person person ON pa.patient_id = person.person_id
-    LEFT JOIN openmrs_analytics.person_name pn ON pa.patient_id = pn.person_id
-        AND pn.preferred = 1
-        AND pn.voided = 0
+    LEFT JOIN openmrs_analytics.dim_patient patient ON pa.patient_id = patient.person_id
 
     -- Join service information
     LEFT JOIN openmrs_analytics.appointment_service aps ON pa.appointment_service_id = aps.appointment_service_id
@@ -96,166 +103,112 @@ def create_flattened_appointments(pipeline):
         AND apst.voided = 0
 
     -- Join location
-    LEFT JOIN openmrs_analytics.location l ON pa.location_id = l.location_id
+    LEFT JOIN openmrs_analytics.dim_location l ON pa.location_id = l.location_id
         AND l.retired = 0
 
     -- Join provider information
-    LEFT JOIN openmrs_analytics.provider prov ON pa.provider_id = prov.provider_id
+    LEFT JOIN openmrs_analytics.dim_provider prov ON pa.provider_id = prov.provider_id
         AND prov.retired = 0
-    LEFT JOIN openmrs_analytics.person_name provider_pn ON prov.person_id = provider_pn.person_id
-        AND provider_pn.preferred = 1
-        AND provider_pn.voided = 0
 
     WHERE pa.voided = 0
-    ORDER BY pa.start_date_time DESC
+    {condition_sql}
     """
 
+
+def create_flattened_appointments(pipeline):
+    """Create flattened appointments table with all related metadata"""
+
+    # If no pipeline provided, create one
+    if pipeline is None:
+        pipeline = get_pipeline()
+
     with pipeline.sql_client() as client:
-        client.execute(flatten_sql)
+        client.execute(f"""
+        CREATE OR REPLACE TABLE openmrs_analytics.flattened_appointments AS
+        {appointment_select(get_change_cursor_tables(client))}
+        ORDER BY pa.start_date_time DESC
+        """)
     print("Flattened appointments table created successfully!")
 
 
+def affected_appointments_query(cursor_tables, start_date, end_date=None):
+    """
+    Ids of the appointments whose own row, service, service type, patient, location
+    or provider changed in the date range
+    """
+    return f"""
+        SELECT patient_appointment_id FROM openmrs_analytics.patient_appointment
+        WHERE {changed_since(cursor_tables, 'patient_appointment', start_date, end_date)}
+        OR patient_id IN ({dim_patient_changed(cursor_tables, start_date, end_date)})
+        OR location_id IN ({dim_location_changed(cursor_tables, start_date, end_date)})
+        OR provider_id IN ({dim_provider_changed(cursor_tables, start_date, end_date)})
+        OR appointment_service_id IN (
+            SELECT appointment_service_id FROM openmrs_analytics.appointment_service
+            WHERE {changed_since(cursor_tables, 'appointment_service', start_date, end_date)}
+        )
+        OR appointment_service_type_id IN (
+            SELECT appointment_service_type_id FROM openmrs_analytics.appointment_service_type
+            WHERE {changed_since(cursor_tables, 'appointment_service_type', start_date, end_date)}
+        )
+    """
+
+
 def incremental_flattened_appointments(pipeline, start_date=None, end_date=None):
     """
-    Incrementally update flattened appointments based on date_changed or date_created.
-    Uses DELETE + INSERT pattern to handle updates.
+    Incrementally update flattened appointments: the appointments affected by changes
+    since the last source_changed_at watermark (less change_cursor_lag) are recomputed
+    with DELETE + INSERT in one transaction. Returns the affected appointments (read)
+    and the rows deleted and inserted (written).
     """
     if pipeline is None:
-        pipeline = dlt.pipeline(
-            pipeline_name="openmrs_etl",
-            destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-            dataset_name="openmrs_analytics"
-        )
+        pipeline = get_pipeline()
 
     # Check if dates are provided
     if start_date is None and end_date is None:
-        # No dates provided - get latest data from destination
+        # No dates provided - continue from the latest change already flattened
         with pipeline.sql_client() as client:
+            columns = client.execute_sql("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = 'openmrs_analytics' AND table_name = 'flattened_appointments'
+            """)
+            if "source_changed_at" not in {row[0] for row in columns}:
+                print("No watermark in flattened_appointments - rebuilding it")
+                create_flattened_appointments(pipeline)
+                return
             result = client.execute_sql("""
-                SELECT MAX(date_changed) as last_date
+                SELECT MAX(source_changed_at) as last_date
                 FROM openmrs_analytics.flattened_appointments
             """)
             last_date = result[0][0] if result and result[0][0] else None
 
-        if last_date:
-            # Incremental update from last date
-            start_date = last_date
-            end_date = None
-            print(f"Auto: Incremental update since last date: {last_date}")
-
-    where_clause = ""
-    if start_date and end_date:
-        where_clause = f"WHERE (pa.date_changed BETWEEN '{start_date}' AND '{end_date}' OR pa.date_created BETWEEN '{start_date}' AND '{end_date}')"
-    elif start_date:
-        where_clause = f"WHERE (pa.date_changed >= '{start_date}' OR pa.date_created >= '{start_date}')"
-
-    # First delete existing records for the date range
-    delete_sql = f"""
-    DELETE FROM openmrs_analytics.flattened_appointments
-    WHERE patient_appointment_id IN (
-        SELECT patient_appointment_id FROM openmrs_analytics.patient_appointment
-        {where_clause.replace('pa.', '')}
-    )
-    """
-
-    # Then insert new/updated records
-    insert_sql = f"""
-    INSERT INTO openmrs_analytics.flattened_appointments
-    SELECT
-        -- Appointment identifiers
-        pa.patient_appointment_id,
-        pa.appointment_number,
-        pa.uuid as appointment_uuid,
-
-        -- Patient information
-        pa.patient_id,
-        CONCAT(pn.given_name, ' ', pn.family_name) as patient_name,
-        person.gender as patient_gender,
-        date_diff('year', person.birthdate, CURRENT_DATE) as patient_age,
-
-        -- Appointment timing
-        pa.start_date_time,
-        pa.end_date_time,
-        date_diff('minute', pa.start_date_time, pa.end_date_time) as duration_minutes,
-        pa.date_appointment_scheduled,
-
-        -- Appointment details
-        pa.status,
-        pa.appointment_kind,
-        pa.priority,
-        pa.comments,
-
-        -- Service information
-        pa.appointment_service_id,
-        aps.name as service_name,
-        aps.description as service_description,
-        aps.duration_mins as service_default_duration,
-        aps.start_time as service_start_time,
-        aps.end_time as service_end_time,
-
-        -- Service type information
-        pa.appointment_service_type_id,
-        apst.name as service_type_name,
-        apst.duration_mins as service_type_duration,
-
-        -- Location information
-        pa.location_id,
-        l.name as location_name,
-        l.description as location_description,
-
-        -- Provider information
-        pa.provider_id,
-        CONCAT(provider_pn.given_name, ' ', provider_pn.family_name) as provider_name,
-
-        -- Related appointment
-        pa.related_appointment_id,
-
-        -- Telehealth
-        pa.tele_health_video_link,
-        CASE WHEN pa.tele_health_video_link IS NOT NULL THEN 1 ELSE 0 END as is_telehealth,
-
-        -- Audit fields
-        pa.date_created,
-        pa.date_changed,
-        pa.voided,
-        pa.void_reason
-
-    FROM openmrs_analytics.patient_appointment pa
-
-    -- Join patient information
-    LEFT JOIN openmrs_analytics.person person ON pa.patient_id = person.person_id
-    LEFT JOIN openmrs_analytics.person_name pn ON pa.patient_id = pn.person_id
-        AND pn.preferred = 1
-        AND pn.voided = 0
-
-    -- Join service information
-    LEFT JOIN openmrs_analytics.appointment_service aps ON pa.appointment_service_id = aps.appointment_service_id
-        AND aps.voided = 0
-
-    -- Join service type information
-    LEFT JOIN openmrs_analytics.appointment_service_type apst ON pa.appointment_service_type_id = apst.appointment_service_type_id
-        AND apst.voided = 0
-
-    -- Join location
-    LEFT JOIN openmrs_analytics.location l ON pa.location_id = l.location_id
-        AND l.retired = 0
-
-    -- Join provider information
-    LEFT JOIN openmrs_analytics.provider prov ON pa.provider_id = prov.provider_id
-        AND prov.retired = 0
-    LEFT JOIN openmrs_analytics.person_name provider_pn ON prov.person_id = provider_pn.person_id
-        AND provider_pn.preferred = 1
-        AND provider_pn.voided = 0
-
-    {where_clause}
-    AND pa.voided = 0
-    ORDER BY pa.start_date_time DESC
-    """
+        if last_date is None:
+            create_flattened_appointments(pipeline)
+            return
+        start_date = lagged_watermark(last_date)
+        print(f"Auto: Incremental update since last change: {last_date}")
 
     with pipeline.sql_client() as client:
+        cursor_tables = get_change_cursor_tables(client)
+        # Evaluated once for the delete and the insert
+        rows_read = affected_rows(client, f"""
+        CREATE OR REPLACE TEMP TABLE affected_appointments AS
+        {affected_appointments_query(cursor_tables, start_date, end_date)}
+        """)
+        affected = "SELECT patient_appointment_id FROM affected_appointments"
+
         client.execute("BEGIN TRANSACTION")
-        client.execute(delete_sql)
-        client.execute(insert_sql)
+        # First delete the affected appointments, voided ones are not inserted again
+        deleted = affected_rows(client, f"""
+        DELETE FROM openmrs_analytics.flattened_appointments
+        WHERE patient_appointment_id IN ({affected})
+        """)
+        # Then insert their recomputed rows
+        inserted = affected_rows(client, f"""
+        INSERT INTO openmrs_analytics.flattened_appointments BY NAME
+        {appointment_select(cursor_tables, f"pa.patient_appointment_id IN ({affected})")}
+        """)
         client.execute("COMMIT")
+        client.execute("DROP TABLE affected_appointments")
 
-    print(f"Incremental update completed for flattened_appointments: {start_date} to {end_date}")
+    print(f"Incremental update completed for flattened_appointments: {start_date} to {end_date} ({deleted} rows deleted, {inserted} inserted)")
+    return {"rows_read": rows_read, "rows_written": deleted + inserted}
@@ -0,0 +1,313 @@
+"""
+Dimension tables - compact, deduplicated lookups shared by all flatten steps
+"""
+from datetime import timedelta
+
+from pipeline.config import get_pipeline
+from pipeline.load_raw_tables import CHANGE_CURSOR, DEFAULT_CHANGE_CURSOR_LAG, get_extract_option
+
+
+def get_change_cursor_tables(client):
+    """Raw tables that have the row_changed_at change cursor column"""
+    rows = client.execute_sql(
+        """
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = 'openmrs_analytics' AND column_name = ?
+        """,
+        CHANGE_CURSOR
+    )
+    return {row[0] for row in rows}
+
+
+def change_cursor(cursor_tables, table_name, alias=None):
+    """Change cursor of a raw table row, date_created for tables loaded without one"""
+    column = CHANGE_CURSOR if table_name in cursor_tables else "date_created"
+    return f"{alias or table_name}.{column}"
+
+
+def changed_since(cursor_tables, table_name, start_date, end_date=None, alias=None):
+    """Condition on the raw table rows changed in the date range"""
+    cursor = change_cursor(cursor_tables, table_name, alias)
+    if end_date:
+        return f"{cursor} BETWEEN '{start_date}' AND '{end_date}'"
+    return f"{cursor} >= '{start_date}'"
+
+
+def lagged_watermark(last_date):
+    """
+    Start of the next incremental window after last_date, the highest change cursor
+    already transformed. Like the extract it starts change_cursor_lag seconds earlier:
+    rows committed late are loaded with change cursors below last_date.
+    """
+    return last_date - timedelta(seconds=get_extract_option("change_cursor_lag", DEFAULT_CHANGE_CURSOR_LAG))
+
+
+def affected_rows(client, sql):
+    """Run a DELETE, INSERT or CREATE TABLE AS statement and return the rows it wrote"""
+    return client.execute(sql).fetchone()[0]
+
+
+# One preferred, non-voided name per person
+PREFERRED_NAMES = """
+    SELECT * FROM openmrs_analytics.person_name
+    WHERE preferred = true AND voided = 0
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY person_id ORDER BY person_name_id DESC) = 1
+"""
+
+
+def where_sql(condition):
+    """WHERE clause of condition, empty without one"""
+    return f"WHERE {condition}" if condition else ""
+
+
+def dim_patient_select(cursor_tables, condition=None):
+    """Person demographics with the preferred name"""
+    return f"""
+    SELECT
+        person.person_id,
+        person.gender,
+        person.birthdate,
+        person.dead,
+        person.death_date,
+        pn.given_name,
+        pn.middle_name,
+        pn.family_name,
+        GREATEST(
+            {change_cursor(cursor_tables, 'person')},
+            {change_cursor(cursor_tables, 'person_name', 'pn')}
+        ) AS source_changed_at
+    FROM openmrs_analytics.person person
+    LEFT JOIN ({PREFERRED_NAMES}) pn ON pn.person_id = person.person_id
+    {where_sql(condition)}
+    """
+
+
+def dim_patient_changed(cursor_tables, start_date, end_date=None):
+    """Persons whose row or names changed"""
+    return f"""
+        SELECT person_id FROM openmrs_analytics.person
+        WHERE {changed_since(cursor_tables, 'person', start_date, end_date)}
+        UNION
+        SELECT person_id FROM openmrs_analytics.person_name
+        WHERE {changed_since(cursor_tables, 'person_name', start_date, end_date)}
+    """
+
+
+def dim_concept_en_select(cursor_tables, condition=None):
+    """One preferred English name per concept"""
+    condition_sql = f"AND {condition}" if condition else ""
+    return f"""
+    SELECT
+        concept_id,
+        name,
+        uuid,
+        {change_cursor(cursor_tables, 'concept_name')} AS source_changed_at
+    FROM openmrs_analytics.concept_name
+    WHERE locale_preferred = true
+    AND locale = 'en'
+    {condition_sql}
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY concept_id ORDER BY concept_name_id DESC) = 1
+    """
+
+
+def dim_concept_en_changed(cursor_tables, start_date, end_date=None):
+    """Concepts with any changed name, a name that stopped being preferred included"""
+    return f"""
+        SELECT concept_id FROM openmrs_analytics.concept_name
+        WHERE {changed_since(cursor_tables, 'concept_name', start_date, end_date)}
+    """
+
+
+def dim_location_select(cursor_tables, condition=None):
+    """Locations with their address, retired ones included"""
+    return f"""
+    SELECT
+        location_id,
+        name,
+        description,
+        address1,
+        address2,
+        city_village,
+        state_province,
+        postal_code,
+        country,
+        retired,
+        uuid,
+        {change_cursor(cursor_tables, 'location')} AS source_changed_at
+    FROM openmrs_analytics.location
+    {where_sql(condition)}
+    """
+
+
+def dim_location_changed(cursor_tables, start_date, end_date=None):
+    """Changed locations"""
+    return f"""
+        SELECT location_id FROM openmrs_analytics.location
+        WHERE {changed_since(cursor_tables, 'location', start_date, end_date)}
+    """
+
+
+def dim_provider_select(cursor_tables, condition=None):
+    """Providers with the preferred name of their person"""
+    return f"""
+    SELECT
+        prov.provider_id,
+        prov.person_id,
+        prov.retired,
+        pn.given_name,
+        pn.family_name,
+        GREATEST(
+            {change_cursor(cursor_tables, 'provider', 'prov')},
+            {change_cursor(cursor_tables, 'person_name', 'pn')}
+        ) AS source_changed_at
+    FROM openmrs_analytics.provider prov
+    LEFT JOIN ({PREFERRED_NAMES}) pn ON pn.person_id = prov.person_id
+    {where_sql(condition)}
+    """
+
+
+def dim_provider_changed(cursor_tables, start_date, end_date=None):
+    """Providers whose row or person names changed"""
+    return f"""
+        SELECT provider_id FROM openmrs_analytics.provider
+        WHERE {changed_since(cursor_tables, 'provider', start_date, end_date)}
+        OR person_id IN (
+            SELECT person_id FROM openmrs_analytics.person_name
+            WHERE {changed_since(cursor_tables, 'person_name', start_date, end_date)}
+        )
+    """
+
+
+def dim_encounter_select(cursor_tables, condition=None):
+    """Encounters with their type, visit and visit type"""
+    return f"""
+    SELECT
+        encounter.encounter_id,
+        encounter.voided,
+        encounter_type.name AS encounter_type_name,
+        encounter_type.description AS encounter_type_description,
+        encounter_type.uuid AS encounter_type_uuid,
+        encounter_type.retired AS encounter_type_retired,
+        visit.visit_id,
+        visit.date_started AS visit_date_started,
+        visit.date_stopped AS visit_date_stopped,
+        visit.location_id AS visit_location_id,
+        visit_type.name AS visit_type_name,
+        visit_type.uuid AS visit_type_uuid,
+        visit_type.retired AS visit_type_retired,
+        GREATEST(
+            {change_cursor(cursor_tables, 'encounter')},
+            {change_cursor(cursor_tables, 'encounter_type')},
+            {change_cursor(cursor_tables, 'visit')},
+            {change_cursor(cursor_tables, 'visit_type')}
+        ) AS source_changed_at
+    FROM openmrs_analytics.encounter AS encounter
+    LEFT JOIN openmrs_analytics.visit AS visit
+        ON encounter.visit_id = visit.visit_id
+    LEFT JOIN openmrs_analytics.encounter_type AS encounter_type
+        ON encounter.encounter_type = encounter_type.encounter_type_id
+    LEFT JOIN openmrs_analytics.visit_type AS visit_type
+        ON visit.visit_type_id = visit_type.visit_type_id
+    {where_sql(condition)}
+    """
+
+
+def dim_encounter_changed(cursor_tables, start_date, end_date=None):
+    """Encounters whose row, type, visit or visit type changed"""
+    return f"""
+        SELECT encounter.encounter_id
+        FROM openmrs_analytics.encounter AS encounter
+        WHERE {changed_since(cursor_tables, 'encounter', start_date, end_date)}
+        OR encounter.encounter_type IN (
+            SELECT encounter_type.encounter_type_id FROM openmrs_analytics.encounter_type AS encounter_type
+            WHERE {changed_since(cursor_tables, 'encounter_type', start_date, end_date)}
+        )
+        OR encounter.visit_id IN (
+            SELECT visit.visit_id
+            FROM openmrs_analytics.visit AS visit
+            WHERE {changed_since(cursor_tables, 'visit', start_date, end_date)}
+            OR visit.visit_type_id IN (
+                SELECT visit_type.visit_type_id FROM openmrs_analytics.visit_type AS visit_type
+                WHERE {changed_since(cursor_tables, 'visit_type', start_date, end_date)}
+            )
+        )
+    """
+
+
+# Dimension table -> (key column as qualified in its select, select, changed keys)
+DIMENSIONS = {
+    "dim_patient": ("person.person_id", dim_patient_select, dim_patient_changed),
+    "dim_concept_en": ("concept_id", dim_concept_en_select, dim_concept_en_changed),
+    "dim_location": ("location_id", dim_location_select, dim_location_changed),
+    "dim_provider": ("prov.provider_id", dim_provider_select, dim_provider_changed),
+    "dim_encounter": ("encounter.encounter_id", dim_encounter_select, dim_encounter_changed),
+}
+
+# Raw tables the dimension selects read, for the run metrics
+DIMENSION_SOURCE_TABLES = [
+    "person", "person_name", "concept_name", "location", "provider",
+    "encounter", "encounter_type", "visit", "visit_type",
+]
+
+
+def create_dimension_tables(pipeline):
+    """Create every dimension table from the raw tables"""
+
+    # If no pipeline provided, create one
+    if pipeline is None:
+        pipeline = get_pipeline()
+
+    with pipeline.sql_client() as client:
+        cursor_tables = get_change_cursor_tables(client)
+        for table_name, (key, select, changed) in DIMENSIONS.items():
+            client.execute(f"""
+            CREATE OR REPLACE TABLE openmrs_analytics.{table_name} AS
+            {select(cursor_tables)}
+            """)
+    print(f"Dimension tables created successfully: {', '.join(DIMENSIONS)}")
+
+
+def incremental_dimension_tables(pipeline):
+    """
+    Update the dimension tables incrementally: the keys with source rows changed since
+    a table's highest source_changed_at (less change_cursor_lag) are recomputed with
+    DELETE + INSERT in one transaction. Missing tables are created.
+    Returns the rows deleted and inserted (written) for the run metrics.
+    """
+    if pipeline is None:
+        pipeline = get_pipeline()
+
+    with pipeline.sql_client() as client:
+        cursor_tables = get_change_cursor_tables(client)
+        existing_tables = {
+            row[0] for row in client.execute_sql(
+                "SELECT table_name FROM information_schema.tables WHERE table_schema = 'openmrs_analytics'"
+            )
+        }
+        rows_written = 0
+        for table_name, (key, select, changed) in DIMENSIONS.items():
+            last_date = None
+            if table_name in existing_tables:
+                last_date = client.execute_sql(
+                    f"SELECT MAX(source_changed_at) FROM openmrs_analytics.{table_name}"
+                )[0][0]
+            if last_date is None:
+                rows_written += affected_rows(client, f"""
+                CREATE OR REPLACE TABLE openmrs_analytics.{table_name} AS
+                {select(cursor_tables)}
+                """)
+                continue
+
+            changed_keys = changed(cursor_tables, lagged_watermark(last_date))
+            client.execute("BEGIN TRANSACTION")
+            rows_written += affected_rows(client, f"""
+            DELETE FROM openmrs_analytics.{table_name}
+            WHERE {key.split('.')[-1]} IN ({changed_keys})
+            """)
+            rows_written += affected_rows(client, f"""
+            INSERT INTO openmrs_analytics.{table_name} BY NAME
+            {select(cursor_tables, f"{key} IN ({changed_keys})")}
+            """)
+            client.execute("COMMIT")
+    print(f"Dimension tables updated incrementally: {', '.join(DIMENSIONS)} ({rows_written} rows written)")
+    return {"rows_written": rows_written}
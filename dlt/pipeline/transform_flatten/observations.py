@@ -1,21 +1,27 @@
 """
 Observations transformation - flatten observations with related metadata
 """
-import dlt
-
-
-def create_flattened_observations(pipeline):
-    """Create flattened observations table from raw data"""
-
-    # If no pipeline provided, create one
-    if pipeline is None:
-        pipeline = dlt.pipeline(
-            pipeline_name="openmrs_etl",
-            destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-            dataset_name="openmrs_analytics"
-        )
-    flatten_sql = """
-    CREATE OR REPLACE TABLE openmrs_analytics.flattened_observations AS
+from pipeline.config import get_pipeline
+from .dimensions import (
+    affected_rows,
+    change_cursor,
+    changed_since,
+    dim_concept_en_changed,
+    dim_encounter_changed,
+    dim_location_changed,
+    get_change_cursor_tables,
+    lagged_watermark
+)
+
+# Encounters whose flattened rows changed, for the incremental pivot (see
+# incremental_widened_observations); it deletes the entries it has pivoted
+CHANGES_TABLE = "flattened_observations_changes"
+
+
+def observation_select(cursor_tables, condition=None):
+    """Flattened rows of the non-voided obs of non-voided encounters, optionally only those matching condition"""
+    condition_sql = f"AND {condition}" if condition else ""
+    return f"""
     SELECT
         obs.obs_id AS obs_id,
         obs.person_id AS person_id,
@@ -45,20 +51,20 @@ def create_flattened_observations(pipeline):
         encounter.encounter_id AS encounter_id,
         encounter.voided AS encounter_voided,
 
-        encounter_type.name AS encounter_type_name,
-        encounter_type.description AS encounter_type_description,
-        encounter_type.uuid AS encounter_type_uuid,
-        encounter_type.retired AS encounter_type_retired,
+        encounter.encounter_type_name AS encounter_type_name,
+        encounter.encounter_type_description AS encounter_type_description,
+        encounter.encounter_type_uuid AS encounter_type_uuid,
+        encounter.encounter_type_retired AS encounter_type_retired,
 
-        visit.visit_id AS visit_id,
-        visit.date_started AS visit_date_started,
-        visit.date_stopped AS visit_date_stopped,
+        encounter.visit_id AS visit_id,
+        encounter.visit_date_started AS visit_date_started,
+        encounter.visit_date_stopped AS visit_date_stopped,
 
-        visit_type.name AS visit_type_name,
-        visit_type.uuid AS visit_type_uuid,
-        visit_type.retired AS visit_type_retired,
+        encounter.visit_type_name AS visit_type_name,
+        encounter.visit_type_uuid AS visit_type_uuid,
+        encounter.visit_type_retired AS visit_type_retired,
 
-        visit.location_id AS location_id,
+        encounter.visit_location_id AS location_id,
         location.name AS location_name,
         location.address1 AS location_address1,
         location.address2 AS location_address2,
@@ -67,162 +73,146 @@ def create_flattened_observations(pipeline):
         location.postal_code AS location_postal_code,
         location.country AS location_country,
         location.retired AS location_retired,
-        location.uuid AS location_uuid
+        location.uuid AS location_uuid,
+
+        GREATEST(
+            {change_cursor(cursor_tables, 'obs')},
+            encounter.source_changed_at,
+            location.source_changed_at,
+            concept_concept_name.source_changed_at,
+            value_concept_name.source_changed_at
+        ) AS source_changed_at
 
     FROM openmrs_analytics.obs AS obs
-    LEFT JOIN openmrs_analytics.concept_name AS value_concept_name
+    LEFT JOIN openmrs_analytics.dim_concept_en AS value_concept_name
         ON obs.value_coded = value_concept_name.concept_id
         AND obs.value_coded IS NOT NULL
-        AND value_concept_name.locale_preferred = true
-        AND value_concept_name.locale = 'en'
-    LEFT JOIN openmrs_analytics.encounter AS encounter
+    LEFT JOIN openmrs_analytics.dim_encounter AS encounter
         ON obs.encounter_id = encounter.encounter_id
-    LEFT JOIN openmrs_analytics.visit AS visit
-        ON encounter.visit_id = visit.visit_id
-    LEFT JOIN openmrs_analytics.encounter_type AS encounter_type
-        ON encounter.encounter_type = encounter_type.encounter_type_id
-    LEFT JOIN openmrs_analytics.visit_type AS visit_type
-        ON visit.visit_type_id = visit_type.visit_type_id
-    LEFT JOIN openmrs_analytics.location AS location
+    LEFT JOIN openmrs_analytics.dim_location AS location
         ON obs.location_id = location.location_id
-    LEFT JOIN openmrs_analytics.concept_name AS concept_concept_name
+    LEFT JOIN openmrs_analytics.dim_concept_en AS concept_concept_name
         ON obs.concept_id = concept_concept_name.concept_id
-        AND concept_concept_name.locale_preferred = true
-        AND concept_concept_name.locale = 'en'
     WHERE obs.voided = 0
       AND encounter.voided = 0
+      {condition_sql}
     """
 
+
+def record_changed_encounters(client, encounters):
+    """Add the encounters selected by the encounters query to the change log"""
+    client.execute(f"""
+    CREATE TABLE IF NOT EXISTS openmrs_analytics.{CHANGES_TABLE} (
+        encounter_id BIGINT, flattened_at TIMESTAMP WITH TIME ZONE
+    )
+    """)
+    client.execute(f"""
+    INSERT INTO openmrs_analytics.{CHANGES_TABLE}
+    SELECT DISTINCT encounter_id, now() FROM ({encounters}) encounters
+    WHERE encounter_id IS NOT NULL
+    """)
+
+
+def create_flattened_observations(pipeline):
+    """Create flattened observations table from raw data"""
+
+    # If no pipeline provided, create one
+    if pipeline is None:
+        pipeline = get_pipeline()
+
     with pipeline.sql_client() as client:
-        client.execute(flatten_sql)
+        client.execute(f"""
+        CREATE OR REPLACE TABLE openmrs_analytics.flattened_observations AS
+        {observation_select(get_change_cursor_tables(client))}
+        """)
+        # Every encounter is new to an incremental pivot, a full pivot clears the log
+        record_changed_encounters(client, "SELECT encounter_id FROM openmrs_analytics.flattened_observations")
     print("Flattened observations table created successfully!")
 
+def affected_obs_query(client, start_date, end_date=None):
+    """
+    Ids of the obs whose flattened row is stale since start_date: obs that changed
+    themselves, obs of changed encounters, visits, encounter types and visit types,
+    and obs of changed locations or concept names (of the concept or the answer).
+    Changes are found on the raw tables' change cursor (date_created where a table
+    has none), so voids, moves and corrections are picked up, not only new rows.
+    """
+    cursor_tables = get_change_cursor_tables(client)
+    changed_concepts = dim_concept_en_changed(cursor_tables, start_date, end_date)
+    return f"""
+        SELECT obs.obs_id
+        FROM openmrs_analytics.obs AS obs
+        WHERE {changed_since(cursor_tables, 'obs', start_date, end_date)}
+        OR obs.encounter_id IN ({dim_encounter_changed(cursor_tables, start_date, end_date)})
+        OR obs.location_id IN ({dim_location_changed(cursor_tables, start_date, end_date)})
+        OR obs.concept_id IN ({changed_concepts})
+        OR obs.value_coded IN ({changed_concepts})
+    """
+
 
 def incremental_flattened_observations(pipeline, start_date=None, end_date=None):
-    """Update flattened observations incrementally - DELETE + INSERT pattern"""
+    """
+    Update flattened observations incrementally - DELETE + INSERT pattern. Every obs
+    affected by a change in any joined table since start_date is recomputed. Without
+    dates the window starts change_cursor_lag before the last source_changed_at.
+    The encounters of the deleted and inserted rows go into the change log.
+    Returns the affected obs (read) and the rows deleted and inserted (written).
+    """
     if pipeline is None:
-        pipeline = dlt.pipeline(
-            pipeline_name="openmrs_etl",
-            destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-            dataset_name="openmrs_analytics"
-        )
+        pipeline = get_pipeline()
 
     # Check if dates are provided
     if start_date is None and end_date is None:
-        # No dates provided - get latest data from destination
+        # No dates provided - continue from the latest change already flattened
         with pipeline.sql_client() as client:
+            columns = client.execute_sql("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = 'openmrs_analytics' AND table_name = 'flattened_observations'
+            """)
+            if "source_changed_at" not in {row[0] for row in columns}:
+                print("No watermark in flattened_observations - rebuilding it")
+                create_flattened_observations(pipeline)
+                return
             result = client.execute_sql("""
-                SELECT MAX(date_created) as last_date
+                SELECT MAX(source_changed_at) as last_date
                 FROM openmrs_analytics.flattened_observations
             """)
             last_date = result[0][0] if result and result[0][0] else None
 
-        if last_date:
-            # Incremental update from last date
-            start_date = last_date
-            end_date = None
-            print(f"Auto: Incremental update since last date: {last_date}")
-
-    where_clause = ""
-    if start_date and end_date:
-        where_clause = f"WHERE obs.date_created BETWEEN '{start_date}' AND '{end_date}'"
-    elif start_date:
-        where_clause = f"WHERE obs.date_created >= '{start_date}'"
-
-    # First delete existing records for the date range
-    delete_sql = f"""
-    DELETE FROM openmrs_analytics.flattened_observations
-    WHERE obs_id IN (
-        SELECT obs_id FROM openmrs_analytics.obs
-        {where_clause.replace('obs.date_created', 'date_created')}
-    )
-    """
-
-    # Then insert new/updated records
-    insert_sql = f"""
-    INSERT INTO openmrs_analytics.flattened_observations
-    SELECT
-        obs.obs_id AS obs_id,
-        obs.person_id AS person_id,
-        obs.concept_id AS concept_id,
-        concept_concept_name.name AS concept_name,
-        concept_concept_name.uuid AS concept_uuid,
-        obs.obs_group_id AS obs_group_id,
-        obs.accession_number AS accession_number,
-        obs.form_namespace_and_path AS form_namespace_and_path,
-        obs.value_coded AS value_coded,
-        value_concept_name.name AS value_coded_name,
-        value_concept_name.uuid AS value_coded_uuid,
-        obs.value_coded_name_id AS value_coded_name_id,
-        obs.value_drug AS value_drug,
-        obs.value_datetime AS value_datetime,
-        obs.value_numeric AS value_numeric,
-        obs.value_modifier AS value_modifier,
-        obs.value_text AS value_text,
-        obs.value_complex AS value_complex,
-        obs.comments AS comments,
-        obs.creator AS creator,
-        obs.date_created AS date_created,
-        obs.voided AS obs_voided,
-        obs.void_reason AS obs_void_reason,
-        obs.previous_version AS previous_version,
-
-        encounter.encounter_id AS encounter_id,
-        encounter.voided AS encounter_voided,
-
-        encounter_type.name AS encounter_type_name,
-        encounter_type.description AS encounter_type_description,
-        encounter_type.uuid AS encounter_type_uuid,
-        encounter_type.retired AS encounter_type_retired,
-
-        visit.visit_id AS visit_id,
-        visit.date_started AS visit_date_started,
-        visit.date_stopped AS visit_date_stopped,
-
-        visit_type.name AS visit_type_name,
-        visit_type.uuid AS visit_type_uuid,
-        visit_type.retired AS visit_type_retired,
-
-        visit.location_id AS location_id,
-        location.name AS location_name,
-        location.address1 AS location_address1,
-        location.address2 AS location_address2,
-        location.city_village AS location_city_village,
-        location.state_province AS location_state_province,
-        location.postal_code AS location_postal_code,
-        location.country AS location_country,
-        location.retired AS location_retired,
-        location.uuid AS location_uuid
-
-    FROM openmrs_analytics.obs AS obs
-    LEFT JOIN openmrs_analytics.concept_name AS value_concept_name
-        ON obs.value_coded = value_concept_name.concept_id
-        AND obs.value_coded IS NOT NULL
-        AND value_concept_name.locale_preferred = true
-        AND value_concept_name.locale = 'en'
-    LEFT JOIN openmrs_analytics.encounter AS encounter
-        ON obs.encounter_id = encounter.encounter_id
-    LEFT JOIN openmrs_analytics.visit AS visit
-        ON encounter.visit_id = visit.visit_id
-    LEFT JOIN openmrs_analytics.encounter_type AS encounter_type
-        ON encounter.encounter_type = encounter_type.encounter_type_id
-    LEFT JOIN openmrs_analytics.visit_type AS visit_type
-        ON visit.visit_type_id = visit_type.visit_type_id
-    LEFT JOIN openmrs_analytics.location AS location
-        ON obs.location_id = location.location_id
-    LEFT JOIN openmrs_analytics.concept_name AS concept_concept_name
-        ON obs.concept_id = concept_concept_name.concept_id
-        AND concept_concept_name.locale_preferred = true
-        AND concept_concept_name.locale = 'en'
-    {where_clause}
-    AND obs.voided = 0
-    AND encounter.voided = 0
-    """
+        if last_date is None:
+            create_flattened_observations(pipeline)
+            return
+        start_date = lagged_watermark(last_date)
+        print(f"Auto: Incremental update since last change: {last_date}")
 
     with pipeline.sql_client() as client:
+        cursor_tables = get_change_cursor_tables(client)
+        # Evaluated once for the change log, the delete and the insert
+        rows_read = affected_rows(client, f"""
+        CREATE OR REPLACE TEMP TABLE affected_obs AS
+        {affected_obs_query(client, start_date, end_date)}
+        """)
+        affected = "SELECT obs_id FROM affected_obs"
+
         client.execute("BEGIN TRANSACTION")
-        client.execute(delete_sql)
-        client.execute(insert_sql)
+        # Encounters the affected obs leave and the ones they are in now
+        record_changed_encounters(client, f"""
+            SELECT encounter_id FROM openmrs_analytics.flattened_observations WHERE obs_id IN ({affected})
+            UNION
+            SELECT encounter_id FROM openmrs_analytics.obs WHERE obs_id IN ({affected})
+        """)
+        # First delete existing records of the affected obs, voided ones are not inserted again
+        deleted = affected_rows(client, f"""
+        DELETE FROM openmrs_analytics.flattened_observations
+        WHERE obs_id IN ({affected})
+        """)
+        # Then insert new/updated records
+        inserted = affected_rows(client, f"""
+        INSERT INTO openmrs_analytics.flattened_observations BY NAME
+        {observation_select(cursor_tables, f"obs.obs_id IN ({affected})")}
+        """)
         client.execute("COMMIT")
+        client.execute("DROP TABLE affected_obs")
 
-    print(f"Incremental update completed for date range: {start_date} to {end_date}")
+    print(f"Incremental update completed for date range: {start_date} to {end_date} ({deleted} rows deleted, {inserted} inserted)")
+    return {"rows_read": rows_read, "rows_written": deleted + inserted}
@@ -1,21 +1,46 @@
 """
 Patient programs transformation - comprehensive flattened patient program with workflow states
 """
-import dlt
+from pipeline.config import get_pipeline
 
+from .dimensions import (
+    affected_rows,
+    change_cursor,
+    changed_since,
+    dim_concept_en_changed,
+    dim_location_changed,
+    dim_patient_changed,
+    get_change_cursor_tables,
+    lagged_watermark
+)
 
-def create_flattened_patient_program(pipeline):
-    """Create comprehensive flattened patient program table with workflow states"""
 
-    # If no pipeline provided, create one
-    if pipeline is None:
-        pipeline = dlt.pipeline(
-            pipeline_name="openmrs_etl",
-            destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-            dataset_name="openmrs_analytics"
-        )
-    flatten_sql = """
-    CREATE OR REPLACE TABLE openmrs_analytics.flattened_patient_program AS
+def current_patient_state_select(condition=None):
+    """
+    Latest non-voided patient_state of every program in one set-based pass,
+    optionally only for the programs matching condition
+    """
+    condition_sql = f"AND {condition}" if condition else ""
+    return f"""
+    SELECT *
+    FROM openmrs_analytics.patient_state
+    WHERE voided = 0
+    {condition_sql}
+    QUALIFY ROW_NUMBER() OVER (
+        PARTITION BY patient_program_id
+        ORDER BY start_date DESC, date_created DESC, patient_state_id DESC
+    ) = 1
+    """
+
+
+def patient_program_select(cursor_tables, program_ids=None):
+    """
+    Flattened patient program rows, optionally only for the patient_program_ids
+    selected by the program_ids query
+    """
+    condition_sql = f"AND pp.patient_program_id IN ({program_ids})" if program_ids else ""
+    state_condition_sql = f"WHERE patient_program_id IN ({program_ids})" if program_ids else ""
+    return f"""
     SELECT
         -- Patient Program identifiers
         pp.patient_program_id,
@@ -23,15 +48,15 @@ def create_flattened_patient_program(pipeline):
 
         -- Patient information
         pp.patient_id,
-        CONCAT(pn.given_name, ' ', pn.family_name) as patient_name,
-        pn.given_name as patient_given_name,
-        pn.middle_name as patient_middle_name,
-        pn.family_name as patient_family_name,
-        person.gender as patient_gender,
-        person.birthdate as patient_birthdate,
-        date_diff('year', CAST(person.birthdate AS DATE), CURRENT_DATE) as patient_age,
-        person.dead as patient_dead,
-        person.death_date as patient_death_date,
+        CONCAT(patient.given_name, ' ', patient.family_name) as patient_name,
+        patient.given_name as patient_given_name,
+        patient.middle_name as patient_middle_name,
+        patient.family_name as patient_family_name,
+        patient.gender as patient_gender,
+        patient.birthdate as patient_birthdate,
+        date_diff('year', CAST(patient.birthdate AS DATE), CURRENT_DATE) as patient_age,
+        patient.dead as patient_dead,
+        patient.death_date as patient_death_date,
 
         -- Program information
         prog.program_id,
@@ -83,61 +108,197 @@ def create_flattened_patient_program(pipeline):
         pp.date_created,
         pp.date_changed,
         pp.voided,
-        pp.void_reason
+        pp.void_reason,
+
+        -- Latest change of the program, its states, person or name (incremental watermark)
+        GREATEST(
+            {change_cursor(cursor_tables, 'patient_program', 'pp')},
+            patient.source_changed_at,
+            state_changes.changed_at
+        ) as source_changed_at
 
     FROM openmrs_analytics.patient_program pp
 
     -- Join patient information
-    LEFT JOIN openmrs_analytics.person person ON pp.patient_id = person.person_id
-    LEFT JOIN openmrs_analytics.person_name pn ON pp.patient_id = pn.person_id
-        AND pn.preferred = true
-        AND pn.voided = 0
+    LEFT JOIN openmrs_analytics.dim_patient patient ON pp.patient_id = patient.person_id
 
     -- Join program information
     LEFT JOIN openmrs_analytics.program prog ON pp.program_id = prog.program_id
         AND prog.retired = 0
 
     -- Join outcome information
-    LEFT JOIN openmrs_analytics.concept_name outcome_concept_name
+    LEFT JOIN openmrs_analytics.dim_concept_en outcome_concept_name
         ON pp.outcome_concept_id = outcome_concept_name.concept_id
-        AND outcome_concept_name.locale_preferred = true
-        AND outcome_concept_name.locale = 'en'
 
     -- Join location
-    LEFT JOIN openmrs_analytics.location location ON pp.location_id = location.location_id
+    LEFT JOIN openmrs_analytics.dim_location location ON pp.location_id = location.location_id
         AND location.retired = 0
 
     -- Join current/most recent patient state (if exists)
-    LEFT JOIN LATERAL (
-        SELECT * FROM openmrs_analytics.patient_state
-        WHERE patient_program_id = pp.patient_program_id
-        AND voided = 0
-        ORDER BY start_date DESC, date_created DESC
-        LIMIT 1
-    ) ps ON true
+    LEFT JOIN openmrs_analytics.current_patient_state ps
+        ON ps.patient_program_id = pp.patient_program_id
+
+    LEFT JOIN (
+        SELECT patient_program_id, MAX({change_cursor(cursor_tables, 'patient_state')}) AS changed_at
+        FROM openmrs_analytics.patient_state patient_state
+        {state_condition_sql}
+        GROUP BY patient_program_id
+    ) state_changes ON state_changes.patient_program_id = pp.patient_program_id
 
     -- Join workflow state information
     LEFT JOIN openmrs_analytics.program_workflow_state pws
         ON ps.state = pws.program_workflow_state_id
         AND pws.retired = 0
-    LEFT JOIN openmrs_analytics.concept_name state_concept_name
+    LEFT JOIN openmrs_analytics.dim_concept_en state_concept_name
         ON pws.concept_id = state_concept_name.concept_id
-        AND state_concept_name.locale_preferred = true
-        AND state_concept_name.locale = 'en'
 
     -- Join workflow information
     LEFT JOIN openmrs_analytics.program_workflow pw
         ON pws.program_workflow_id = pw.program_workflow_id
         AND pw.retired = 0
-    LEFT JOIN openmrs_analytics.concept_name workflow_concept_name
+    LEFT JOIN openmrs_analytics.dim_concept_en workflow_concept_name
         ON pw.concept_id = workflow_concept_name.concept_id
-        AND workflow_concept_name.locale_preferred = true
-        AND workflow_concept_name.locale = 'en'
 
     WHERE pp.voided = 0
-    ORDER BY pp.date_enrolled DESC
+    {condition_sql}
+    """
+
+
+def create_flattened_patient_program(pipeline):
+    """Create comprehensive flattened patient program table with workflow states"""
+
+    # If no pipeline provided, create one
+    if pipeline is None:
+        pipeline = get_pipeline()
+    # Materialized once for the flatten and for dashboards
+    current_state_sql = f"""
+    CREATE OR REPLACE TABLE openmrs_analytics.current_patient_state AS
+    {current_patient_state_select()}
     """
 
     with pipeline.sql_client() as client:
+        flatten_sql = f"""
+        CREATE OR REPLACE TABLE openmrs_analytics.flattened_patient_program AS
+        {patient_program_select(get_change_cursor_tables(client))}
+        ORDER BY pp.date_enrolled DESC
+        """
+        client.execute(current_state_sql)
         client.execute(flatten_sql)
     print("Flattened patient program table created successfully!")
+
+
+def affected_programs_query(cursor_tables, start_date, end_date=None):
+    """
+    Ids of the patient programs whose own row, patient_state rows, person or
+    person_name rows, enrollment location, program, outcome, workflow or state
+    (names included) changed in the date range
+    """
+    changed_concepts = dim_concept_en_changed(cursor_tables, start_date, end_date)
+    return f"""
+        SELECT patient_program_id FROM openmrs_analytics.patient_program
+        WHERE {changed_since(cursor_tables, 'patient_program', start_date, end_date)}
+        OR patient_id IN ({dim_patient_changed(cursor_tables, start_date, end_date)})
+        OR location_id IN ({dim_location_changed(cursor_tables, start_date, end_date)})
+        OR outcome_concept_id IN ({changed_concepts})
+        OR program_id IN (
+            SELECT program_id FROM openmrs_analytics.program
+            WHERE {changed_since(cursor_tables, 'program', start_date, end_date)}
+        )
+        UNION
+        SELECT patient_program_id FROM openmrs_analytics.patient_state
+        WHERE {changed_since(cursor_tables, 'patient_state', start_date, end_date)}
+        OR state IN (
+            SELECT pws.program_workflow_state_id
+            FROM openmrs_analytics.program_workflow_state pws
+            LEFT JOIN openmrs_analytics.program_workflow pw
+                ON pws.program_workflow_id = pw.program_workflow_id
+            WHERE {changed_since(cursor_tables, 'program_workflow_state', start_date, end_date, 'pws')}
+            OR {changed_since(cursor_tables, 'program_workflow', start_date, end_date, 'pw')}
+            OR pws.concept_id IN ({changed_concepts})
+            OR pw.concept_id IN ({changed_concepts})
+        )
+    """
+
+
+def incremental_flattened_patient_program(pipeline, start_date=None, end_date=None):
+    """
+    Incrementally update flattened patient programs: only the programs affected by
+    changes since the last source_changed_at watermark (less change_cursor_lag) are recomputed and swapped
+    in with DELETE + INSERT in one transaction, together with their current_patient_state.
+    Returns the affected programs (read) and the flattened rows deleted and inserted (written).
+    """
+    if pipeline is None:
+        pipeline = get_pipeline()
+
+    # Check if dates are provided
+    if start_date is None and end_date is None:
+        # No dates provided - continue from the latest change already flattened
+        with pipeline.sql_client() as client:
+            columns = client.execute_sql("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = 'openmrs_analytics' AND table_name = 'flattened_patient_program'
+            """)
+            if "source_changed_at" not in {row[0] for row in columns}:
+                print("No watermark in flattened_patient_program - rebuilding it")
+                create_flattened_patient_program(pipeline)
+                return
+            result = client.execute_sql("""
+                SELECT MAX(source_changed_at) as last_date
+                FROM openmrs_analytics.flattened_patient_program
+            """)
+            last_date = result[0][0] if result and result[0][0] else None
+
+        if last_date is None:
+            create_flattened_patient_program(pipeline)
+            return
+        start_date = lagged_watermark(last_date)
+        print(f"Auto: Incremental update since last change: {last_date}")
+    with pipeline.sql_client() as client:
+        cursor_tables = get_change_cursor_tables(client)
+    # Materialized as a temp table on the client that runs the statements below
+    affected = "SELECT patient_program_id FROM affected_programs"
+
+    # The current states of the affected programs are refreshed first, the flatten joins them
+    current_state_sql = [
+        f"""
+        CREATE TABLE IF NOT EXISTS openmrs_analytics.current_patient_state AS
+        {current_patient_state_select()}
+        """,
+        f"""
+        DELETE FROM openmrs_analytics.current_patient_state
+        WHERE patient_program_id IN ({affected})
+        """,
+        f"""
+        INSERT INTO openmrs_analytics.current_patient_state BY NAME
+        {current_patient_state_select(f"patient_program_id IN ({affected})")}
+        """,
+    ]
+
+    # First delete the affected programs, voided ones are not inserted again
+    delete_sql = f"""
+    DELETE FROM openmrs_analytics.flattened_patient_program
+    WHERE patient_program_id IN ({affected})
+    """
+
+    # Then insert their recomputed rows
+    insert_sql = f"""
+    INSERT INTO openmrs_analytics.flattened_patient_program BY NAME
+    {patient_program_select(cursor_tables, affected)}
+    """
+
+    with pipeline.sql_client() as client:
+        # Evaluated once for every statement below
+        rows_read = affected_rows(client, f"""
+        CREATE OR REPLACE TEMP TABLE affected_programs AS
+        {affected_programs_query(cursor_tables, start_date, end_date)}
+        """)
+        client.execute("BEGIN TRANSACTION")
+        for sql in current_state_sql:
+            client.execute(sql)
+        deleted = affected_rows(client, delete_sql)
+        inserted = affected_rows(client, insert_sql)
+        client.execute("COMMIT")
+        client.execute("DROP TABLE affected_programs")
+
+    print(f"Incremental patient program update completed for date range: {start_date} to {end_date} ({deleted} rows deleted, {inserted} inserted)")
+    return {"rows_read": rows_read, "rows_written": deleted + inserted}
@@ -1,5 +1,49 @@
 import dlt
 import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from dlt.common.schema.utils import new_table
+
+from pipeline.config import get_option, get_pipeline
+from pipeline.transform_flatten.observations import CHANGES_TABLE
+
+WIDENED_TABLE = "widened_observations"
+WIDENED_PRIMARY_KEY = ["person_id", "encounter_id"]
+
+# Encounter information every widened row is grouped by
+BASE_COLUMNS = [
+    "person_id",
+    "encounter_id",
+    "encounter_type_name",
+    "visit_date_started",
+    "location_name"
+]
+
+# dlt data types of the DuckDB column types a pivot query produces
+DLT_DATA_TYPES = {
+    "BIGINT": "bigint",
+    "INTEGER": "bigint",
+    "HUGEINT": "bigint",
+    "DOUBLE": "double",
+    "DECIMAL": "decimal",
+    "FLOAT": "double",
+    "VARCHAR": "text",
+    "BOOLEAN": "bool",
+    "DATE": "date",
+    "TIMESTAMP": "timestamp",
+    "TIMESTAMP WITH TIME ZONE": "timestamp",
+}
+
+def dlt_data_type(data_type):
+    """dlt data type of a DuckDB column type, lists (answer list columns) are json"""
+    if data_type.endswith("[]"):
+        return "json"
+    return DLT_DATA_TYPES.get(data_type.split("(")[0], "text")
+
+def get_pivot_option(key, default, option_type=None):
+    """Read an [openmrs.pivot] option from .dlt/config.toml, typed like default"""
+    return get_option(f"openmrs.pivot.{key}", default, option_type)
 
 def create_safe_column_name(text):
     """Create SQL-safe column names by removing/replacing special characters"""
@@ -14,43 +58,570 @@ def escape_sql_string(text):
     """Escape single quotes in SQL strings by doubling them"""
     return text.replace("'", "''")
 
-def get_concept_metadata(pipeline):
-    """Get all concepts and their value types outside the resource function"""
+def repr_sql_string(text):
+    """SQL string literal of text"""
+    return f"'{escape_sql_string(text)}'"
+
+CATALOGUE_TABLE = "pivot_concept_catalogue"
+REGISTRY_TABLE = "pivot_column_registry"
+
+def get_concept_metadata(pipeline, condition=None, partition_expression=None, selected_table=None):
+    """
+    Get concepts, their value types and the answers of coded concepts in one grouped
+    pass over flattened_observations, optionally only over rows matching condition.
+    Only the concepts selected by the [openmrs.pivot] concept options are returned
+    (see concept_selection_condition for selected_table).
+    Returns (partition_name, concept_id, value_type, concept_name, answers) rows with
+    the answer concept ids, grouped by partition_expression too if given
+    (partition_name is None otherwise).
+    """
+    partition_column = "NULL" if partition_expression is None else partition_expression
+    conditions = ["concept_id IS NOT NULL", concept_selection_condition(selected_table)]
+    if partition_expression is not None:
+        conditions.append(f"{partition_expression} IS NOT NULL")
+    if condition:
+        conditions.append(f"({condition})")
+
     with pipeline.sql_client() as client:
-        concepts_query = """
-        SELECT DISTINCT 
-            concept_name,
-            CASE 
-                WHEN value_coded IS NOT NULL THEN 'coded'
-                WHEN value_numeric IS NOT NULL THEN 'numeric' 
-                WHEN value_text IS NOT NULL THEN 'text'
-                WHEN value_datetime IS NOT NULL THEN 'datetime'
-                WHEN value_drug IS NOT NULL THEN 'drug'
-                ELSE 'other'
-            END as value_type
-        FROM openmrs_analytics.flattened_observations 
-        WHERE concept_name IS NOT NULL
+        concepts_query = f"""
+        SELECT
+            partition_name,
+            concept_id,
+            value_type,
+            MAX(concept_name) AS concept_name,
+            LIST(DISTINCT value_coded ORDER BY value_coded)
+                FILTER (WHERE value_coded IS NOT NULL) AS answers
+        FROM (
+            SELECT
+                {partition_column} AS partition_name,
+                concept_id,
+                concept_name,
+                CASE
+                    WHEN value_coded IS NOT NULL THEN 'coded'
+                    WHEN value_numeric IS NOT NULL THEN 'numeric'
+                    WHEN value_text IS NOT NULL THEN 'text'
+                    WHEN value_datetime IS NOT NULL THEN 'datetime'
+                    WHEN value_drug IS NOT NULL THEN 'drug'
+                    ELSE 'other'
+                END as value_type,
+                value_coded
+            FROM openmrs_analytics.flattened_observations
+            {build_where_clause(*conditions)}
+        )
+        GROUP BY partition_name, concept_id, value_type
+        ORDER BY partition_name, concept_id, value_type
         """
-        
-        concepts_result = client.execute_sql(concepts_query)
-        concepts = [(row[0], row[1]) for row in concepts_result]
-    
-    # Get answers for coded concepts
-    coded_concept_answers = {}
-    for concept_name, value_type in concepts:
-        if value_type == 'coded':
-            with pipeline.sql_client() as client:
-                answers_query = f"""
-                SELECT DISTINCT value_coded_name
-                FROM openmrs_analytics.flattened_observations 
-                WHERE concept_name = '{escape_sql_string(concept_name)}' 
-                  AND value_coded_name IS NOT NULL
-                """
-                answers_result = client.execute_sql(answers_query)
-                answers = [row[0] for row in answers_result]
-                coded_concept_answers[concept_name] = answers
-    
-    return concepts, coded_concept_answers
+        # Answers only occur on rows typed 'coded'
+        return [(row[0], row[1], row[2], row[3], row[4] or []) for row in client.execute_sql(concepts_query)]
+
+def concept_selection_condition(selected_table=None):
+    """
+    Condition on concept_id from the [openmrs.pivot] concept options, None to pivot
+    every concept. include_concepts, include_concept_classes (concept_class names)
+    and include_concept_sets (set concept ids, nested sets included) each add
+    concepts, exclude_concepts removes them, and min_observations drops concepts
+    observed fewer times across all of flattened_observations. Counting them takes a
+    pass over the whole table, so incremental runs give a selected_table (the
+    catalogue) instead and only keep the concepts the last full pivot selected.
+    """
+    includes = []
+    include_concepts = get_pivot_option("include_concepts", [])
+    if include_concepts:
+        includes.append(concept_ids_condition(include_concepts))
+    include_classes = get_pivot_option("include_concept_classes", [])
+    if include_classes:
+        includes.append(f"""concept_id IN (
+            SELECT concept.concept_id
+            FROM openmrs_analytics.concept AS concept
+            JOIN openmrs_analytics.concept_class AS concept_class
+                ON concept.class_id = concept_class.concept_class_id
+            WHERE concept_class.name IN ({', '.join(repr_sql_string(name) for name in include_classes)})
+        )""")
+    include_sets = get_pivot_option("include_concept_sets", [])
+    if include_sets:
+        includes.append(f"""concept_id IN (
+            WITH RECURSIVE members (concept_id) AS (
+                SELECT concept_id FROM openmrs_analytics.concept_set
+                WHERE concept_set IN ({', '.join(str(set_id) for set_id in sorted(include_sets))})
+                UNION
+                SELECT concept_set.concept_id
+                FROM openmrs_analytics.concept_set AS concept_set
+                JOIN members ON concept_set.concept_set = members.concept_id
+            )
+            SELECT concept_id FROM members
+        )""")
+
+    conditions = []
+    if includes:
+        conditions.append(" OR ".join(f"({include})" for include in includes))
+    exclude_concepts = get_pivot_option("exclude_concepts", [])
+    if exclude_concepts:
+        conditions.append(f"NOT {concept_ids_condition(exclude_concepts)}")
+    min_observations = get_pivot_option("min_observations", None, int)
+    if min_observations and selected_table:
+        conditions.append(f"concept_id IN (SELECT concept_id FROM {selected_table})")
+    elif min_observations:
+        conditions.append(f"""concept_id IN (
+            SELECT concept_id FROM openmrs_analytics.flattened_observations
+            GROUP BY concept_id
+            HAVING COUNT(*) >= {int(min_observations)}
+        )""")
+    return " AND ".join(f"({condition})" for condition in conditions) or None
+
+def build_where_clause(*conditions):
+    """WHERE clause of the given conditions, empty without any"""
+    conditions = [condition for condition in conditions if condition]
+    return f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+def catalogue_table_name(partition_by=None):
+    """The concept catalogue table, one per partitioning of the wide tables"""
+    return CATALOGUE_TABLE if partition_by is None else f"{CATALOGUE_TABLE}_by_{partition_by}"
+
+def read_catalogue_entries(client, partition_by=None):
+    """
+    (partition_name, concept_id, value_type, concept_name, answers) rows of a
+    catalogue table, None if it has not been built yet (or still keyed by name)
+    """
+    table_name = catalogue_table_name(partition_by)
+    if "concept_id" not in get_table_columns(client, table_name):
+        return None
+    return client.execute_sql(f"""
+        SELECT {'NULL' if partition_by is None else 'partition_name'}, concept_id, value_type, concept_name, answers
+        FROM {client.make_qualified_table_name(table_name)}
+        ORDER BY ALL
+    """)
+
+def read_concept_catalogue(pipeline):
+    """
+    Column definitions from pivot_concept_catalogue as (concept_id, value_type,
+    concept_name, answers) rows, None if the catalogue has not been built yet
+    """
+    with pipeline.sql_client() as client:
+        entries = read_catalogue_entries(client)
+    return None if entries is None else [tuple(entry[1:]) for entry in entries]
+
+def concept_ids_condition(concept_ids):
+    """Rows of the given concepts"""
+    return f"concept_id IN ({', '.join(str(concept_id) for concept_id in sorted(concept_ids))})"
+
+def maintain_catalogue(pipeline, condition=None, partition_by=None, partition_expression=None):
+    """
+    Maintain a catalogue table from the flattened_observations rows matching
+    condition: new concepts are added and new coded answers are merged into the
+    answer lists. Without a condition (or catalogue) it is rebuilt from all rows.
+    Returns all entries by (partition_name, concept_id, value_type) and the
+    partitions the matching rows belong to or whose entries changed.
+    """
+    with pipeline.sql_client() as client:
+        catalogue = None if condition is None else read_catalogue_entries(client, partition_by)
+    rebuild = catalogue is None
+    if rebuild:
+        condition = None
+        catalogue = []
+
+    entries = {tuple(row[:3]): tuple(row) for row in catalogue}
+    changed = {}
+
+    def merge_metadata(metadata):
+        """Add metadata rows to entries, returns the concepts that were not known yet"""
+        new_concepts = set()
+        for partition_name, concept_id, value_type, concept_name, new_answers in metadata:
+            key = (partition_name, concept_id, value_type)
+            current = entries.get(key)
+            known_answers = list(current[4] or []) if current else []
+            answers = sorted(set(known_answers) | set(new_answers))
+            if current is None or answers != known_answers:
+                entries[key] = changed[key] = (partition_name, concept_id, value_type, concept_name, answers)
+            if current is None:
+                new_concepts.add(concept_id)
+        return new_concepts
+
+    # Incremental runs keep the concept selection of the last full pivot
+    selected_table = None if rebuild else f"openmrs_analytics.{catalogue_table_name(partition_by)}"
+    metadata = get_concept_metadata(pipeline, condition, partition_expression, selected_table)
+    touched_partitions = {row[0] for row in metadata}
+    new_concepts = merge_metadata(metadata)
+    if new_concepts and not rebuild:
+        # Older rows of a concept new to the catalogue (e.g. backdated obs) can have
+        # other answers, their columns are needed for the backfill of the wide tables
+        merge_metadata(get_concept_metadata(
+            pipeline, concept_ids_condition(new_concepts), partition_expression, selected_table
+        ))
+    touched_partitions.update(key[0] for key in changed)
+
+    partition_column = [] if partition_by is None else ["partition_name"]
+    with pipeline.sql_client() as client:
+        qualified_name = client.make_qualified_table_name(catalogue_table_name(partition_by))
+        with client.begin_transaction():
+            if rebuild:
+                client.execute_sql(f"""
+                    CREATE OR REPLACE TABLE {qualified_name} (
+                        {''.join(f'{name} VARCHAR, ' for name in partition_column)}
+                        concept_id BIGINT,
+                        value_type VARCHAR,
+                        concept_name VARCHAR,
+                        answers BIGINT[],
+                        updated_at TIMESTAMPTZ
+                    )
+                """)
+            for partition_name, concept_id, value_type, concept_name, answers in changed.values():
+                key = partition_column + ["concept_id", "value_type"]
+                key_values = ([partition_name] if partition_column else []) + [concept_id, value_type]
+                client.execute_sql(
+                    f"DELETE FROM {qualified_name} WHERE {' AND '.join(f'{name} = ?' for name in key)}",
+                    *key_values
+                )
+                client.execute_sql(
+                    f"INSERT INTO {qualified_name} ({', '.join(key)}, concept_name, answers, updated_at) VALUES ({', '.join('?' for _ in key)}, ?, ?, now())",
+                    *key_values,
+                    concept_name,
+                    answers
+                )
+
+    print(f"{catalogue_table_name(partition_by)}: {len(changed)} concepts added or extended, {len(entries)} in total")
+    return entries, touched_partitions
+
+def update_concept_catalogue(pipeline, condition=None):
+    """
+    Maintain pivot_concept_catalogue from the flattened_observations rows matching
+    condition (all rows if None). Returns the catalogue rows.
+    """
+    entries, _ = maintain_catalogue(pipeline, condition)
+    return [entries[key][1:] for key in sorted(entries)]
+
+# Value column and pivoted column suffix per value type, coded columns are one-hot per answer
+VALUE_COLUMNS = {
+    "coded": None,
+    "numeric": "value_numeric",
+    "text": "value_text",
+    "datetime": "value_datetime",
+    "drug": "value_drug",
+}
+COLUMN_SUFFIXES = {
+    "numeric": "value",
+    "text": "text",
+    "datetime": "datetime",
+    "drug": "drug_id",
+}
+# Suffix of the single answer list column of a coded concept (coded_columns = "list")
+ANSWER_LIST_SUFFIX = "answers"
+
+def coded_as_lists():
+    """Whether coded concepts are pivoted into one list of answer ids instead of one-hot columns"""
+    return get_pivot_option("coded_columns", "one_hot") == "list"
+
+def catalogue_columns(catalogue, answer_lists=False):
+    """
+    (concept_id, value_type, answer_concept_id) of every pivoted column of catalogue
+    entries. With answer_lists a coded concept has one column without an answer.
+    """
+    columns = []
+    for concept_id, value_type, concept_name, answers in catalogue:
+        if value_type == 'coded' and answer_lists:
+            columns.append((concept_id, value_type, None))
+        elif value_type == 'coded':
+            columns.extend((concept_id, value_type, answer_id) for answer_id in answers or [])
+        elif value_type in COLUMN_SUFFIXES:
+            columns.append((concept_id, value_type, None))
+    return columns
+
+def register_columns(client, catalogue):
+    """
+    Column names of the catalogue's columns from pivot_column_registry, keyed by
+    (concept_id, value_type, answer_concept_id). The one-hot columns are registered
+    in list mode too, the one-hot views expand to them. A new column is named once from the
+    current concept/answer names; a name that is already taken gets the concept (and
+    answer) id appended. Names are never changed afterwards, so renamed concepts and
+    names that only differ beyond the 40 character limit keep stable, unique columns.
+    """
+    qualified_name = client.make_qualified_table_name(REGISTRY_TABLE)
+    client.execute_sql(f"""
+        CREATE TABLE IF NOT EXISTS {qualified_name} (
+            column_name VARCHAR,
+            concept_id BIGINT,
+            value_type VARCHAR,
+            answer_concept_id BIGINT,
+            concept_name VARCHAR,
+            answer_name VARCHAR,
+            registered_at TIMESTAMPTZ
+        )
+    """)
+    column_names = {
+        (row[0], row[1], row[2]): row[3]
+        for row in client.execute_sql(
+            f"SELECT concept_id, value_type, answer_concept_id, column_name FROM {qualified_name}"
+        )
+    }
+    columns = catalogue_columns(catalogue)
+    if coded_as_lists():
+        columns += [column for column in catalogue_columns(catalogue, answer_lists=True) if column[1] == 'coded']
+    new_columns = [column for column in columns if column not in column_names]
+    if not new_columns:
+        return column_names
+
+    concept_names = {entry[0]: entry[2] for entry in catalogue}
+    answer_ids = sorted({column[2] for column in new_columns if column[2] is not None})
+    answer_names = {}
+    if answer_ids:
+        answer_names = dict(client.execute_sql(f"""
+            SELECT value_coded, MAX(value_coded_name)
+            FROM openmrs_analytics.flattened_observations
+            WHERE value_coded IN ({', '.join(str(answer_id) for answer_id in answer_ids)})
+            GROUP BY value_coded
+        """))
+
+    # Encounter columns and dlt columns can not be reused either
+    taken = set(column_names.values()) | set(BASE_COLUMNS) | {"date_created", "_dlt_load_id", "_dlt_id"}
+    with client.begin_transaction():
+        for concept_id, value_type, answer_id in new_columns:
+            concept_name = concept_names.get(concept_id)
+            safe_concept_name = create_safe_column_name(concept_name or "") or f"concept_{concept_id}"
+            if value_type == 'coded' and answer_id is not None:
+                answer_name = answer_names.get(answer_id)
+                safe_answer_name = create_safe_column_name(answer_name or "") or f"answer_{answer_id}"
+                column_name = f"{safe_concept_name}_{safe_answer_name}"
+                unique_name = f"{column_name}_{concept_id}_{answer_id}"
+            else:
+                answer_name = None
+                suffix = ANSWER_LIST_SUFFIX if value_type == 'coded' else COLUMN_SUFFIXES[value_type]
+                column_name = f"{safe_concept_name}_{suffix}"
+                unique_name = f"{column_name}_{concept_id}"
+            if column_name in taken:
+                column_name = unique_name
+            suffix = 2
+            while column_name in taken:
+                column_name = f"{unique_name}_{suffix}"
+                suffix += 1
+
+            client.execute_sql(
+                f"INSERT INTO {qualified_name} VALUES (?, ?, ?, ?, ?, ?, now())",
+                column_name,
+                concept_id,
+                value_type,
+                answer_id,
+                concept_name,
+                answer_name
+            )
+            column_names[(concept_id, value_type, answer_id)] = column_name
+            taken.add(column_name)
+
+    print(f"Registered {len(new_columns)} new pivot columns")
+    return column_names
+
+def pivot_column_definitions(catalogue, column_names):
+    """
+    Output columns of the pivot in catalogue order as (concept_id, value_type,
+    answer_concept_id, column_name), the answer is only set for the one-hot columns
+    of coded concepts (none in list mode). column_names comes from register_columns.
+    """
+    return [column + (column_names[column],) for column in catalogue_columns(catalogue, coded_as_lists())]
+
+# Long-format columns of the concepts that do not fit into a wide table
+OVERFLOW_COLUMNS = BASE_COLUMNS + [
+    "date_created",
+    "concept_id",
+    "concept_name",
+    "value_coded",
+    "value_coded_name",
+    "value_numeric",
+    "value_text",
+    "value_datetime",
+    "value_drug",
+]
+
+def limit_pivot_columns(client, table_name, columns, condition=None, incremental=False):
+    """
+    Keep the columns of whole concepts up to [openmrs.pivot] max_columns per wide
+    table (encounter columns included), most observed concepts first. Concepts the
+    table already has columns for are kept first, so incremental runs never stop
+    filling an existing column. Incremental runs do not count observations, new
+    concepts take the budget left in concept id order until the next full pivot
+    ranks them. The other concepts are exposed in long format by the
+    <table_name>_overflow view over flattened_observations (rows matching
+    condition), dropped when every concept fits. Returns the kept column
+    definitions.
+    """
+    overflow_view = client.make_qualified_table_name(f"{table_name}_overflow")
+    max_columns = get_pivot_option("max_columns", None, int)
+    if not max_columns:
+        client.execute_sql(f"DROP VIEW IF EXISTS {overflow_view}")
+        return columns
+
+    concept_columns = {}
+    for column in columns:
+        concept_columns.setdefault(column[0], []).append(column)
+    counts = {} if incremental else dict(client.execute_sql(f"""
+        SELECT concept_id, COUNT(*)
+        FROM openmrs_analytics.flattened_observations
+        {build_where_clause(condition)}
+        GROUP BY concept_id
+    """))
+    existing_columns = get_table_columns(client, table_name)
+
+    def priority(concept_id):
+        in_table = any(column[3] in existing_columns for column in concept_columns[concept_id])
+        return (not in_table, -counts.get(concept_id, 0), concept_id)
+
+    budget = int(max_columns) - len(BASE_COLUMNS) - 1
+    kept, overflow = set(), []
+    for concept_id in sorted(concept_columns, key=priority):
+        if len(concept_columns[concept_id]) <= budget:
+            kept.add(concept_id)
+            budget -= len(concept_columns[concept_id])
+        else:
+            overflow.append(concept_id)
+
+    if not overflow:
+        client.execute_sql(f"DROP VIEW IF EXISTS {overflow_view}")
+        return columns
+    client.execute_sql(f"""
+        CREATE OR REPLACE VIEW {overflow_view} AS
+        SELECT {', '.join(OVERFLOW_COLUMNS)}
+        FROM openmrs_analytics.flattened_observations
+        {build_where_clause(condition, concept_ids_condition(overflow))}
+    """)
+    print(f"{len(overflow)} concepts over the {max_columns} column budget of {table_name} are in {table_name}_overflow")
+    return [column for column in columns if column[0] in kept]
+
+def get_pivot_columns(pipeline, catalogue, table_name=WIDENED_TABLE, incremental=False):
+    """
+    Register the catalogue's columns and return the definitions of those within
+    the column budget of table_name
+    """
+    with pipeline.sql_client() as client:
+        column_names = register_columns(client, catalogue)
+        return limit_pivot_columns(
+            client, table_name, pivot_column_definitions(catalogue, column_names), incremental=incremental
+        )
+
+def case_pivot_query(columns, where_clause=""):
+    """Pivot with one MAX(CASE WHEN ...) per output column, evaluated against every row"""
+    pivot_columns = []
+    for concept_id, value_type, answer_id, column_name in columns:
+        if value_type == 'coded' and answer_id is None:
+            pivot_columns.append(
+                f"LIST(DISTINCT value_coded ORDER BY value_coded) FILTER (WHERE concept_id = {concept_id} AND value_coded IS NOT NULL) AS \"{column_name}\""
+            )
+        elif value_type == 'coded':
+            pivot_columns.append(
+                f"MAX(CASE WHEN concept_id = {concept_id} AND value_coded = {answer_id} THEN 1 ELSE 0 END) AS \"{column_name}\""
+            )
+        else:
+            pivot_columns.append(
+                f"MAX(CASE WHEN concept_id = {concept_id} THEN {VALUE_COLUMNS[value_type]} END) AS \"{column_name}\""
+            )
+
+    return f"""
+    SELECT
+        {', '.join(BASE_COLUMNS + ['MAX(date_created) as date_created'] + pivot_columns)}
+    FROM openmrs_analytics.flattened_observations
+    {where_clause}
+    GROUP BY
+        {', '.join(BASE_COLUMNS)}
+    """
+
+def native_pivot_query(columns, where_clause=""):
+    """
+    Pivot with DuckDB's PIVOT on integer column ids. Every flattened row is joined
+    once to the ids of its concept's columns (by concept_id, and by answer for coded
+    concepts), then one PIVOT per value type spreads the ids into columns with a
+    hash lookup instead of comparing concepts once per output column. Answer list
+    columns get their own PIVOT over the answers collected per encounter.
+    """
+    def pivot_group(value_type, answer_id):
+        return ANSWER_LIST_SUFFIX if value_type == 'coded' and answer_id is None else value_type
+
+    column_ids = ",\n            ".join(
+        f"({column_id}, {concept_id}, '{pivot_group(value_type, answer_id)}', {'NULL' if answer_id is None else answer_id})"
+        for column_id, (concept_id, value_type, answer_id, column_name) in enumerate(columns, 1)
+    )
+    group_by = ", ".join(BASE_COLUMNS)
+    key_match = " AND ".join(f"encounters.{name} IS NOT DISTINCT FROM {{alias}}.{name}" for name in BASE_COLUMNS)
+
+    groups = {column_id: pivot_group(column[1], column[2]) for column_id, column in enumerate(columns, 1)}
+    value_types = [value_type for value_type in list(VALUE_COLUMNS) + [ANSWER_LIST_SUFFIX] if value_type in groups.values()]
+    pivots = []
+    for value_type in value_types:
+        ids = ", ".join(str(column_id) for column_id, group in groups.items() if group == value_type)
+        if value_type == ANSWER_LIST_SUFFIX:
+            # Concepts observed with other value types join here too, without an answer
+            source = f"""SELECT {group_by}, column_id, LIST(DISTINCT value_coded ORDER BY value_coded) AS value
+            FROM cells
+            WHERE value_type = '{value_type}' AND value_coded IS NOT NULL
+            GROUP BY {group_by}, column_id"""
+            aggregate = "FIRST(value)"
+        else:
+            value = "1" if value_type == 'coded' else VALUE_COLUMNS[value_type]
+            source = f"SELECT {group_by}, column_id, {value} AS value FROM cells WHERE value_type = '{value_type}'"
+            aggregate = "MAX(value)"
+        pivots.append(f"""
+    {value_type}_columns AS (
+        PIVOT ({source})
+        ON column_id IN ({ids})
+        USING {aggregate}
+        GROUP BY {group_by}
+    )""")
+
+    select_columns = []
+    for column_id, (concept_id, value_type, answer_id, column_name) in enumerate(columns, 1):
+        if groups[column_id] == 'coded':
+            select_columns.append(f'COALESCE(coded_columns."{column_id}", 0) AS "{column_name}"')
+        else:
+            select_columns.append(f'{groups[column_id]}_columns."{column_id}" AS "{column_name}"')
+
+    joins = "\n    ".join(
+        f"LEFT JOIN {value_type}_columns ON {key_match.format(alias=f'{value_type}_columns')}"
+        for value_type in value_types
+    )
+    return f"""
+    WITH column_ids (column_id, concept_id, value_type, answer) AS (
+        VALUES
+            {column_ids}
+    ),
+    observations AS (
+        SELECT *
+        FROM openmrs_analytics.flattened_observations
+        {where_clause}
+    ),
+    encounters AS (
+        SELECT {group_by}, MAX(date_created) AS date_created
+        FROM observations
+        GROUP BY {group_by}
+    ),
+    cells AS (
+        SELECT
+            {', '.join(f'observations.{name}' for name in BASE_COLUMNS)},
+            column_ids.column_id,
+            column_ids.value_type,
+            observations.value_coded,
+            {', '.join(f'observations.{name}' for name in VALUE_COLUMNS.values() if name)}
+        FROM observations
+        JOIN column_ids
+            ON column_ids.concept_id = observations.concept_id
+            AND (column_ids.answer IS NULL OR column_ids.answer = observations.value_coded)
+    ),{','.join(pivots)}
+    SELECT
+        {', '.join(f'encounters.{name}' for name in BASE_COLUMNS + ['date_created'])},
+        {', '.join(select_columns)}
+    FROM encounters
+    {joins}
+    """
+
+def build_pivot_query(columns, where_clause=""):
+    """Pivot query grouping flattened_observations by encounter, optionally filtered"""
+    if columns and get_pivot_option("engine", "pivot") == "pivot":
+        return native_pivot_query(columns, where_clause)
+    return case_pivot_query(columns, where_clause)
+
+def yield_pivoted_rows(pipeline, columns, where_clause=""):
+    """Run the pivot query and yield its rows as dicts (dlt writer)"""
+    column_names = BASE_COLUMNS + ['date_created'] + [column[3] for column in columns]
+    with pipeline.sql_client() as client:
+        results = client.execute_sql(build_pivot_query(columns, where_clause))
+
+        # Yield each row with proper column names
+        for row in results:
+            yield dict(zip(column_names, row))
 
 @dlt.resource(name="widened_observations", write_disposition="replace")
 def create_widened_observations():
@@ -58,248 +629,553 @@ def create_widened_observations():
     
     pipeline = dlt.pipeline()
     
-    # Get metadata outside the yield loop
-    concepts, coded_concept_answers = get_concept_metadata(pipeline)
+    # Full pivot rebuilds the concept catalogue from all flattened rows
+    catalogue = update_concept_catalogue(pipeline)
     
-    if not concepts:
+    if not catalogue:
         print("No concepts found for pivoting")
         return
     
     # Build columns for each concept based on value type
-    pivot_columns = []
+    columns = get_pivot_columns(pipeline, catalogue)
     
-    for concept_name, value_type in concepts:
-        safe_concept_name = create_safe_column_name(concept_name)
-        escaped_concept_name = escape_sql_string(concept_name)
-        
-        if value_type == 'coded':
-            # Create one-hot columns for each answer
-            answers = coded_concept_answers.get(concept_name, [])
-            for answer_name in answers:
-                safe_answer_name = create_safe_column_name(answer_name)
-                escaped_answer_name = escape_sql_string(answer_name)
-                column_name = f"{safe_concept_name}_{safe_answer_name}"
-                
-                pivot_columns.append(
-                    f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' AND value_coded_name = '{escaped_answer_name}' THEN 1 ELSE 0 END) AS \"{column_name}\""
+    yield from yield_pivoted_rows(pipeline, columns)
+
+def get_table_columns(client, table_name):
+    """Column names and DuckDB types of a dataset table, empty if it does not exist"""
+    rows = client.execute_sql(
+        """
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = ? AND table_name = ?
+        ORDER BY ordinal_position
+        """,
+        client.dataset_name,
+        table_name
+    )
+    return {row[0]: row[1] for row in rows}
+
+def built_by_other_writer(client, table_name):
+    """
+    Whether an existing wide table was built by the other [openmrs.pivot] writer:
+    only the dlt writer adds _dlt_load_id and _dlt_id
+    """
+    columns = get_table_columns(client, table_name)
+    if not columns:
+        return False
+    return ("_dlt_load_id" in columns) != (get_pivot_option("writer", "sql") == "dlt")
+
+def record_widened_tables(pipeline, table_names, write_disposition, pivoted_until, with_columns=True):
+    """
+    Record wide tables built inside DuckDB with dlt: their columns go into the
+    pipeline schema (unless with_columns is False) and the pivot watermark into the
+    resource state, both committed by a load without rows, so the tables themselves
+    are not touched. A replaced table also replaces its schema table, which drops
+    the _dlt columns of a table the dlt writer loaded before.
+    """
+    schema = pipeline.default_schema if pipeline.default_schema_name else dlt.Schema(pipeline.pipeline_name)
+    table_states = {}
+    with pipeline.sql_client() as client:
+        for table_name in table_names:
+            columns = get_table_columns(client, table_name)
+            if with_columns:
+                table = new_table(
+                    table_name,
+                    write_disposition=write_disposition,
+                    columns=[
+                        {"name": name, "data_type": dlt_data_type(data_type), "nullable": True}
+                        for name, data_type in columns.items()
+                        if not name.startswith("_dlt")
+                    ]
                 )
-        
-        elif value_type == 'numeric':
-            pivot_columns.append(
-                f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' THEN value_numeric END) AS \"{safe_concept_name}_value\""
-            )
-        
-        elif value_type == 'text':
-            pivot_columns.append(
-                f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' THEN value_text END) AS \"{safe_concept_name}_text\""
-            )
-        
-        elif value_type == 'datetime':
-            pivot_columns.append(
-                f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' THEN value_datetime END) AS \"{safe_concept_name}_datetime\""
-            )
-        
-        elif value_type == 'drug':
-            pivot_columns.append(
-                f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' THEN value_drug END) AS \"{safe_concept_name}_drug_id\""
+                if write_disposition == "merge":
+                    for name in WIDENED_PRIMARY_KEY:
+                        table["columns"][name]["primary_key"] = True
+                table["x-normalizer"] = {"seen-data": True}
+                if write_disposition == "replace":
+                    schema.tables.pop(table_name, None)
+                schema.update_table(table)
+
+            table_states[table_name] = {
+                "built_at": datetime.now(timezone.utc).isoformat(),
+                "write_disposition": write_disposition,
+                "pivoted_until": str(pivoted_until) if pivoted_until else None,
+                "columns": len(columns),
+                "rows": client.execute_sql(f"SELECT COUNT(*) FROM {client.make_qualified_table_name(table_name)}")[0][0]
+            }
+
+    @dlt.resource(name="widened_observations_state")
+    def widened_observations_state():
+        dlt.current.resource_state().update(table_states)
+        yield from ()
+
+    return pipeline.run(widened_observations_state(), schema=schema)
+
+def get_pivoted_until(client, where_clause=""):
+    """Latest date_created among the flattened rows a pivot covers"""
+    return client.execute_sql(
+        f"SELECT MAX(date_created) FROM openmrs_analytics.flattened_observations {where_clause}"
+    )[0][0]
+
+def get_changes_until(client):
+    """Latest entry of the flattened_observations change log, None if it is empty or missing"""
+    if not get_table_columns(client, CHANGES_TABLE):
+        return None
+    return client.execute_sql(f"SELECT MAX(flattened_at) FROM openmrs_analytics.{CHANGES_TABLE}")[0][0]
+
+def changed_encounters_query(changes_until):
+    """Encounters the flatten changed up to changes_until"""
+    return f"""
+        SELECT encounter_id FROM openmrs_analytics.{CHANGES_TABLE}
+        WHERE flattened_at <= '{changes_until}'
+    """
+
+def clear_changes(pipeline, changes_until):
+    """Remove the change log entries a pivot has covered"""
+    if changes_until is None:
+        return
+    with pipeline.sql_client() as client:
+        client.execute_sql(
+            f"DELETE FROM openmrs_analytics.{CHANGES_TABLE} WHERE flattened_at <= ?", changes_until
+        )
+
+def touched_encounters_condition(condition):
+    """
+    Rows of every encounter with a flattened row matching condition, so the touched
+    encounters are re-pivoted from all their obs rather than only the new ones
+    """
+    return f"""encounter_id IN (
+        SELECT encounter_id FROM openmrs_analytics.flattened_observations WHERE {condition}
+    )"""
+
+def delete_encounters(client, table_name, touched_encounters):
+    """
+    Delete the wide rows of the encounters selected by the touched_encounters query,
+    returns the rows deleted
+    """
+    return client.execute_sql(
+        f"DELETE FROM {client.make_qualified_table_name(table_name)} WHERE encounter_id IN ({touched_encounters})"
+    )[0][0]
+
+def replace_widened_table(client, table_name, pivot_query):
+    """(Re)create a wide table from a pivot query with CREATE TABLE ... AS, returns its rows"""
+    return client.execute_sql(
+        f"CREATE OR REPLACE TABLE {client.make_qualified_table_name(table_name)} AS {pivot_query}"
+    )[0][0]
+
+def merge_widened_table(client, table_name, pivot_query, touched_encounters=None):
+    """
+    Stage the rows of a pivot query in a temp table and replace the rows of the same
+    encounters with DELETE + INSERT in one transaction. Rows of the touched_encounters
+    are deleted too, those left without obs are not in the pivot. Columns of new
+    concepts or answers are added to the table first, a missing table is created.
+    Returns the rows deleted and inserted.
+    """
+    qualified_name = client.make_qualified_table_name(table_name)
+    existing_columns = get_table_columns(client, table_name)
+    if not existing_columns:
+        return client.execute_sql(f"CREATE TABLE {qualified_name} AS {pivot_query}")[0][0]
+
+    staging_table = f"{table_name}_changes"
+    with client.begin_transaction():
+        client.execute_sql(f"CREATE OR REPLACE TEMP TABLE {staging_table} AS {pivot_query}")
+        for name, data_type, *_ in client.execute_sql(f"DESCRIBE {staging_table}"):
+            if name not in existing_columns:
+                client.execute_sql(f'ALTER TABLE {qualified_name} ADD COLUMN "{name}" {data_type}')
+        for name in ("_dlt_load_id", "_dlt_id"):
+            # Tables written by the dlt writer have NOT NULL dlt columns the SQL writer does not fill
+            if name in existing_columns:
+                client.execute_sql(f"ALTER TABLE {qualified_name} ALTER COLUMN {name} DROP NOT NULL")
+        key_match = " AND ".join(
+            f"{qualified_name}.{name} IS NOT DISTINCT FROM changes.{name}"
+            for name in WIDENED_PRIMARY_KEY
+        )
+        rows_written = delete_encounters(client, table_name, touched_encounters) if touched_encounters else 0
+        rows_written += client.execute_sql(
+            f"DELETE FROM {qualified_name} USING {staging_table} changes WHERE {key_match}"
+        )[0][0]
+        rows_written += client.execute_sql(f"INSERT INTO {qualified_name} BY NAME SELECT * FROM {staging_table}")[0][0]
+        client.execute_sql(f"DROP TABLE {staging_table}")
+    return rows_written
+
+def create_one_hot_view(client, table_name, catalogue, column_names=None):
+    """
+    In list mode, (re)create <table_name>_one_hot over a wide table: the answer list
+    of every coded concept is expanded into its registered one-hot columns with
+    list_contains, so reports written against one-hot columns keep working.
+    Otherwise the view of an earlier list mode pivot is dropped.
+    """
+    one_hot_view = client.make_qualified_table_name(f"{table_name}_one_hot")
+    if not coded_as_lists() or not catalogue:
+        client.execute_sql(f"DROP VIEW IF EXISTS {one_hot_view}")
+        return
+    if column_names is None:
+        column_names = register_columns(client, catalogue)
+    existing_columns = get_table_columns(client, table_name)
+    list_columns = []
+    one_hot_columns = []
+    for concept_id, value_type, concept_name, answers in catalogue:
+        list_column = column_names.get((concept_id, value_type, None))
+        if value_type != 'coded' or list_column not in existing_columns:
+            continue
+        list_columns.append(f'"{list_column}"')
+        one_hot_columns.extend(
+            f'COALESCE(list_contains("{list_column}", {answer_id}), false)::INTEGER AS "{column_names[(concept_id, value_type, answer_id)]}"'
+            for answer_id in answers or []
+        )
+    if not list_columns:
+        client.execute_sql(f"DROP VIEW IF EXISTS {one_hot_view}")
+        return
+    client.execute_sql(f"""
+        CREATE OR REPLACE VIEW {one_hot_view} AS
+        SELECT * EXCLUDE ({', '.join(list_columns)}), {', '.join(one_hot_columns)}
+        FROM {client.make_qualified_table_name(table_name)}
+    """)
+
+def create_widened_observations_in_database(pipeline):
+    """
+    Full pivot with CREATE TABLE ... AS inside DuckDB, so rows never pass through
+    Python or dlt's load files
+    """
+    catalogue = update_concept_catalogue(pipeline)
+
+    if not catalogue:
+        print("No concepts found for pivoting")
+        return None
+
+    pivot_query = build_pivot_query(get_pivot_columns(pipeline, catalogue))
+    with pipeline.sql_client() as client:
+        pivoted_until = get_pivoted_until(client)
+        replace_widened_table(client, WIDENED_TABLE, pivot_query)
+        create_one_hot_view(client, WIDENED_TABLE, catalogue)
+
+    return record_widened_tables(pipeline, [WIDENED_TABLE], "replace", pivoted_until)
+
+def add_new_columns(client, table_name, columns):
+    """
+    Add the catalogue columns a wide table does not have yet with ALTER TABLE ADD
+    COLUMN, one-hot columns with DEFAULT 0 like the pivot fills them and answer
+    list columns as lists of value_coded. Returns the
+    definitions of the added columns, none if the table does not exist.
+    """
+    existing_columns = get_table_columns(client, table_name)
+    if not existing_columns:
+        return []
+    flattened_types = get_table_columns(client, "flattened_observations")
+    qualified_name = client.make_qualified_table_name(table_name)
+    added = []
+    for column in columns:
+        concept_id, value_type, answer_id, column_name = column
+        if column_name in existing_columns:
+            continue
+        if value_type == 'coded' and answer_id is None:
+            column_sql = f"{flattened_types['value_coded']}[]"
+        elif value_type == 'coded':
+            column_sql = "INTEGER DEFAULT 0"
+        else:
+            column_sql = flattened_types[VALUE_COLUMNS[value_type]]
+        client.execute_sql(f'ALTER TABLE {qualified_name} ADD COLUMN "{column_name}" {column_sql}')
+        existing_columns[column_name] = column_sql
+        added.append(column)
+    if added:
+        print(f"Added {len(added)} columns to {table_name}")
+    return added
+
+def backfill_condition(added_columns):
+    """Rows of the concepts whose columns were just added, their encounters are re-pivoted"""
+    if not added_columns:
+        return None
+    return concept_ids_condition({column[0] for column in added_columns})
+
+def touched_where_clause(condition, added_columns, *conditions):
+    """
+    WHERE clause selecting the encounters to re-pivot: those with rows matching
+    condition and those with obs of newly added columns (backfill)
+    """
+    touched = [condition, backfill_condition(added_columns)]
+    touched = " OR ".join(f"({part})" for part in touched if part)
+    return build_where_clause(*conditions, touched_encounters_condition(touched) if touched else None)
+
+def merge_widened_observations_in_database(pipeline, condition, touched_encounters=None):
+    """
+    Incremental pivot inside DuckDB: encounters with rows matching condition are
+    re-pivoted and replace their rows (and those of the touched_encounters) with a
+    set-based DELETE + INSERT. Columns of
+    new concepts/answers are added first and only the encounters that have them are
+    backfilled, instead of re-pivoting all history. Returns the rows deleted and inserted.
+    """
+    catalogue = update_concept_catalogue(pipeline, condition)
+
+    if not catalogue:
+        print("No concepts found for pivoting")
+        return 0
+
+    columns = get_pivot_columns(pipeline, catalogue, incremental=True)
+    with pipeline.sql_client() as client:
+        pivoted_until = get_pivoted_until(client, touched_where_clause(condition, []))
+        added_columns = add_new_columns(client, WIDENED_TABLE, columns)
+        pivot_query = build_pivot_query(columns, touched_where_clause(condition, added_columns))
+        rows_written = merge_widened_table(client, WIDENED_TABLE, pivot_query, touched_encounters)
+        create_one_hot_view(client, WIDENED_TABLE, catalogue)
+
+    record_widened_tables(pipeline, [WIDENED_TABLE], "merge", pivoted_until)
+    return rows_written
+
+# Wide tables per encounter type or per form, each with only the concepts observed in
+# it. The form is the name in form_namespace_and_path, e.g. "Bahmni^Vitals.1/2-0" -> "Vitals"
+PARTITION_EXPRESSIONS = {
+    "encounter_type": "encounter_type_name",
+    "form": "NULLIF(split_part(split_part(form_namespace_and_path, '^', 2), '.', 1), '')",
+}
+
+PARTITION_REGISTRY_TABLE = "pivot_partition_registry"
+
+# Views created next to every wide table
+WIDENED_VIEW_SUFFIXES = ["_one_hot", "_overflow"]
+
+def register_partitions(client, partition_by, partition_names):
+    """
+    Wide table names of the partitions from pivot_partition_registry, keyed by
+    partition name, e.g. widened_observations_adult_initial. Like the pivot columns, a
+    new partition is named once; a name that is taken by another partition or the views
+    of a wide table gets a number appended, so partitions whose names only differ in
+    special characters or beyond 40 characters never share a table.
+    """
+    qualified_name = client.make_qualified_table_name(PARTITION_REGISTRY_TABLE)
+    client.execute_sql(f"""
+        CREATE TABLE IF NOT EXISTS {qualified_name} (
+            table_name VARCHAR,
+            partition_by VARCHAR,
+            partition_name VARCHAR,
+            registered_at TIMESTAMPTZ
+        )
+    """)
+    registered = client.execute_sql(f"SELECT partition_by, partition_name, table_name FROM {qualified_name}")
+    table_names = {row[1]: row[2] for row in registered if row[0] == partition_by}
+    new_partitions = [name for name in sorted(partition_names) if name not in table_names]
+    if not new_partitions:
+        return table_names
+
+    # widened_observations and its views can not be reused either
+    taken = {
+        f"{table_name}{suffix}"
+        for table_name in [WIDENED_TABLE] + [row[2] for row in registered]
+        for suffix in [""] + WIDENED_VIEW_SUFFIXES
+    }
+
+    def is_taken(table_name):
+        return any(f"{table_name}{suffix}" in taken for suffix in [""] + WIDENED_VIEW_SUFFIXES)
+
+    with client.begin_transaction():
+        for partition_name in new_partitions:
+            safe_name = create_safe_column_name(partition_name) or "partition"
+            table_name = f"{WIDENED_TABLE}_{safe_name}"
+            number = 2
+            while is_taken(table_name):
+                table_name = f"{WIDENED_TABLE}_{safe_name}_{number}"
+                number += 1
+            client.execute_sql(
+                f"INSERT INTO {qualified_name} VALUES (?, ?, ?, now())", table_name, partition_by, partition_name
             )
-    
-    # Add base encounter information
-    base_columns = [
-        "person_id",
-        "encounter_id",
-        "encounter_type_name",
-        "visit_date_started",
-        "location_name"
-    ]
-
-    # Build the final query
-    pivot_query = f"""
-    SELECT
-        {', '.join(base_columns)},
-        MAX(date_created) as date_created,
-        {', '.join(pivot_columns)}
-    FROM openmrs_analytics.flattened_observations
-    GROUP BY
-        {', '.join(base_columns)}
+            table_names[partition_name] = table_name
+            taken.update(f"{table_name}{suffix}" for suffix in [""] + WIDENED_VIEW_SUFFIXES)
+
+    print(f"Registered {len(new_partitions)} new {partition_by} partitions")
+    return table_names
+
+def pivot_partitions(pipeline, condition=None, touched_encounters=None):
     """
+    Build one wide table per partition of [openmrs.pivot] partition_by, in parallel.
+    With a condition only the encounters of the matching rows are re-pivoted and
+    merged into their partitions, otherwise every table is rebuilt. The other
+    partitions lose the rows of the touched_encounters, e.g. of an encounter whose
+    type changed. Rows without a partition are only in widened_observations.
+    Returns the rows written to the partition tables (deleted and inserted ones).
+    """
+    partition_by = get_pivot_option("partition_by", None, str)
+    if not partition_by:
+        return 0
+    partition_expression = PARTITION_EXPRESSIONS[partition_by]
 
-    # Execute query and yield results
+    entries, touched_partitions = maintain_catalogue(pipeline, condition, partition_by, partition_expression)
+    catalogues = {}
+    for key in sorted(entries):
+        catalogues.setdefault(key[0], []).append(entries[key][1:])
+    partitions = sorted(catalogues) if condition is None else sorted(touched_partitions)
+    left_partitions = [] if condition is None or not touched_encounters else sorted(set(catalogues) - set(touched_partitions))
+    # Registered up front, the workers only look names up
     with pipeline.sql_client() as client:
-        results = client.execute_sql(pivot_query)
-        # Since execute_sql returns a list, we need to manually create column names
-        # Get column names by running a similar query with LIMIT 0
-        column_names = base_columns.copy()
-        column_names.append('date_created')  # Add date_created after base columns
-
-        for col in pivot_columns:
-            # Extract column name from "AS \"column_name\""
-            if 'AS' in col:
-                col_name = col.split(' AS ')[1].strip().strip('"')
-                column_names.append(col_name)
-                
-        # Yield each row with proper column names
-        for row in results: 
-            row_dict = {}
-            for i, value in enumerate(row):
-                if i < len(column_names):
-                    row_dict[column_names[i]] = value
-            yield row_dict
+        table_names_by_partition = register_partitions(client, partition_by, catalogues)
+        column_names = register_columns(
+            client, [entry for partition_name in partitions for entry in catalogues[partition_name]]
+        )
+
+    def build_partition(partition_name):
+        table_name = table_names_by_partition[partition_name]
+        partition_condition = f"{partition_expression} = {repr_sql_string(partition_name)}"
+        # Every worker pivots on its own cursor of the shared DuckDB connection
+        with pipeline.sql_client() as client:
+            columns = limit_pivot_columns(
+                client,
+                table_name,
+                pivot_column_definitions(catalogues[partition_name], column_names),
+                partition_condition,
+                incremental=condition is not None
+            )
+            if condition is None:
+                rows_written = replace_widened_table(
+                    client, table_name, build_pivot_query(columns, build_where_clause(partition_condition))
+                )
+            else:
+                added_columns = add_new_columns(client, table_name, columns)
+                where_clause = touched_where_clause(condition, added_columns, partition_condition)
+                rows_written = merge_widened_table(
+                    client, table_name, build_pivot_query(columns, where_clause), touched_encounters
+                )
+            create_one_hot_view(client, table_name, catalogues[partition_name], column_names)
+        return table_name, rows_written
+
+    with pipeline.sql_client() as client:
+        pivoted_until = get_pivoted_until(client, touched_where_clause(condition, []))
+        with ThreadPoolExecutor(max_workers=get_pivot_option("partition_workers", 4)) as executor:
+            built = list(executor.map(build_partition, partitions))
+        rows_written = sum(rows for _, rows in built)
+        for partition_name in left_partitions:
+            if get_table_columns(client, table_names_by_partition[partition_name]):
+                rows_written += delete_encounters(client, table_names_by_partition[partition_name], touched_encounters)
+
+    table_names = [table_name for table_name, _ in built]
+    print(f"Pivoted {len(table_names)} wide tables by {partition_by}")
+    if not table_names:
+        return rows_written
+    # Only their state is recorded, every sql_client() call validates the whole dlt schema
+    record_widened_tables(
+        pipeline, table_names, "replace" if condition is None else "merge", pivoted_until, with_columns=False
+    )
+    return rows_written
+
+def create_widened_one_hot_view(pipeline):
+    """One-hot view over a widened_observations table loaded by the dlt writer"""
+    catalogue = read_concept_catalogue(pipeline)
+    with pipeline.sql_client() as client:
+        create_one_hot_view(client, WIDENED_TABLE, catalogue)
 
 def run_pivoting_transformation():
     """Run the comprehensive pivoting transformation"""
-    pipeline = dlt.pipeline(
-        pipeline_name="openmrs_etl",
-        destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-        dataset_name="openmrs_analytics"
-    )
+    pipeline = get_pipeline()
+    # Everything flattened so far is pivoted, the change log up to now is covered
+    with pipeline.sql_client() as client:
+        changes_until = get_changes_until(client)
     
-    load_info = pipeline.run(create_widened_observations())
+    if get_pivot_option("writer", "sql") == "sql":
+        create_widened_observations_in_database(pipeline)
+    else:
+        # dlt can not add its NOT NULL _dlt columns to a table the sql writer built,
+        # dlt drops it with its schema table (answer lists are typed differently)
+        with pipeline.sql_client() as client:
+            refresh = "drop_resources" if built_by_other_writer(client, WIDENED_TABLE) else None
+        if refresh:
+            print(f"{WIDENED_TABLE} was built by the sql writer - dropping it")
+        load_info = pipeline.run(create_widened_observations(), refresh=refresh)
+        create_widened_one_hot_view(pipeline)
+    pivot_partitions(pipeline)
+    clear_changes(pipeline, changes_until)
     print("✅ Comprehensive pivoting completed! All value types included.")
     return pipeline
 
 
 def incremental_widened_observations(pipeline, start_date=None, end_date=None):
-    """Incremental update for widened observations using dlt merge"""
+    """
+    Incremental update for widened observations: every encounter the flatten changed
+    since the last pivot (in its change log), or with flattened rows created in the
+    date range, is re-pivoted and merged on person_id + encounter_id. Returns the wide
+    rows deleted and inserted (written), None after a full pivot.
+    """
     if pipeline is None:
-        pipeline = dlt.pipeline(
-            pipeline_name="openmrs_etl",
-            destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-            dataset_name="openmrs_analytics"
-        )
-    
-    # Check if dates are provided
-    if start_date is None and end_date is None:
-        # No dates provided - get latest data from destination
+        pipeline = get_pipeline()
+
+    changes_until = None
+    if start_date or end_date:
+        # Encounters with flattened rows created in the date range
+        if start_date and end_date:
+            created = f"date_created BETWEEN '{start_date}' AND '{end_date}'"
+        elif start_date:
+            created = f"date_created >= '{start_date}'"
+        else:
+            created = f"date_created <= '{end_date}'"
+        touched_encounters = f"SELECT encounter_id FROM openmrs_analytics.flattened_observations WHERE {created}"
+    else:
+        # No dates provided - the encounters the flatten changed since the last pivot
         with pipeline.sql_client() as client:
-            result = client.execute_sql("""
-                SELECT MAX(date_created) as last_date 
-                FROM openmrs_analytics.flattened_observations
-            """)
-            last_date = result[0][0] if result and result[0][0] else None
-        
-        if last_date:
-            # Incremental update from last date
-            start_date = last_date
-            end_date = None
-            print(f"Auto: Incremental pivot update since last date: {last_date}")
-    
-    # Build where clause for flattened_observations
-    where_clause = ""
-    if start_date and end_date:
-        where_clause = f"WHERE date_created BETWEEN '{start_date}' AND '{end_date}'"
-    elif start_date:
-        where_clause = f"WHERE date_created >= '{start_date}'"
+            changes_until = get_changes_until(client)
+        if changes_until is None:
+            print("No flattened changes to pivot")
+            return {"rows_written": 0}
+        touched_encounters = changed_encounters_query(changes_until)
+        print(f"Auto: Incremental pivot update of the flattened changes up to {changes_until}")
+
+    with pipeline.sql_client() as client:
+        rebuild = built_by_other_writer(client, WIDENED_TABLE)
+    if rebuild:
+        print(f"[openmrs.pivot] writer changed since {WIDENED_TABLE} was built - running a full pivot")
+        run_pivoting_transformation()
+        return
+
+    # Touched encounters are re-pivoted from all of their rows, those without rows left are deleted
+    condition = f"encounter_id IN ({touched_encounters})"
+
+    if get_pivot_option("writer", "sql") == "sql":
+        print(f"Running incremental pivoting for date range: {start_date} to {end_date}")
+        rows_written = merge_widened_observations_in_database(pipeline, condition, touched_encounters)
+        rows_written += pivot_partitions(pipeline, condition, touched_encounters)
+        clear_changes(pipeline, changes_until)
+        print(f"✅ Incremental pivoting completed! {rows_written} wide rows deleted or inserted")
+        return {"rows_written": rows_written}
 
     @dlt.resource(
         name="widened_observations", 
         write_disposition="merge", 
-        primary_key=["person_id", "encounter_id"]
+        primary_key=WIDENED_PRIMARY_KEY
     )
     def incremental_widened_data():
         """Create widened columns for incremental data"""
         
-        # Get concept metadata
-        concepts, coded_concept_answers = get_concept_metadata(pipeline)
+        # Extend the concept catalogue from the new rows only and read column definitions from it
+        catalogue = update_concept_catalogue(pipeline, condition)
         
-        if not concepts:
+        if not catalogue:
             print("No concepts found for pivoting")
             return
         
         # Build columns for each concept based on value type
-        pivot_columns = []
-        
-        for concept_name, value_type in concepts:
-            safe_concept_name = create_safe_column_name(concept_name)
-            escaped_concept_name = escape_sql_string(concept_name)
-            
-            if value_type == 'coded':
-                # Create one-hot columns for each answer
-                answers = coded_concept_answers.get(concept_name, [])
-                for answer_name in answers:
-                    safe_answer_name = create_safe_column_name(answer_name)
-                    escaped_answer_name = escape_sql_string(answer_name)
-                    column_name = f"{safe_concept_name}_{safe_answer_name}"
-                    
-                    pivot_columns.append(
-                        f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' AND value_coded_name = '{escaped_answer_name}' THEN 1 ELSE 0 END) AS \"{column_name}\""
-                    )
-            
-            elif value_type == 'numeric':
-                pivot_columns.append(
-                    f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' THEN value_numeric END) AS \"{safe_concept_name}_value\""
-                )
-            
-            elif value_type == 'text':
-                pivot_columns.append(
-                    f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' THEN value_text END) AS \"{safe_concept_name}_text\""
-                )
-            
-            elif value_type == 'datetime':
-                pivot_columns.append(
-                    f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' THEN value_datetime END) AS \"{safe_concept_name}_datetime\""
-                )
-            
-            elif value_type == 'drug':
-                pivot_columns.append(
-                    f"MAX(CASE WHEN concept_name = '{escaped_concept_name}' THEN value_drug END) AS \"{safe_concept_name}_drug_id\""
-                )
-        
-        # Add base encounter information
-        base_columns = [
-            "person_id",
-            "encounter_id",
-            "encounter_type_name",
-            "visit_date_started",
-            "location_name"
-        ]
-
-        # Build the final query with where clause for incremental data
-        pivot_query = f"""
-        SELECT
-            {', '.join(base_columns)},
-            MAX(date_created) as date_created,
-            {', '.join(pivot_columns)}
-        FROM openmrs_analytics.flattened_observations
-        {where_clause}
-        GROUP BY
-            {', '.join(base_columns)}
-        """
+        columns = get_pivot_columns(pipeline, catalogue, incremental=True)
 
-        # Execute query and yield results
+        # New columns are added before the load, one-hot columns with DEFAULT 0 on the
+        # rows this run does not touch, and the encounters with their obs are backfilled
         with pipeline.sql_client() as client:
-            results = client.execute_sql(pivot_query)
-            # Since execute_sql returns a list, we need to manually create column names
-            column_names = base_columns.copy()
-            column_names.append('date_created')  # Add date_created after base columns
-
-            for col in pivot_columns:
-                # Extract column name from "AS \"column_name\""
-                if 'AS' in col:
-                    col_name = col.split(' AS ')[1].strip().strip('"')
-                    column_names.append(col_name)
-                    
-            # Yield each row with proper column names
-            for row in results: 
-                row_dict = {}
-                for i, value in enumerate(row):
-                    if i < len(column_names):
-                        row_dict[column_names[i]] = value
-                yield row_dict
-
-    # Run the incremental update using dlt's merge capability
+            added_columns = add_new_columns(client, WIDENED_TABLE, columns)
+
+        yield from yield_pivoted_rows(pipeline, columns, touched_where_clause(condition, added_columns))
+
+    # Run the incremental update using dlt's merge capability, the merge only replaces
+    # encounters that still have rows
     print(f"Running incremental pivoting for date range: {start_date} to {end_date}")
+    rows_written = 0
+    with pipeline.sql_client() as client:
+        if get_table_columns(client, WIDENED_TABLE):
+            rows_written = delete_encounters(client, WIDENED_TABLE, touched_encounters)
     load_info = pipeline.run(incremental_widened_data())
+    rows_written += pipeline.last_trace.last_normalize_info.row_counts.get(WIDENED_TABLE, 0)
+    create_widened_one_hot_view(pipeline)
+    rows_written += pivot_partitions(pipeline, condition, touched_encounters)
+    clear_changes(pipeline, changes_until)
     print(f"✅ Incremental pivoting completed! Load info: {load_info}")
+    return {"rows_written": rows_written}
     
 def run_incremental_pivoting(pipeline=None, start_date=None, end_date=None):
     """Run the incremental pivoting transformation"""
     if pipeline is None:
-        pipeline = dlt.pipeline(
-            pipeline_name="openmrs_etl",
-            destination=dlt.destinations.duckdb("/opt/airflow/data/openmrs_etl.duckdb"),
-            dataset_name="openmrs_analytics"
-        )
+        pipeline = get_pipeline()
     
     incremental_widened_observations(pipeline, start_date, end_date)
     return pipeline
@@ -0,0 +1,20 @@
+"""
+Shared fixtures: every test gets its own DuckDB database and pipelines directory
+"""
+import os
+import sys
+
+import pytest
+
+# The pipeline and benchmarks packages are imported from the dlt/ directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# No usage reporting from test pipelines
+os.environ["RUNTIME__DLTHUB_TELEMETRY"] = "false"
+
+
+@pytest.fixture
+def pipeline_env(tmp_path, monkeypatch):
+    """Point get_pipeline() at a fresh database and pipeline state under tmp_path"""
+    monkeypatch.setenv("DB_PATH", str(tmp_path / "openmrs_etl.duckdb"))
+    monkeypatch.setenv("PIPELINES_DIR", str(tmp_path / "pipelines"))
+    return tmp_path
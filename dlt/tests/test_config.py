@@ -0,0 +1,38 @@
+"""
+Options set through environment variables arrive as strings and are typed like in config.toml
+"""
+from datetime import datetime, timedelta
+
+from pipeline import load_raw_tables
+from pipeline.pipeline_runner import get_transform_option
+from pipeline.transform_flatten.dimensions import lagged_watermark
+from pipeline.transform_pivot.observations import concept_selection_condition, get_pivot_option
+
+
+def test_table_flags_from_the_environment(monkeypatch):
+    monkeypatch.setenv("OPENMRS__TABLES__OBS__CHANGE_CURSOR", "false")
+    monkeypatch.setenv("OPENMRS__TABLES__DRUG_ORDER__ROW_HASH", "false")
+    monkeypatch.setenv("OPENMRS__TABLES__ENCOUNTER__APPEND_FAST_PATH", "false")
+
+    assert load_raw_tables.uses_change_cursor("obs") is False
+    assert load_raw_tables.uses_row_hash("drug_order") is False
+    assert load_raw_tables.get_table_option("encounter", "append_fast_path", False) is False
+
+
+def test_numbers_from_the_environment(monkeypatch):
+    monkeypatch.setenv("OPENMRS__EXTRACT__CHANGE_CURSOR_LAG", "60")
+    monkeypatch.setenv("OPENMRS__EXTRACT__PK_CHUNK_SIZE", "1000")
+    monkeypatch.setenv("OPENMRS__TRANSFORM__WORKERS", "2")
+    monkeypatch.setenv("OPENMRS__PIVOT__MAX_COLUMNS", "100")
+
+    assert lagged_watermark(datetime(2024, 1, 1)) == datetime(2024, 1, 1) - timedelta(seconds=60)
+    assert load_raw_tables.get_extract_option("pk_chunk_size", load_raw_tables.DEFAULT_PK_CHUNK_SIZE) == 1000
+    assert get_transform_option("workers", 3) == 2
+    assert get_pivot_option("max_columns", None, int) == 100
+
+
+def test_lists_from_the_environment(monkeypatch):
+    monkeypatch.setenv("OPENMRS__PIVOT__INCLUDE_CONCEPTS", "[5089, 5090]")
+    monkeypatch.setenv("OPENMRS__PIVOT__EXCLUDE_CONCEPTS", "[5090]")
+
+    assert concept_selection_condition() == "((concept_id IN (5089, 5090))) AND (NOT concept_id IN (5090))"
@@ -0,0 +1,29 @@
+"""
+Synthetic data generator tests
+"""
+import duckdb
+import pytest
+
+from benchmarks.generate import SCALES, check_data_shape, generate_tables
+
+
+def test_tiny_scale_matches_its_shape():
+    conn = duckdb.connect()
+    row_counts = generate_tables(conn, SCALES["tiny"])
+
+    scale = SCALES["tiny"]
+    encounters = scale["patients"] * scale["encounters_per_patient"]
+    assert row_counts["encounter"] == encounters
+    assert row_counts["obs"] == encounters * scale["obs_per_encounter"]
+    # rnd() spreads values evenly over its range
+    genders = dict(conn.execute("SELECT gender, COUNT(*) FROM openmrs_analytics.person GROUP BY gender").fetchall())
+    assert abs(genders["F"] - genders["M"]) < 0.1 * sum(genders.values())
+
+
+def test_check_data_shape_rejects_missing_concepts():
+    conn = duckdb.connect()
+    generate_tables(conn, SCALES["tiny"])
+    conn.execute("DELETE FROM openmrs_analytics.obs WHERE concept_id = 1")
+
+    with pytest.raises(ValueError):
+        check_data_shape(conn, SCALES["tiny"])
@@ -0,0 +1,219 @@
+"""
+Incremental flatten and pivot runs must give the same tables as a full rebuild,
+on the tiny benchmark scale with voids, renames and new rows applied in between
+"""
+import duckdb
+import pytest
+
+from benchmarks.generate import SCALES, generate_tables
+from pipeline.config import get_db_path, get_pipeline
+from pipeline.load_raw_tables import CHANGE_CURSOR
+from pipeline.transform_flatten import (
+    create_dimension_tables,
+    create_flattened_appointments,
+    create_flattened_observations,
+    create_flattened_patient_program,
+    incremental_dimension_tables,
+    incremental_flattened_appointments,
+    incremental_flattened_observations,
+    incremental_flattened_patient_program
+)
+from pipeline.transform_flatten.observations import CHANGES_TABLE
+from pipeline.transform_pivot import incremental_widened_observations, run_pivoting_transformation
+from pipeline.transform_pivot.observations import PARTITION_REGISTRY_TABLE
+
+FLATTENED_TABLES = {
+    "flattened_observations": (create_flattened_observations, incremental_flattened_observations),
+    "flattened_appointments": (create_flattened_appointments, incremental_flattened_appointments),
+    "flattened_patient_program": (create_flattened_patient_program, incremental_flattened_patient_program),
+}
+
+# Source changes made after the first build, each stamped with a new change cursor
+CHANGES = [
+    # Void one obs and every obs of another encounter
+    "UPDATE obs SET voided = true, {cursor} = now() WHERE obs_id = 291",
+    "UPDATE obs SET voided = true, {cursor} = now() WHERE encounter_id = 31",
+    # Void an encounter, move one to another encounter type and another obs to another encounter
+    "UPDATE encounter SET voided = true, {cursor} = now() WHERE encounter_id = 40",
+    "UPDATE encounter SET encounter_type = encounter_type % 10 + 1, {cursor} = now() WHERE encounter_id = 50",
+    "UPDATE obs SET encounter_id = 61, {cursor} = now() WHERE obs_id = 601",
+    # Rename a question and an answer concept, a location and a patient
+    "UPDATE concept_name SET name = 'Renamed question', {cursor} = now() WHERE concept_id = 8",
+    "UPDATE concept_name SET name = 'Renamed answer', {cursor} = now() WHERE concept_id = 60",
+    "UPDATE location SET name = 'Renamed location', {cursor} = now() WHERE location_id = 3",
+    "UPDATE person_name SET given_name = 'Renamed', {cursor} = now() WHERE person_id IN (5, 7)",
+    # Rename the concept of a program workflow state
+    "UPDATE concept_name SET name = 'Renamed state', {cursor} = now() WHERE concept_id = 108",
+    # New encounter with copies of the obs of encounter 100
+    """INSERT INTO encounter SELECT * REPLACE (100000 AS encounter_id, now() AS date_created, now() AS {cursor})
+       FROM encounter WHERE encounter_id = 100""",
+    """INSERT INTO obs SELECT * REPLACE (obs_id + 1000000 AS obs_id, 100000 AS encounter_id,
+       now() AS date_created, now() AS {cursor})
+       FROM obs WHERE encounter_id = 100""",
+    # A new coded question concept, observed once, and an answer concept 4 never had,
+    # their one-hot columns are 0 on the rows pivoted before
+    """INSERT INTO concept SELECT * REPLACE (100001 AS concept_id, now() AS date_created, now() AS {cursor})
+       FROM concept WHERE concept_id = 4""",
+    """INSERT INTO concept_name SELECT * REPLACE (100001 AS concept_name_id, 100001 AS concept_id,
+       'New question' AS name, now() AS date_created, now() AS {cursor})
+       FROM concept_name WHERE concept_id = 4""",
+    """INSERT INTO obs SELECT * REPLACE (2000001 AS obs_id, 100001 AS concept_id, 51 AS value_coded,
+       false AS voided, now() AS date_created, now() AS {cursor})
+       FROM obs WHERE obs_id = 2001""",
+    """INSERT INTO obs SELECT * REPLACE (2000002 AS obs_id, 4 AS concept_id, 51 AS value_coded,
+       false AS voided, now() AS date_created, now() AS {cursor})
+       FROM obs WHERE obs_id = 2001""",
+    # New program state and a changed appointment
+    """INSERT INTO patient_state SELECT * REPLACE (100000 AS patient_state_id, start_date + INTERVAL 90 DAY AS start_date,
+       now() AS date_created, now() AS {cursor})
+       FROM patient_state WHERE patient_program_id = 9 ORDER BY patient_state_id DESC LIMIT 1""",
+    "UPDATE patient_appointment SET status = 'Missed', {cursor} = now() WHERE patient_appointment_id = 11",
+]
+
+
+def execute(sql):
+    """Run statements on the pipeline's DuckDB database with the dataset as default schema"""
+    conn = duckdb.connect(get_db_path())
+    try:
+        conn.execute("SET schema = 'openmrs_analytics'")
+        conn.execute(sql)
+        return conn.fetchall()
+    except duckdb.InvalidInputException:
+        # Statements without a result
+        return None
+    finally:
+        conn.close()
+
+
+def add_change_cursors(conn):
+    """Give every generated table with date_created the change cursor column of loaded tables"""
+    tables = conn.execute("""
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = 'openmrs_analytics' AND column_name = 'date_created'
+    """).fetchall()
+    for (table_name,) in tables:
+        conn.execute(f"ALTER TABLE openmrs_analytics.{table_name} ADD COLUMN {CHANGE_CURSOR} TIMESTAMPTZ")
+        conn.execute(f"UPDATE openmrs_analytics.{table_name} SET {CHANGE_CURSOR} = date_created")
+
+
+@pytest.fixture(params=[
+    {},
+    {"OPENMRS__PIVOT__PARTITION_BY": "encounter_type"},
+    {"OPENMRS__PIVOT__WRITER": "dlt"},
+], ids=["sql", "partitioned", "dlt_writer"])
+def pivot_options(request, monkeypatch):
+    """[openmrs.pivot] options of the pivot parity tests, set before the first build"""
+    for key, value in request.param.items():
+        monkeypatch.setenv(key, value)
+    return request.param
+
+
+@pytest.fixture
+def tiny_pipeline(pipeline_env):
+    """Tiny scale raw tables with change cursors and a full build of every transformation"""
+    conn = duckdb.connect(get_db_path())
+    generate_tables(conn, SCALES["tiny"])
+    add_change_cursors(conn)
+    conn.close()
+
+    pipeline = get_pipeline()
+    create_dimension_tables(pipeline)
+    for create, incremental in FLATTENED_TABLES.values():
+        create(pipeline)
+    run_pivoting_transformation()
+    return pipeline
+
+
+def apply_changes():
+    for change in CHANGES:
+        execute(change.format(cursor=CHANGE_CURSOR))
+
+
+def table_difference(client, table_name, expected_table_name, columns=None):
+    """Rows in either table but not in the other, compared on columns (all by default)"""
+    select = ", ".join(f'"{name}"' for name in columns) if columns else "*"
+    return client.execute_sql(f"""
+        (SELECT {select} FROM {table_name} EXCEPT ALL SELECT {select} FROM {expected_table_name})
+        UNION ALL
+        (SELECT {select} FROM {expected_table_name} EXCEPT ALL SELECT {select} FROM {table_name})
+    """)
+
+
+def snapshot(client, table_name):
+    """Copy a table as <table>_incremental before the full rebuild replaces it"""
+    client.execute_sql(f"CREATE OR REPLACE TABLE {table_name}_incremental AS SELECT * FROM {table_name}")
+
+
+def columns_of(client, table_name):
+    """Data columns of a table, without the load ids and row ids of the dlt writer"""
+    return [row[0] for row in client.execute_sql(f"DESCRIBE {table_name}") if not row[0].startswith("_dlt")]
+
+
+def test_incremental_flatten_matches_full_rebuild(tiny_pipeline):
+    pipeline = tiny_pipeline
+    apply_changes()
+
+    incremental_dimension_tables(pipeline)
+    for create, incremental in FLATTENED_TABLES.values():
+        incremental(pipeline)
+    with pipeline.sql_client() as client:
+        for table_name in FLATTENED_TABLES:
+            snapshot(client, table_name)
+
+    create_dimension_tables(pipeline)
+    for create, incremental in FLATTENED_TABLES.values():
+        create(pipeline)
+    with pipeline.sql_client() as client:
+        for table_name in FLATTENED_TABLES:
+            assert table_difference(client, f"{table_name}_incremental", table_name) == [], table_name
+        # The changes did reach the flattened rows
+        assert client.execute_sql(
+            "SELECT COUNT(*) FROM flattened_observations WHERE obs_id = 291 OR encounter_id IN (31, 40)"
+        )[0][0] == 0
+        assert client.execute_sql(
+            "SELECT COUNT(*) FROM flattened_observations WHERE concept_name = 'Renamed question'"
+        )[0][0] > 0
+        assert client.execute_sql(
+            "SELECT COUNT(*) FROM flattened_patient_program WHERE current_state_name = 'Renamed state'"
+        )[0][0] > 0
+
+
+def wide_tables(client):
+    """widened_observations and the partition tables of the registry"""
+    table_names = ["widened_observations"]
+    if client.execute_sql(
+        "SELECT 1 FROM information_schema.tables WHERE table_schema = 'openmrs_analytics' AND table_name = ?",
+        PARTITION_REGISTRY_TABLE
+    ):
+        table_names += [
+            row[0] for row in client.execute_sql(f"SELECT table_name FROM {PARTITION_REGISTRY_TABLE} ORDER BY table_name")
+        ]
+    return table_names
+
+
+def test_incremental_pivot_matches_full_rebuild(pivot_options, tiny_pipeline):
+    pipeline = tiny_pipeline
+    apply_changes()
+
+    incremental_dimension_tables(pipeline)
+    for create, incremental in FLATTENED_TABLES.values():
+        incremental(pipeline)
+    incremental_widened_observations(pipeline)
+    with pipeline.sql_client() as client:
+        table_names = wide_tables(client)
+        for table_name in table_names:
+            snapshot(client, table_name)
+        # Encounter 30 had obs 291, 31 and 40 no longer have obs
+        assert client.execute_sql(
+            "SELECT COUNT(*) FROM widened_observations WHERE encounter_id IN (31, 40)"
+        )[0][0] == 0
+        # Every change was pivoted
+        assert client.execute_sql(f"SELECT COUNT(*) FROM {CHANGES_TABLE}")[0][0] == 0
+
+    run_pivoting_transformation()
+    with pipeline.sql_client() as client:
+        for table_name in table_names:
+            # Columns of concepts without obs left stay in the incremental table
+            columns = columns_of(client, table_name)
+            assert set(columns) <= set(columns_of(client, f"{table_name}_incremental")), table_name
+            assert table_difference(client, f"{table_name}_incremental", table_name, columns) == [], table_name
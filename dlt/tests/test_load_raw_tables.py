@@ -0,0 +1,210 @@
+"""
+Extract tests against a local SQLite source standing in for MySQL
+"""
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+
+import pytest
+import sqlalchemy as sa
+
+from pipeline import load_raw_tables
+from pipeline.config import get_pipeline
+from pipeline.metrics import RunMetrics
+
+
+def create_source_tables(path, table_names, rows=3):
+    """SQLite tables with an id key and date_created cursor"""
+    conn = sqlite3.connect(path)
+    for table_name in table_names:
+        conn.execute(f"CREATE TABLE {table_name} (id INTEGER PRIMARY KEY, value TEXT, date_created TIMESTAMP)")
+        conn.executemany(
+            f"INSERT INTO {table_name} VALUES (?, ?, ?)",
+            [(i, f"{table_name}-{i}", f"2024-01-0{i} 00:00:00") for i in range(1, rows + 1)]
+        )
+    conn.commit()
+    conn.close()
+
+
+def use_source_tables(pipeline_env, monkeypatch, table_names, rows=3):
+    """Load table_names from a SQLite source instead of the OpenMRS tables"""
+    source_path = pipeline_env / "source.db"
+    create_source_tables(source_path, table_names, rows)
+    monkeypatch.setattr(
+        load_raw_tables,
+        "RAW_TABLES",
+        {table_name: {"primary_key": "id", "cursor": "date_created"} for table_name in table_names}
+    )
+    monkeypatch.setenv("SOURCES__SQL_DATABASE__CREDENTIALS", f"sqlite:///{source_path}")
+
+
+def test_parallel_extract_with_more_tables_than_workers(pipeline_env, monkeypatch):
+    table_names = [f"table_{i}" for i in range(6)]
+    use_source_tables(pipeline_env, monkeypatch, table_names)
+    monkeypatch.setenv("EXTRACT__WORKERS", "2")
+    # Small batches so every table yields several times while holding its connection
+    monkeypatch.setenv("SOURCES__SQL_DATABASE__CHUNK_SIZE", "1")
+
+    connections = {"open": 0, "max_open": 0}
+    create_source_engine = load_raw_tables.create_source_engine
+
+    def counting_engine(workers):
+        engine = create_source_engine(workers)
+
+        @sa.event.listens_for(engine, "checkout")
+        def checkout(*args):
+            connections["open"] += 1
+            connections["max_open"] = max(connections["max_open"], connections["open"])
+
+        @sa.event.listens_for(engine, "checkin")
+        def checkin(*args):
+            connections["open"] -= 1
+        return engine
+
+    monkeypatch.setattr(load_raw_tables, "create_source_engine", counting_engine)
+
+    load_raw_tables.load_tables(mode="poll")
+
+    with get_pipeline().sql_client() as client:
+        for table_name in table_names:
+            assert client.execute_sql(f"SELECT COUNT(*) FROM {table_name}")[0][0] == 3
+    assert connections["max_open"] <= 2
+
+
+def test_excluded_columns_are_not_selected(pipeline_env, monkeypatch):
+    use_source_tables(pipeline_env, monkeypatch, ["table_0"])
+    monkeypatch.setenv("OPENMRS__TABLES__TABLE_0__EXCLUDE_COLUMNS", '["value"]')
+
+    load_raw_tables.load_tables(mode="poll")
+
+    with get_pipeline().sql_client() as client:
+        columns = {row[0] for row in client.execute_sql(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = 'table_0'"
+        )}
+    assert "value" not in columns
+    assert {"id", "date_created", "row_changed_at"} <= columns
+
+
+def test_columns_named_like_part_of_an_excluded_column_are_selected(pipeline_env, monkeypatch):
+    use_source_tables(pipeline_env, monkeypatch, ["table_0"])
+    monkeypatch.setenv("OPENMRS__TABLES__TABLE_0__EXCLUDE_COLUMNS", '["value_complex"]')
+
+    assert load_raw_tables.keeps_column("table_0", "value")
+    assert not load_raw_tables.keeps_column("table_0", "value_complex")
+
+
+def with_mysql_functions(engine):
+    """Register the MySQL functions of row_hash_expression on a SQLite engine"""
+    @sa.event.listens_for(engine, "connect")
+    def register_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function("md5", 1, lambda value: hashlib.md5(value.encode()).hexdigest())
+        dbapi_connection.create_function("concat_ws", -1, lambda separator, *values: separator.join(values))
+    return engine
+
+
+def test_row_hash_diff_reads_new_and_changed_rows(pipeline_env, monkeypatch):
+    use_source_tables(pipeline_env, monkeypatch, ["table_0"])
+    monkeypatch.setitem(load_raw_tables.RAW_TABLES, "table_0", {"primary_key": "id", "cursor": None})
+    engine = with_mysql_functions(sa.create_engine(f"sqlite:///{pipeline_env / 'source.db'}"))
+    pipeline = get_pipeline()
+
+    changed_keys, row_count = load_raw_tables.get_changed_keys(pipeline, engine, "table_0")
+    assert changed_keys is None and row_count == 3
+    load_raw_tables.commit_row_hashes(pipeline, ["table_0"])
+
+    with engine.begin() as conn:
+        conn.execute(sa.text("UPDATE table_0 SET value = 'changed' WHERE id = 2"))
+        conn.execute(sa.text("INSERT INTO table_0 VALUES (4, 'new', '2024-01-04 00:00:00')"))
+    changed_keys, row_count = load_raw_tables.get_changed_keys(pipeline, engine, "table_0")
+    assert sorted(changed_keys) == [(2,), (4,)] and row_count == 4
+
+    # Without a commit the manifest still has the old hashes
+    changed_keys, _ = load_raw_tables.get_changed_keys(pipeline, engine, "table_0")
+    assert sorted(changed_keys) == [(2,), (4,)]
+    load_raw_tables.commit_row_hashes(pipeline, ["table_0"])
+    assert load_raw_tables.get_changed_keys(pipeline, engine, "table_0")[0] == []
+
+
+def test_chunked_load_resumes_after_the_last_checkpoint(pipeline_env, monkeypatch):
+    use_source_tables(pipeline_env, monkeypatch, ["table_0"], rows=5)
+    monkeypatch.setitem(load_raw_tables.RAW_TABLES, "table_0", {"primary_key": "id", "cursor": "date_created", "chunked": True})
+    monkeypatch.setenv("OPENMRS__EXTRACT__PK_CHUNK_SIZE", "2")
+
+    pk_range = load_raw_tables.openmrs_pk_range
+    started_ranges = []
+
+    def crash_on_second_range(engine, table_name, lower, upper, checkpoint):
+        started_ranges.append(lower)
+        if started_ranges == [1, 3]:
+            raise RuntimeError("extract stopped")
+        return pk_range(engine, table_name, lower, upper, checkpoint)
+
+    monkeypatch.setattr(load_raw_tables, "openmrs_pk_range", crash_on_second_range)
+    with pytest.raises(RuntimeError):
+        load_raw_tables.load_tables(mode="poll")
+    load_raw_tables.load_tables(mode="poll")
+
+    # The first range is not loaded again
+    assert started_ranges == [1, 3, 3, 5]
+    with get_pipeline().sql_client() as client:
+        assert client.execute_sql("SELECT COUNT(*), COUNT(DISTINCT id) FROM table_0")[0] == (5, 5)
+
+
+def test_chunked_load_rows_are_in_the_extract_metrics(pipeline_env, monkeypatch):
+    use_source_tables(pipeline_env, monkeypatch, ["table_0"], rows=5)
+    monkeypatch.setitem(load_raw_tables.RAW_TABLES, "table_0", {"primary_key": "id", "cursor": "date_created", "chunked": True})
+    monkeypatch.setenv("OPENMRS__EXTRACT__PK_CHUNK_SIZE", "2")
+
+    metrics = RunMetrics("full")
+    with metrics.stage("extract") as rows:
+        traces = load_raw_tables.load_tables(mode="poll")
+        metrics.record_load("extract", traces, rows)
+
+    # Three ranges, then the incremental run of all tables
+    assert len(traces) == 4
+    table_record = next(record for record in metrics.records if record["table_name"] == "table_0")
+    assert table_record["rows_written"] == 5
+    assert metrics.records[-1]["rows_written"] == 5
+
+
+def test_append_fast_path_keeps_one_version_per_key(pipeline_env, monkeypatch):
+    use_source_tables(pipeline_env, monkeypatch, ["table_0"])
+    monkeypatch.setenv("OPENMRS__TABLES__TABLE_0__APPEND_FAST_PATH", "true")
+    load_raw_tables.load_tables(mode="poll")
+
+    conn = sqlite3.connect(pipeline_env / "source.db")
+    conn.execute("UPDATE table_0 SET value = 'changed', date_created = '2024-01-05 00:00:00' WHERE id = 2")
+    conn.execute("INSERT INTO table_0 VALUES (4, 'new', '2024-01-06 00:00:00')")
+    conn.commit()
+    conn.close()
+    load_raw_tables.load_tables(mode="poll")
+
+    with get_pipeline().sql_client() as client:
+        rows = client.execute_sql("SELECT id, value FROM table_0 ORDER BY id")
+    assert rows == [(1, "table_0-1"), (2, "changed"), (3, "table_0-3"), (4, "new")]
+    with get_pipeline().sql_client() as client:
+        assert client.execute_sql(f"SELECT COUNT(*) FROM {load_raw_tables.APPEND_DEDUPE_TABLE}")[0][0] == 0
+
+
+def test_append_window_skips_unchanged_rows_in_any_session_time_zone(pipeline_env, monkeypatch):
+    use_source_tables(pipeline_env, monkeypatch, ["table_0"])
+    monkeypatch.setenv("OPENMRS__TABLES__TABLE_0__APPEND_FAST_PATH", "true")
+    load_raw_tables.load_tables(mode="poll")
+
+    pipeline = get_pipeline()
+    sql_client = pipeline.sql_client
+
+    @contextmanager
+    def sql_client_in_new_york():
+        # dlt sets the session time zone to UTC, loaded cursors then come back in UTC
+        with sql_client() as client:
+            client.execute_sql("SET TimeZone = 'America/New_York'")
+            yield client
+
+    monkeypatch.setattr(pipeline, "sql_client", sql_client_in_new_york)
+    engine = sa.create_engine(f"sqlite:///{pipeline_env / 'source.db'}")
+    append_window = load_raw_tables.get_append_window(
+        pipeline, engine, "table_0", load_raw_tables.get_source_state(pipeline)
+    )
+    # Only id 3 is within the lag of the last cursor value
+    assert append_window["skip_keys"] == [3]
@@ -0,0 +1,67 @@
+"""
+Stage records, dlt load rows and the pipeline_run_metrics table
+"""
+import dlt
+import pytest
+
+from pipeline.config import get_pipeline
+from pipeline.metrics import METRICS_COLUMNS, METRICS_TABLE, RunMetrics
+
+
+def test_stage_records_process_totals_only_when_asked():
+    metrics = RunMetrics("full")
+    with metrics.stage("alone") as rows:
+        rows["rows_read"] = 3
+    with metrics.stage("concurrent", process_totals=False):
+        pass
+
+    alone, concurrent = metrics.records
+    assert alone["status"] == "success" and alone["rows_read"] == 3
+    assert alone["cpu_seconds"] is not None and alone["max_rss_so_far_mb"] > 0
+    assert concurrent["wall_seconds"] is not None
+    assert concurrent["cpu_seconds"] is None and concurrent["max_rss_so_far_mb"] is None
+
+
+def test_failed_stage_is_recorded_and_raised():
+    metrics = RunMetrics("full")
+    with pytest.raises(ValueError):
+        with metrics.stage("pivot"):
+            raise ValueError("no concepts")
+
+    assert metrics.records[0]["status"] == "failed"
+    assert metrics.records[0]["error"] == "no concepts"
+
+
+def test_load_rows_are_summed_over_every_run(pipeline_env):
+    pipeline = get_pipeline()
+    traces = []
+    for ids in ([1, 2], [3, 4, 5]):
+        pipeline.run(dlt.resource([{"id": i} for i in ids], name="table_0"))
+        traces.append(pipeline.last_trace)
+
+    metrics = RunMetrics("full")
+    with metrics.stage("extract") as rows:
+        metrics.record_load("extract", traces, rows)
+
+    table_record, stage_record = metrics.records
+    assert table_record["table_name"] == "table_0"
+    assert table_record["rows_read"] == table_record["rows_written"] == 5
+    assert stage_record["rows_read"] == stage_record["rows_written"] == 5
+
+
+def test_save_adds_new_columns_to_an_older_metrics_table(pipeline_env):
+    pipeline = get_pipeline()
+    with pipeline.sql_client() as client:
+        client.execute_sql(f"CREATE SCHEMA IF NOT EXISTS {client.fully_qualified_dataset_name()}")
+        client.execute_sql(f"CREATE TABLE {METRICS_TABLE} (run_id VARCHAR, stage VARCHAR, peak_rss_mb DOUBLE)")
+
+    metrics = RunMetrics("full")
+    with metrics.stage("dimensions"):
+        pass
+    metrics.save(pipeline)
+
+    with pipeline.sql_client() as client:
+        saved = client.execute_sql(f"SELECT stage, max_rss_so_far_mb FROM {METRICS_TABLE}")
+        columns = {row[0] for row in client.execute_sql(f"DESCRIBE {METRICS_TABLE}")}
+    assert saved == [("dimensions", metrics.records[0]["max_rss_so_far_mb"])]
+    assert set(METRICS_COLUMNS) <= columns
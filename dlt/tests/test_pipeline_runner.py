@@ -0,0 +1,63 @@
+"""
+The flatten steps run concurrently give the tables of a serial run, and their metrics
+"""
+import duckdb
+import pytest
+
+from benchmarks.generate import SCALES, generate_tables
+from pipeline.config import get_db_path, get_pipeline
+from pipeline.metrics import RunMetrics
+from pipeline.pipeline_runner import FLATTEN_STEPS, run_flatten_steps
+from pipeline.transform_flatten import create_dimension_tables
+
+FLATTENED_TABLES = [step[3][0] for step in FLATTEN_STEPS]
+STEP_NAMES = [step[0] for step in FLATTEN_STEPS]
+
+
+@pytest.fixture
+def tiny_dimensions(pipeline_env):
+    """Tiny scale raw tables and their dimension tables"""
+    conn = duckdb.connect(get_db_path())
+    generate_tables(conn, SCALES["tiny"])
+    conn.close()
+    pipeline = get_pipeline()
+    create_dimension_tables(pipeline)
+    return pipeline
+
+
+def flatten(pipeline, monkeypatch, workers):
+    monkeypatch.setenv("OPENMRS__TRANSFORM__WORKERS", str(workers))
+    metrics = RunMetrics("full")
+    run_flatten_steps(metrics, pipeline)
+    return {record["stage"]: record for record in metrics.records}
+
+
+def test_concurrent_flatten_matches_serial_flatten(tiny_dimensions, monkeypatch):
+    pipeline = tiny_dimensions
+    serial_records = flatten(pipeline, monkeypatch, 1)
+    with pipeline.sql_client() as client:
+        for table_name in FLATTENED_TABLES:
+            client.execute_sql(f"CREATE TABLE {table_name}_serial AS SELECT * FROM openmrs_analytics.{table_name}")
+
+    records = flatten(pipeline, monkeypatch, 3)
+
+    with pipeline.sql_client() as client:
+        for table_name in FLATTENED_TABLES:
+            assert client.execute_sql(f"""
+                SELECT COUNT(*) FROM (
+                    (SELECT * FROM openmrs_analytics.{table_name} EXCEPT ALL SELECT * FROM {table_name}_serial)
+                    UNION ALL
+                    (SELECT * FROM {table_name}_serial EXCEPT ALL SELECT * FROM openmrs_analytics.{table_name})
+                )
+            """) == [(0,)], table_name
+
+    assert set(records) == set(STEP_NAMES) | {"flatten"}
+    for name, table_name in zip(STEP_NAMES, FLATTENED_TABLES):
+        record = records[name]
+        assert record["status"] == "success"
+        assert record["rows_written"] == serial_records[name]["rows_written"] > 0, table_name
+        # Concurrent steps only have their own wall time, the process totals are on the group
+        assert record["cpu_seconds"] is None and record["max_rss_so_far_mb"] is None
+        assert serial_records[name]["cpu_seconds"] is not None
+    assert records["flatten"]["rows_written"] == sum(records[name]["rows_written"] for name in STEP_NAMES)
+    assert records["flatten"]["cpu_seconds"] is not None
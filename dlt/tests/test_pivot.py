@@ -0,0 +1,155 @@
+"""
+Pivot column and partition table names from their registries
+"""
+import pytest
+
+from pipeline.config import get_pipeline
+from pipeline.transform_pivot.observations import (
+    case_pivot_query,
+    create_one_hot_view,
+    get_pivot_columns,
+    native_pivot_query,
+    register_columns,
+    register_partitions,
+    update_concept_catalogue
+)
+
+
+@pytest.fixture
+def client(pipeline_env):
+    with get_pipeline().sql_client() as client:
+        client.execute_sql(f"CREATE SCHEMA IF NOT EXISTS {client.fully_qualified_dataset_name()}")
+        yield client
+
+
+@pytest.fixture
+def flattened(client):
+    """flattened_observations of three encounters with coded, numeric and text concepts"""
+    client.execute_sql("""
+        CREATE TABLE openmrs_analytics.flattened_observations AS
+        SELECT
+            person_id::BIGINT AS person_id,
+            encounter_id::BIGINT AS encounter_id,
+            'Visit' AS encounter_type_name,
+            TIMESTAMPTZ '2024-01-01 00:00:00+00' AS visit_date_started,
+            'Clinic' AS location_name,
+            TIMESTAMPTZ '2024-01-02 00:00:00+00' AS date_created,
+            concept_id::BIGINT AS concept_id,
+            concept_name,
+            value_coded::BIGINT AS value_coded,
+            'Answer ' || value_coded AS value_coded_name,
+            value_numeric::DOUBLE AS value_numeric,
+            value_text::VARCHAR AS value_text,
+            NULL::TIMESTAMPTZ AS value_datetime,
+            NULL::BIGINT AS value_drug
+        FROM (VALUES
+            (1, 10, 4, 'Answered', 51, NULL, NULL),
+            (1, 10, 4, 'Answered', 52, NULL, NULL),
+            (1, 10, 5, 'Weight', NULL, 70.5, NULL),
+            (2, 20, 4, 'Answered', 52, NULL, NULL),
+            (2, 20, 6, 'Note', NULL, NULL, 'Seen'),
+            (2, 21, 5, 'Weight', NULL, 80.0, NULL)
+        ) obs(person_id, encounter_id, concept_id, concept_name, value_coded, value_numeric, value_text)
+    """)
+
+
+def test_column_names_are_unique_and_stable(client):
+    catalogue = [
+        (1, "numeric", "HIV/ART", []),
+        (2, "numeric", "HIV ART", []),
+        (3, "text", None, []),
+    ]
+    column_names = register_columns(client, catalogue)
+    assert len(set(column_names.values())) == 3
+    assert column_names[(1, "numeric", None)] == "hiv_art_value"
+    assert column_names[(3, "text", None)] == "concept_3_text"
+
+    # A renamed concept keeps its column, a new one with the old name does not take it
+    renamed = [(1, "numeric", "Renamed", [])] + catalogue[1:] + [(5, "numeric", "HIV/ART", [])]
+    new_names = register_columns(client, renamed)
+    assert {key: new_names[key] for key in column_names} == column_names
+    assert new_names[(5, "numeric", None)] not in column_names.values()
+
+
+def test_partition_table_names_never_collide(client):
+    partitions = ["HIV/ART", "HIV ART", "", "one hot", "a" * 50, "a" * 50 + "b"]
+    table_names = register_partitions(client, "encounter_type", partitions)
+    assert len(set(table_names.values())) == len(partitions)
+    assert table_names[""] == "widened_observations_partition"
+    # widened_observations_one_hot is the one-hot view of widened_observations
+    assert table_names["one hot"] != "widened_observations_one_hot"
+
+    # Names are kept across runs and shared by no other partitioning
+    assert register_partitions(client, "encounter_type", ["HIV ART"]) == table_names
+    form_table_names = register_partitions(client, "form", ["HIV ART"])
+    assert form_table_names["HIV ART"] not in table_names.values()
+
+
+def test_one_hot_view_is_dropped_outside_list_mode(client, flattened, monkeypatch):
+    monkeypatch.setenv("OPENMRS__PIVOT__CODED_COLUMNS", "list")
+    catalogue = [(4, "coded", "Answered", [51, 52])]
+    column_names = register_columns(client, catalogue)
+    client.execute_sql(f"""
+        CREATE TABLE openmrs_analytics.widened_observations AS
+        SELECT 1 AS encounter_id, [51] AS "{column_names[(4, "coded", None)]}"
+    """)
+    views = "SELECT view_name FROM duckdb_views() WHERE view_name = 'widened_observations_one_hot'"
+
+    create_one_hot_view(client, "widened_observations", catalogue)
+    assert client.execute_sql(f"""
+        SELECT "{column_names[(4, "coded", 51)]}", "{column_names[(4, "coded", 52)]}" FROM openmrs_analytics.widened_observations_one_hot
+    """) == [(1, 0)]
+
+    monkeypatch.setenv("OPENMRS__PIVOT__CODED_COLUMNS", "one_hot")
+    create_one_hot_view(client, "widened_observations", catalogue)
+    assert client.execute_sql(views) == []
+
+
+@pytest.mark.parametrize("coded_columns", ["one_hot", "list"])
+def test_native_pivot_matches_case_pivot(client, flattened, monkeypatch, coded_columns):
+    monkeypatch.setenv("OPENMRS__PIVOT__CODED_COLUMNS", coded_columns)
+    pipeline = get_pipeline()
+    columns = get_pivot_columns(pipeline, update_concept_catalogue(pipeline))
+
+    for where_clause in ["", "WHERE encounter_id IN (10, 21)"]:
+        native_rows = client.execute_sql(native_pivot_query(columns, where_clause))
+        case_rows = client.execute_sql(case_pivot_query(columns, where_clause))
+        assert sorted(native_rows) == sorted(case_rows)
+    # Encounters 10 and 21 were pivoted, into weight, note and one column per answer (or the answer list)
+    assert len(case_rows) == 2
+    assert len(columns) == (4 if coded_columns == "one_hot" else 3)
+
+
+def catalogue_concepts(pipeline):
+    return [entry[0] for entry in update_concept_catalogue(pipeline)]
+
+
+def test_concept_options_select_the_pivoted_concepts(client, flattened, monkeypatch):
+    pipeline = get_pipeline()
+    monkeypatch.setenv("OPENMRS__PIVOT__INCLUDE_CONCEPTS", "[4, 5]")
+    monkeypatch.setenv("OPENMRS__PIVOT__EXCLUDE_CONCEPTS", "[5]")
+    assert catalogue_concepts(pipeline) == [4]
+
+    # Concept 6 has a single obs
+    monkeypatch.delenv("OPENMRS__PIVOT__INCLUDE_CONCEPTS")
+    monkeypatch.delenv("OPENMRS__PIVOT__EXCLUDE_CONCEPTS")
+    monkeypatch.setenv("OPENMRS__PIVOT__MIN_OBSERVATIONS", "2")
+    assert catalogue_concepts(pipeline) == [4, 5]
+
+
+def test_concepts_over_max_columns_are_in_the_overflow_view(client, flattened, monkeypatch):
+    pipeline = get_pipeline()
+    catalogue = update_concept_catalogue(pipeline)
+    overflow = "SELECT concept_id, COUNT(*) FROM openmrs_analytics.widened_observations_overflow GROUP BY concept_id ORDER BY concept_id"
+
+    # The encounter columns and date_created leave two columns, taken by the answers of the most observed concept
+    monkeypatch.setenv("OPENMRS__PIVOT__MAX_COLUMNS", "8")
+    columns = get_pivot_columns(pipeline, catalogue)
+    assert [(column[0], column[2]) for column in columns] == [(4, 51), (4, 52)]
+    assert client.execute_sql(overflow) == [(5, 2), (6, 1)]
+
+    monkeypatch.delenv("OPENMRS__PIVOT__MAX_COLUMNS")
+    assert len(get_pivot_columns(pipeline, catalogue)) == 4
+    assert client.execute_sql(
+        "SELECT COUNT(*) FROM duckdb_views() WHERE view_name = 'widened_observations_overflow'"
+    ) == [(0,)]
@@ -0,0 +1,4 @@
+-- Binlog change data capture (extract mode "binlog") reads the row-based
+-- binlog as a replica, which needs replication privileges for the dlt user
+GRANT REPLICATION SLAVE, REPLICATION CLIENT ON *.* TO 'openmrs'@'%';
+FLUSH PRIVILEGES;